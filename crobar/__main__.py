@@ -1,47 +1,345 @@
+import argparse
+import logging
+import signal
 import sys
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Type
 
-from .arch import ConcreteDebugInterface
+from .agent import AgentClient
+from .agent import AgentServer
+from . import arch
+from .cache import CachingDebugInterface
+from .guard import DriftEvent
+from .guard import PatchGuard
+from .identify import FingerprintCache
+from .identify import VersionIndex
+from .identify import identify_process
+from .metrics import InstrumentedDebugInterface
+from .metrics import Metrics
+from .multi import MODE_APPLY
+from .multi import MODE_REVERT
+from .multi import MODE_VERIFY
+from .multi import TargetResult
+from .multi import patch_all
+from .offline import DIFF_SUFFIX
+from .offline import FileDiff
+from .offline import OfflinePatchResult
+from .offline import patch_file
+from .offline import verify_file
+from .patchplan import PatchPlan
+from .patchplan import compile_plan
+from .record import RecordingDebugInterface
+from .record import ReplayDebugInterface
+from .signature import Signature
+from .signature import SignatureScanner
+from .snapshot import SnapshotDebugInterface
+from .snapshot import take_snapshot
 from .versions import ALL_VERSIONS
+from .versions.base import BaseTalosVersion
+from .watch import DEFAULT_RATE
+from .watch import WATCH_EXECUTE
+from .watch import WATCH_WRITE
+from .watch import WatchEvent
+from .watch import Watcher
+from .watch import Watchpoint
+from .watch import WatchpointHit
 from crobar.api import DebugInterface
 from crobar.api import TalosVersion
 
 
 # TODO move all this stuff out into proper classes and packages and stuff
-print("Attaching to Talos")
-debug_interface: DebugInterface = ConcreteDebugInterface()
-
-print("Finding Talos version")
-for talos_version_type in ALL_VERSIONS:
-    ver_addr, ver_string, = talos_version_type.get_version_identifier()
-    exe_string: bytes = debug_interface.read_memory(
-        addr=ver_addr,
-        length=len(ver_string))
-    if ver_string == exe_string:
-        print(f"Found Talos version: {talos_version_type!r}")
-        talos_version: TalosVersion = talos_version_type(
-            debug_interface=debug_interface)
-        break
+parser = argparse.ArgumentParser(prog="crobar", description="Make multiplayer work for The Talos Principle.")
+target_mode = parser.add_mutually_exclusive_group()
+target_mode.add_argument("--pid", type=int, help="attach to this process instead of searching for Talos")
+target_mode.add_argument("--all", action="store_true", help="patch every running Talos process at once; works with --verify and --revert")
+parser.add_argument("--agent", action="store_true", help="stay running, keep Talos attached (reattaching whenever it restarts) and take requests over a Unix socket; patches it on every attach, unless --verify is given")
+parser.add_argument("--agent-status", action="store_true", help="ask a running agent how it's doing")
+parser.add_argument("--socket", metavar="PATH", help="the agent's Unix socket (default: $XDG_RUNTIME_DIR/crobar.sock)")
+parser.add_argument("--timeout", type=float, default=60.0, metavar="SECONDS", help="with --all, give up on any process still going after this long (default: %(default)s)")
+parser.add_argument("--find", action="append", metavar="SIGNATURE", help="just print where a byte signature like \"85 c0 0f 84 ?? ?? 00 00\" shows up in executable memory (as linked, not where it's loaded); can be given more than once")
+parser.add_argument("--snapshot", metavar="PATH", help="just copy every bit of memory Talos can read into PATH, for --from-snapshot to look at later; use --stop-session to keep it still while that happens")
+parser.add_argument("--compress", action="store_true", help="with --snapshot, compress whatever compresses")
+parser.add_argument("--watchpoint", action="append", metavar="ADDR[,LENGTH[,KIND]]", help="just print every time the game touches this address (as linked, like --find prints), using a hardware watchpoint, until interrupted; KIND is write (the default), access or execute, and LENGTH defaults to 4 (or 1 for execute); up to 4 of them (Linux only)")
+parser.add_argument("--watch", action="store_true", help="don't patch anything, just print the game's live state whenever it changes, until interrupted")
+parser.add_argument("--guard", type=float, metavar="SECONDS", help="after patching, stay running and check the patches are still there this often, patching them again if the game puts them back; works with --agent")
+parser.add_argument("--rate", type=float, default=DEFAULT_RATE, metavar="HZ", help="how often --watch looks (default: %(default)s)")
+patch_mode = parser.add_mutually_exclusive_group()
+patch_mode.add_argument("--verify", action="store_true", help="just report which patches are applied, without changing anything")
+patch_mode.add_argument("--revert", action="store_true", help="undo every patch instead of applying them")
+parser.add_argument("--patch-file", metavar="EXECUTABLE", help="patch a copy of an executable on disk instead of a running game; works with --verify and --revert")
+parser.add_argument("--output", metavar="PATH", help="where --patch-file writes its copy (default: EXECUTABLE.patched, or EXECUTABLE.unpatched with --revert)")
+parser.add_argument("--unpatch-file", nargs=2, metavar=("EXECUTABLE", "DIFF"), help="undo the changes recorded in a diff left by --patch-file, in place")
+parser.add_argument("--no-cache", action="store_true", help="don't cache memory reads")
+parser.add_argument("--no-fingerprint", action="store_true", help="identify the version from memory only, not from the executable file")
+parser.add_argument("--no-relocate", action="store_true", help="assume the executable is loaded where it was linked (Linux only)")
+parser.add_argument("--wait", action="store_true", help="if Talos isn't running yet, wait for it to start (Linux only)")
+record_mode = parser.add_mutually_exclusive_group()
+record_mode.add_argument("--record", metavar="LOG", help="log every read and write made to Talos, for --replay to use later")
+record_mode.add_argument("--replay", metavar="LOG", help="run against a log left by --record, instead of a running game")
+record_mode.add_argument("--from-snapshot", metavar="SNAPSHOT", help="run against a snapshot left by --snapshot, instead of a running game; it's read-only, so works with --verify and --find")
+parser.add_argument("--metrics", metavar="PATH", help="count and time everything done to Talos, and save it here when done: as JSON if PATH ends in .json, otherwise as a Prometheus textfile")
+verbosity = parser.add_mutually_exclusive_group()
+verbosity.add_argument("-v", "--verbose", action="store_true", help="say more about what's going on")
+verbosity.add_argument("-q", "--quiet", action="store_true", help="only say what happened, and anything that went wrong")
+parser.add_argument("--stop-session", action="store_true", help="keep Talos stopped the whole time, instead of only while writing (Linux only)")
+args = parser.parse_args()
+if args.compress and args.snapshot is None:
+    parser.error("--compress only makes sense with --snapshot")
+if args.from_snapshot is not None and not (args.verify or args.find or args.watch or args.snapshot):
+    parser.error("--from-snapshot is read-only, so needs --verify, --find or --watch")
+if args.guard is not None and (args.verify or args.revert):
+    parser.error("--guard only makes sense when applying patches")
+if args.record is not None and (args.all or args.agent):
+    parser.error("--record only works with one Talos at a time, so not with --all or --agent")
+if args.metrics is not None and args.agent:
+    parser.error("--metrics doesn't work with --agent")
+
+logging.basicConfig(
+    level=(logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO),
+    format="%(message)s")
+logger = logging.getLogger("crobar")
+metrics: Optional[Metrics] = None if args.metrics is None else Metrics()
+
+if args.unpatch_file is not None:
+    unpatch_path, diff_path, = args.unpatch_file
+    FileDiff.load(diff_path).apply(unpatch_path, reverse=True)
+    logger.info("Restored %r", unpatch_path)
+    sys.exit(0)
+
+if args.patch_file is not None:
+    if args.verify:
+        offline_result: OfflinePatchResult = verify_file(args.patch_file, versions=ALL_VERSIONS)
+    else:
+        output_path: str = args.output or (args.patch_file + (".unpatched" if args.revert else ".patched"))
+        offline_result = patch_file(args.patch_file, output_path, versions=ALL_VERSIONS, revert=args.revert)
+        logger.info("Wrote %r, with a diff in %r", output_path, output_path + DIFF_SUFFIX)
+    print(f"Found Talos version: {offline_result.version!r}")
+    for name, outcome in offline_result.results.items():
+        if isinstance(outcome, bool):
+            outcome = "OK" if outcome else ("Not patched" if args.revert else "Already patched")
+        print(f"- patch_{name}: {outcome}")
+    for name, reason in offline_result.skipped.items():
+        print(f"- patch_{name}: skipped, needs a running game ({reason})")
+    sys.exit(0)
+
+interface_args: Dict[str, Any] = {}
+if args.pid is not None:
+    interface_args["pid"] = args.pid
+if args.wait:
+    interface_args["wait"] = True
+if args.no_relocate:
+    interface_args["relocate"] = False
+if args.stop_session:
+    interface_args["stop_for_session"] = True
+
+if args.agent_status:
+    agent_client = AgentClient(args.socket)
+    for key, value in agent_client.status().items():
+        print(f"{key}: {value}")
+    agent_client.close()
+    sys.exit(0)
+
+if args.agent:
+    # Waiting happens in the agent's own loop, where it doesn't hold up the socket.
+    interface_args.pop("wait", None)
+    # The agent gets the PID on its own, since it attaches to whichever Talos turns up after the first.
+    interface_args.pop("pid", None)
+    agent_server = AgentServer(
+        args.socket,
+        versions=ALL_VERSIONS,
+        pid=args.pid,
+        interface_args=interface_args,
+        mode=(MODE_VERIFY if args.verify else MODE_REVERT if args.revert else MODE_APPLY),
+        guard_interval=args.guard,
+        fingerprint_cache=(None if args.no_fingerprint else FingerprintCache()))
+    # Being told to stop should still let go of Talos and tidy up the socket.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        agent_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+if args.all:
+    if args.guard is not None:
+        parser.error("--guard doesn't work with --all; use --agent")
+    pids: List[int] = arch.find_talos_pids()
+    if not pids:
+        raise Exception(f"Could not find Talos in the process list")
+    logger.info("Patching %d Talos processes", len(pids))
+    target_results: List[TargetResult] = patch_all(
+        pids,
+        versions=ALL_VERSIONS,
+        mode=(MODE_VERIFY if args.verify else MODE_REVERT if args.revert else MODE_APPLY),
+        interface_args=interface_args,
+        cache_reads=not args.no_cache,
+        fingerprint_cache=(None if args.no_fingerprint else FingerprintCache()),
+        metrics=metrics,
+        timeout=args.timeout)
+    for target_result in target_results:
+        timings: str = ", ".join(f"{phase} {seconds*1000.0:.1f} ms" for phase, seconds in target_result.timings.items())
+        if not target_result.ok:
+            print(f"{target_result.pid:d}: FAILED: {target_result.error} ({timings})")
+            continue
+        print(f"{target_result.pid:d}: {target_result.version!r} ({timings})")
+        for name, outcome in target_result.results.items():
+            if isinstance(outcome, bool):
+                outcome = "OK" if outcome else ("Not patched" if args.revert else "Already patched")
+            print(f"- patch_{name}: {outcome}")
+    if metrics is not None:
+        metrics.save(args.metrics)
+    sys.exit(0 if all(target_result.ok for target_result in target_results) else 1)
+
+raw_debug_interface: DebugInterface
+if args.replay is not None:
+    logger.info("Replaying %r", args.replay)
+    raw_debug_interface = ReplayDebugInterface(args.replay)
+elif args.from_snapshot is not None:
+    logger.info("Reading snapshot %r", args.from_snapshot)
+    raw_debug_interface = SnapshotDebugInterface(args.from_snapshot)
 else:
-    raise Exception(f"Could not identify the version of the running Talos executable")
+    logger.info("Attaching to Talos")
+    raw_debug_interface = arch.ConcreteDebugInterface(**interface_args)
+if args.record is not None:
+    raw_debug_interface = RecordingDebugInterface(raw_debug_interface, args.record)
+debug_interface: DebugInterface = raw_debug_interface
+if metrics is not None:
+    debug_interface = InstrumentedDebugInterface(debug_interface, metrics)
+if not args.no_cache:
+    debug_interface = CachingDebugInterface(debug_interface)
+
+# Whichever way this ends, the recording and the metrics still need finishing off.
+try:
+    if args.find:
+        scanner = SignatureScanner(Signature.parse(text, name=text) for text in args.find)
+        scan_start: float = time.perf_counter()
+        # Big sequential reads would just thrash the cache.
+        found: Dict[str, List[int]] = scanner.find_all(raw_debug_interface)
+        logger.info("Scanned executable memory in %.1f ms", (time.perf_counter()-scan_start)*1000.0)
+        # As linked, so they match a disassembly, and can go straight into --watchpoint or a version class.
+        find_relocation: int = raw_debug_interface.from_relative_addr(0)
+        for text, addrs in found.items():
+            print(f"{text}: {', '.join(f'0x{addr - find_relocation:08x}' for addr in addrs) or 'not found'}")
+        sys.exit(0)
+
+    if args.snapshot is not None:
+        logger.info("Taking a snapshot")
+        # Like --find, this is far too much to cache.
+        snapshot_stats = take_snapshot(raw_debug_interface, args.snapshot, compress=args.compress)
+        logger.info("Snapshot: %r", snapshot_stats)
+        print(f"Wrote {args.snapshot}")
+        sys.exit(0)
+
+    if args.watchpoint:
+        watchpoints: List[Watchpoint] = []
+        for spec in args.watchpoint:
+            parts: List[str] = spec.split(",")
+            kind: str = parts[2] if len(parts) >= 3 else WATCH_WRITE
+            watchpoints.append(Watchpoint(
+                addr=debug_interface.from_relative_addr(int(parts[0], 0)),
+                length=(int(parts[1], 0) if len(parts) >= 2 else 1 if kind == WATCH_EXECUTE else 4),
+                kind=kind))
+        relocation: int = debug_interface.from_relative_addr(0)
+
+        def print_hit(hit: WatchpointHit) -> None:
+            value: str = "" if hit.value is None else f" = {hit.value.hex(' ')}"
+            print(f"{hit.tid:d}: {hit.watchpoint.kind} 0x{hit.watchpoint.addr - relocation:08x} from 0x{hit.ip - relocation:08x}{value}", flush=True)
+
+        watch_hardware: Any = getattr(raw_debug_interface, "watch_hardware", None)
+        if watch_hardware is None:
+            raise Exception(f"Hardware watchpoints aren't supported here")
+        logger.info("Watching %d addresses", len(watchpoints))
+        try:
+            watch_hardware(watchpoints, print_hit)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    logger.info("Finding Talos version")
+    talos_version_type: Optional[Type[TalosVersion]] = identify_process(
+        debug_interface,
+        index=VersionIndex(ALL_VERSIONS),
+        cache=(None if args.no_fingerprint else FingerprintCache()),
+        # A replay or a snapshot can't look at the file, so a recording needs to have seen it done without.
+        use_file=not (args.no_fingerprint or args.record or args.replay or args.from_snapshot))
+    if talos_version_type is None:
+        raise Exception(f"Could not identify the version of the running Talos executable")
+    print(f"Found Talos version: {talos_version_type!r}")
+    talos_version: TalosVersion = talos_version_type(
+        debug_interface=debug_interface)
+
+    if args.watch:
+        if not isinstance(talos_version, BaseTalosVersion):
+            raise Exception(f"Don't know what to watch in {talos_version_type!r}")
+        # Anything cached would never change.
+        watcher = Watcher(
+            debug_interface.inner if isinstance(debug_interface, CachingDebugInterface) else debug_interface,
+            rate=args.rate)
+        watcher.add_all(talos_version.get_watches())
+        logger.info("Watching %d values at %g Hz", len(watcher.watches), watcher.rate)
+
+        def print_change(event: WatchEvent) -> None:
+            print(f"{time.strftime('%H:%M:%S')} {event.name}: {event.old!r} -> {event.new!r}", flush=True)
+
+        try:
+            watcher.run(print_change)
+        except KeyboardInterrupt:
+            pass
+        logger.info("Watched: %r", watcher.stats)
+        sys.exit(0)
+
+    plan: PatchPlan = compile_plan(debug_interface, talos_version.get_patch_manifest())
 
-print("Applying patches")
+    if args.verify:
+        logger.info("Verifying patches")
+        for name, state in plan.verify(debug_interface).items():
+            print(f"- patch_{name}: {state}")
+    elif args.revert:
+        logger.info("Reverting patches")
+        for name, changed in plan.revert(debug_interface).items():
+            print(f"- patch_{name}: {'OK' if changed else 'Not patched'}")
+    else:
+        logger.info("Applying patches")
+        for name, changed in plan.apply(debug_interface).items():
+            print(f"- patch_{name}: {'OK' if changed else 'Already patched'}")
+        if args.guard is not None:
+            # Anything cached would never drift.
+            guard = PatchGuard(
+                debug_interface.inner if isinstance(debug_interface, CachingDebugInterface) else debug_interface,
+                plan,
+                interval=args.guard,
+                metrics=metrics)
+            logger.info("Guarding %d patched ranges every %g seconds", len(guard.sites), guard.interval)
 
-sys.stdout.write("- patch_enable_esga: ")
-sys.stdout.write("OK" if talos_version.patch_enable_esga() else "Already patched")
-sys.stdout.write("\n")
+            def print_drift(event: DriftEvent) -> None:
+                print(f"{time.strftime('%H:%M:%S')} patch_{event.name}: drifted at 0x{event.addr:08x}, {event.outcome}", flush=True)
 
-sys.stdout.write("- patch_bypass_game_mode_checks_for_map_vote: ")
-sys.stdout.write("OK" if talos_version.patch_bypass_game_mode_checks_for_map_vote() else "Already patched")
-sys.stdout.write("\n")
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                guard.run(print_drift)
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            logger.info("Guarded: %r", guard.stats)
 
-sys.stdout.write("- patch_crash_on_nexus_0001: ")
-sys.stdout.write("OK" if talos_version.patch_crash_on_nexus_0001() else "Already patched")
-sys.stdout.write("\n")
+finally:
+    if metrics is not None:
+        metrics.collect(debug_interface)
+        metrics.save(args.metrics)
+        logger.info("Saved metrics to %r", args.metrics)
 
-sys.stdout.write("- patch_upgrade_singleplayer: ")
-sys.stdout.write("OK" if talos_version.patch_upgrade_singleplayer() else "Already patched")
-sys.stdout.write("\n")
+    if isinstance(raw_debug_interface, RecordingDebugInterface):
+        raw_debug_interface.close()
+        logger.info("Recorded to %r", raw_debug_interface.path)
+        raw_debug_interface = raw_debug_interface.inner
 
-sys.stdout.write("- patch_ignore_pure_mode: ")
-sys.stdout.write("OK" if talos_version.patch_ignore_pure_mode() else "Already patched")
-sys.stdout.write("\n")
+    if isinstance(debug_interface, CachingDebugInterface):
+        logger.info("Read cache: %r", debug_interface.stats)
+    for transfer_name, transfer_stats in getattr(raw_debug_interface, "transfer_stats", {}).items():
+        logger.info("Transfers via %s: %r", transfer_name, transfer_stats)
+    freeze_stats: Any = getattr(raw_debug_interface, "freeze_stats", None)
+    if freeze_stats is not None:
+        logger.info("Froze Talos: %r", freeze_stats)
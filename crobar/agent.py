@@ -0,0 +1,539 @@
+"""A long-running agent that keeps Talos attached, and takes requests over a Unix socket.
+
+Attaching, identifying the version and compiling the patch plan all happen once,
+rather than once per run. If Talos exits, the agent waits for it to come back,
+and attaches to it again (patching it again, if it was asked to).
+If it was given a guard interval, it also keeps checking that the patches
+are still in place, and patches again whatever the game puts back.
+
+Everything happens on one thread, since ptrace only takes requests from the thread that attached.
+
+The protocol is little-endian binary. Every message is a header and then a payload.
+Requests have a payload length (u32), a request number (u32) and an opcode (u8).
+Replies have the same, except with a status instead of an opcode.
+Errors carry a UTF-8 message as their payload.
+
+- OP_READ: (address u64, length u32) pairs.
+  Replies with a length (i32, -1 if it couldn't be read) and then that many bytes, for each one.
+- OP_WRITE: (address u64, length u32, data) triples. Replies with nothing.
+- OP_PATCH: a mode byte, then patch names separated by commas (or nothing, for all of them).
+  Replies with JSON.
+- OP_STATUS: nothing. Replies with JSON.
+- OP_REGIONS: nothing. Replies with (start u64, end u64, flags u8, offset u64, path length u16, path)
+  for each mapped region.
+"""
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import tempfile
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Type
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import TalosVersion
+from crobar import arch
+from crobar.arch.base import BaseDebugInterface
+from crobar.cache import CachingDebugInterface
+from crobar.guard import PatchGuard
+from crobar.identify import FingerprintCache
+from crobar.identify import VersionIndex
+from crobar.identify import identify_process
+from crobar.multi import MODE_APPLY
+from crobar.multi import MODE_REVERT
+from crobar.multi import MODE_VERIFY
+from crobar.patchplan import PatchPlan
+from crobar.patchplan import compile_plan
+from crobar.versions import AnyVersion
+
+logger = logging.getLogger(__name__)
+
+OP_READ = 1
+OP_WRITE = 2
+OP_PATCH = 3
+OP_STATUS = 4
+OP_REGIONS = 5
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_MODES: Sequence[str] = (MODE_APPLY, MODE_REVERT, MODE_VERIFY)
+
+_HEADER = struct.Struct("<IIB")
+_RANGE = struct.Struct("<QI")
+_LENGTH = struct.Struct("<i")
+
+# Nobody has any business sending or asking for more than this in one go.
+MAX_PAYLOAD: int = 64 * 1024 * 1024
+
+# How often to check whether Talos is still there, or back again.
+POLL_INTERVAL: float = 1.0
+
+
+class AgentException(HackingOpException):
+    """Fires when the agent can't be reached, or can't do what it was asked."""
+    __slots__ = ()
+
+
+def default_socket_path() -> str:
+    """Where the agent listens, unless told otherwise."""
+    runtime_dir: Optional[str] = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "crobar.sock")
+    return os.path.join(tempfile.gettempdir(), f"crobar-{os.getuid():d}.sock")
+
+
+def _recv_exactly(sock: socket.socket, length: int) -> bytes:
+    chunks: List[bytes] = []
+    while length > 0:
+        chunk: bytes = sock.recv(min(length, 1024 * 1024))
+        if not chunk:
+            raise AgentException("the agent hung up")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+
+class _Target:
+    """Everything we know about the Talos we're attached to."""
+    __slots__ = (
+        "debug_interface",
+        "version",
+        "plan",
+        "guard",
+        "next_guard",
+        "attached_at",
+    )
+
+    def __init__(self, debug_interface: DebugInterface, version: Type[TalosVersion], plan: PatchPlan) -> None:
+        self.debug_interface = debug_interface
+        self.version = version
+        self.plan = plan
+        # Only there while the patches are meant to be applied
+        self.guard: Optional[PatchGuard] = None
+        self.next_guard: float = 0.0
+        self.attached_at: float = time.time()
+
+    def is_alive(self) -> bool:
+        is_alive: Optional[Callable[[], bool]] = getattr(self.debug_interface, "is_alive", None)
+        return is_alive() if is_alive is not None else True
+
+
+class AgentServer:
+    """Keeps Talos attached, and serves requests for it until told to stop."""
+    __slots__ = (
+        "socket_path",
+        "requests",
+        "attaches",
+        "_listener",
+        "_clients",
+        "_pid",
+        "_interface_args",
+        "_mode",
+        "_guard_interval",
+        "_index",
+        "_fingerprint_cache",
+        "_target",
+        "_next_attach",
+        "_last_attach_error",
+    )
+
+    def __init__(
+            self,
+            socket_path: Optional[str]=None,
+            *,
+            versions: Sequence[AnyVersion],
+            pid: Optional[int]=None,
+            interface_args: Optional[Mapping[str, Any]]=None,
+            mode: str=MODE_VERIFY,
+            guard_interval: Optional[float]=None,
+            fingerprint_cache: Optional[FingerprintCache]=None) -> None:
+        """Starts listening. Nothing gets attached to until serve_forever() runs.
+
+        Every time Talos is attached to, the patch plan gets applied or reverted according to mode.
+        MODE_VERIFY leaves it alone.
+        With a guard_interval, applied patches get checked that often, and patched again if they drift.
+        """
+        self.socket_path: str = socket_path if socket_path is not None else default_socket_path()
+        self.requests: int = 0
+        self.attaches: int = 0
+        self._clients: Dict[socket.socket, bytearray] = {}
+        # Only used for the first attach. After that, we take whichever Talos shows up.
+        self._pid = pid
+        self._interface_args: Dict[str, Any] = dict(interface_args or {})
+        # Which process to attach to is up to us, not whoever built the arguments.
+        self._interface_args.pop("pid", None)
+        self._mode = mode
+        self._guard_interval = guard_interval
+        self._index = VersionIndex(versions)
+        self._fingerprint_cache = fingerprint_cache
+        self._target: Optional[_Target] = None
+        self._next_attach: float = 0.0
+        self._last_attach_error: Optional[str] = None
+        self._listener: socket.socket = self._listen()
+
+    def _listen(self) -> socket.socket:
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                # Left behind by an agent that didn't get to clean up.
+                os.unlink(self.socket_path)
+            else:
+                raise AgentException(f"an agent is already listening on {self.socket_path!r}")
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Anyone who can talk to this can write anywhere in the game, so it's ours alone.
+        old_umask: int = os.umask(0o177)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(8)
+        return listener
+
+    def close(self) -> None:
+        """Hangs up on everyone, lets go of Talos, and removes the socket."""
+        for client in list(self._clients):
+            client.close()
+        self._clients = {}
+        self._detach()
+        self._listener.close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def serve_forever(self) -> None:
+        logger.info("Agent listening on %r", self.socket_path)
+        try:
+            while True:
+                self._check_target()
+                self._check_guard()
+                readable: List[socket.socket]
+                readable, _, _, = select.select([self._listener, *self._clients], [], [], self._select_timeout())
+                for sock in readable:
+                    if sock is self._listener:
+                        client, _, = self._listener.accept()
+                        # Don't let a client that never reads its replies wedge us.
+                        client.settimeout(5.0)
+                        self._clients[client] = bytearray()
+                    else:
+                        self._service(sock)
+        finally:
+            self.close()
+
+    def _check_target(self) -> None:
+        if self._target is not None and not self._target.is_alive():
+            logger.info("Talos went away")
+            self._detach()
+        if self._target is None and time.monotonic() >= self._next_attach:
+            try:
+                self._attach()
+            except (HackingOpException, OSError) as e:
+                self._next_attach = time.monotonic() + POLL_INTERVAL
+                # Waiting for Talos to turn up would otherwise log this every second.
+                if str(e) != self._last_attach_error:
+                    logger.warning("Could not attach to Talos, will keep trying: %s", e)
+                    self._last_attach_error = str(e)
+
+    def _select_timeout(self) -> float:
+        if self._target is None or self._target.guard is None:
+            return POLL_INTERVAL
+        return max(0.0, min(POLL_INTERVAL, self._target.next_guard - time.monotonic()))
+
+    def _check_guard(self) -> None:
+        if self._target is None or self._target.guard is None or time.monotonic() < self._target.next_guard:
+            return
+        try:
+            self._target.guard.check()
+        except HackingOpException as e:
+            # Most likely Talos is on its way out, which _check_target() will notice.
+            logger.warning("Could not check patches: %s", e)
+        self._target.next_guard = time.monotonic() + self._target.guard.interval
+
+    def _guard(self, target: _Target, plan: PatchPlan) -> None:
+        if self._guard_interval is not None:
+            target.guard = PatchGuard(target.debug_interface, plan, interval=self._guard_interval)
+            target.next_guard = time.monotonic() + self._guard_interval
+
+    def _attach(self) -> None:
+        pid: Optional[int] = self._pid
+        self._pid = None
+        debug_interface: DebugInterface = arch.ConcreteDebugInterface(pid=pid, **self._interface_args)
+        try:
+            version: Optional[Type[TalosVersion]] = identify_process(
+                debug_interface,
+                index=self._index,
+                cache=self._fingerprint_cache)
+            if version is None:
+                raise HackingOpException(f"could not identify the version of the running Talos executable")
+
+            # The cache only lives as long as the compile. After that the game's moved on.
+            cached_interface = CachingDebugInterface(debug_interface)
+            plan: PatchPlan = compile_plan(cached_interface, version(debug_interface=cached_interface).get_patch_manifest())
+            if self._mode == MODE_APPLY:
+                plan.apply(debug_interface)
+            elif self._mode == MODE_REVERT:
+                plan.revert(debug_interface)
+        except BaseException:
+            debug_interface.close()
+            raise
+
+        self._target = _Target(debug_interface, version, plan)
+        if self._mode == MODE_APPLY:
+            self._guard(self._target, plan)
+        self._last_attach_error = None
+        self.attaches += 1
+        logger.info("Attached to %r", version)
+
+    def _detach(self) -> None:
+        if self._target is not None:
+            target: _Target = self._target
+            self._target = None
+            target.debug_interface.close()
+
+    def _require_target(self) -> _Target:
+        if self._target is not None and not self._target.is_alive():
+            self._detach()
+        if self._target is None:
+            # Don't make the client wait for the next poll if Talos is already back.
+            self._attach()
+        assert self._target is not None
+        return self._target
+
+    def _service(self, client: socket.socket) -> None:
+        buf: bytearray = self._clients[client]
+        try:
+            data: bytes = client.recv(1024 * 1024)
+            if not data:
+                raise ConnectionResetError()
+            buf += data
+            while len(buf) >= _HEADER.size:
+                length, request, op, = _HEADER.unpack_from(buf, 0)
+                if length > MAX_PAYLOAD:
+                    raise ConnectionResetError()
+                if len(buf) < _HEADER.size + length:
+                    break
+                payload: bytes = bytes(buf[_HEADER.size:_HEADER.size+length])
+                del buf[:_HEADER.size+length]
+
+                status: int = STATUS_OK
+                try:
+                    reply: bytes = self._dispatch(op, payload)
+                except (HackingOpException, OSError) as e:
+                    # An OSError here came from Talos (or /proc), not the client, so it still gets a reply.
+                    status, reply, = STATUS_ERROR, str(e).encode("utf-8")
+                except (ValueError, IndexError, struct.error) as e:
+                    status, reply, = STATUS_ERROR, f"bad request: {e}".encode("utf-8")
+                client.sendall(_HEADER.pack(len(reply), request, status) + reply)
+        except OSError:
+            # Hung up, timed out, or sent us garbage. Either way, we're done with it.
+            del self._clients[client]
+            client.close()
+
+    def _dispatch(self, op: int, payload: bytes) -> bytes:
+        self.requests += 1
+        if op == OP_STATUS:
+            return json.dumps(self.status()).encode("utf-8")
+
+        target: _Target = self._require_target()
+        debug_interface: DebugInterface = target.debug_interface
+        if op == OP_READ:
+            ranges: List[Tuple[int, int]] = list(_RANGE.iter_unpack(payload))
+            if sum(length for addr, length in ranges) > MAX_PAYLOAD:
+                raise AgentException(f"asked for more than {MAX_PAYLOAD:d} bytes in one go")
+            reply: List[bytes] = []
+            for data in debug_interface.read_many(ranges=ranges):
+                if data is None:
+                    reply.append(_LENGTH.pack(-1))
+                else:
+                    reply += [_LENGTH.pack(len(data)), data]
+            return b"".join(reply)
+
+        elif op == OP_WRITE:
+            chunks: List[Tuple[int, bytes]] = []
+            offset: int = 0
+            while offset < len(payload):
+                addr, length, = _RANGE.unpack_from(payload, offset)
+                offset += _RANGE.size
+                if offset + length > len(payload):
+                    raise AgentException("write request ends early")
+                chunks.append((addr, payload[offset:offset+length]))
+                offset += length
+            debug_interface.write_many(chunks=chunks)
+            return b""
+
+        elif op == OP_PATCH:
+            mode: str = _MODES[payload[0]]
+            names: List[str] = [name for name in payload[1:].decode("utf-8").split(",") if name]
+            plan: PatchPlan = target.plan
+            if names:
+                plan = compile_plan(debug_interface, target.version(debug_interface=debug_interface).get_patch_manifest(), names=names)
+            results: Dict[str, object]
+            if mode == MODE_VERIFY:
+                results = dict(plan.verify(debug_interface))
+            elif mode == MODE_REVERT:
+                results = dict(plan.revert(debug_interface))
+            else:
+                results = dict(plan.apply(debug_interface))
+            if mode == MODE_REVERT:
+                # Otherwise the guard would just put them back.
+                target.guard = None
+            elif mode == MODE_APPLY and target.guard is None:
+                self._guard(target, plan)
+            return json.dumps(results).encode("utf-8")
+
+        elif op == OP_REGIONS:
+            return b"".join(region.pack() for region in debug_interface.get_memory_regions())
+
+        else:
+            raise AgentException(f"unknown opcode {op:d}")
+
+    def status(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            "socket": self.socket_path,
+            "requests": self.requests,
+            "attaches": self.attaches,
+            "clients": len(self._clients),
+            "attached": self._target is not None,
+        }
+        if self._target is not None:
+            debug_interface: DebugInterface = self._target.debug_interface
+            result.update({
+                "version": self._target.version.__name__,
+                "pid": getattr(debug_interface, "pid", None),
+                "executable": debug_interface.get_executable_path(),
+                "relocation": debug_interface.from_relative_addr(0),
+                "attached_for": time.time() - self._target.attached_at,
+                "patches": self._target.plan.verify(debug_interface),
+            })
+            if self._target.guard is not None:
+                result["guard"] = repr(self._target.guard.stats)
+                result["drifts"] = [
+                    {"patch": event.name, "addr": event.addr, "outcome": event.outcome}
+                    for event in self._target.guard.events]
+        elif self._last_attach_error is not None:
+            result["error"] = self._last_attach_error
+        return result
+
+
+class AgentClient(BaseDebugInterface):
+    """Talks to a running agent.
+
+    This is a DebugInterface in its own right,
+    so anything that works on an attached Talos works through the agent too.
+    Safe to share between threads, though requests go one at a time.
+    """
+    __slots__ = (
+        "socket_path",
+        "_sock",
+        "_lock",
+        "_next_request",
+        "_relocation",
+    )
+
+    def __init__(self, socket_path: Optional[str]=None) -> None:
+        self.socket_path: str = socket_path if socket_path is not None else default_socket_path()
+        self._lock = threading.Lock()
+        self._next_request: int = 0
+        self._relocation: Optional[int] = None
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(self.socket_path)
+        except OSError as e:
+            self._sock.close()
+            raise AgentException(f"could not reach an agent on {self.socket_path!r}: {e}") from e
+
+    def close(self) -> None:
+        self._sock.close()
+
+    def _call(self, op: int, payload: bytes=b"") -> bytes:
+        with self._lock:
+            request: int = self._next_request
+            self._next_request = (self._next_request + 1) & 0xFFFFFFFF
+            try:
+                self._sock.sendall(_HEADER.pack(len(payload), request, op) + payload)
+                length, reply_request, status, = _HEADER.unpack(_recv_exactly(self._sock, _HEADER.size))
+                reply: bytes = _recv_exactly(self._sock, length)
+            except OSError as e:
+                raise AgentException(f"lost the agent: {e}") from e
+        if reply_request != request:
+            raise AgentException(f"got the reply to request {reply_request:d} instead of {request:d}")
+        if status != STATUS_OK:
+            raise AgentException(reply.decode("utf-8", "replace"))
+        return reply
+
+    def status(self) -> Dict[str, Any]:
+        """Asks the agent how it's doing. This also picks up where Talos is loaded, if it's moved."""
+        result: Dict[str, Any] = json.loads(self._call(OP_STATUS))
+        if "relocation" in result:
+            self._relocation = int(result["relocation"])
+        return result
+
+    def patch(self, mode: str=MODE_APPLY, names: Sequence[str]=()) -> Dict[str, object]:
+        """Applies, reverts or verifies patches in the agent's Talos. Defaults to every patch."""
+        return json.loads(self._call(OP_PATCH, bytes([_MODES.index(mode)]) + ",".join(names).encode("utf-8")))
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory from the attached process."""
+        data: Optional[bytes] = self.read_many(ranges=[(addr, length)])[0]
+        if data is None:
+            raise AgentException(f"could not read {length:d} bytes at 0x{addr:x}")
+        return data
+
+    def read_many(self, *, ranges: Sequence[Tuple[int, int]], max_gap: Optional[int]=None) -> List[Optional[bytes]]:
+        """Read several (address, length) ranges from the attached process in one go.
+
+        It's all one request. The agent does its own merging, so max_gap is ignored.
+        """
+        reply: bytes = self._call(OP_READ, b"".join(_RANGE.pack(addr, length) for addr, length in ranges))
+        result: List[Optional[bytes]] = []
+        offset: int = 0
+        for _ in ranges:
+            length, = _LENGTH.unpack_from(reply, offset)
+            offset += _LENGTH.size
+            if length < 0:
+                result.append(None)
+            else:
+                result.append(reply[offset:offset+length])
+                offset += length
+        return result
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Write memory to the attached process."""
+        self.write_many(chunks=[(addr, data)])
+
+    def write_many(self, *, chunks: Sequence[Tuple[int, bytes]], max_gap: Optional[int]=None) -> None:
+        """Write several (address, data) chunks to the attached process in one go."""
+        self._call(OP_WRITE, b"".join(_RANGE.pack(addr, len(data)) + bytes(data) for addr, data in chunks))
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        if self._relocation is None:
+            self.status()
+        return addr + (self._relocation or 0)
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        return MemoryRegion.unpack_all(self._call(OP_REGIONS))
+
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        return self.status().get("executable")
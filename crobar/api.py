@@ -1,6 +1,20 @@
 from abc import ABCMeta
 from abc import abstractmethod
+import logging
+import mmap
+import struct
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
 from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from crobar.patchplan import PatchSpec
 
 
 class HackingOpException(Exception):
@@ -8,7 +22,85 @@ class HackingOpException(Exception):
     __slots__ = ()
 
 
+class PatchSite(NamedTuple):
+    """One place to patch: the bytes we expect to find there, and what to replace them with."""
+    addr: int
+    old: bytes
+    new: bytes
+
+
+class MemoryRegion(NamedTuple):
+    """One contiguous mapping in the attached process."""
+    start: int
+    end: int
+    readable: bool
+    writable: bool
+    executable: bool
+    # What's mapped there, if it's a file and we know what it is
+    path: Optional[str] = None
+    # Offset of start within that file
+    offset: int = 0
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+    def pack(self) -> bytes:
+        """Packs this region into bytes, for sending or saving somewhere."""
+        path: bytes = (self.path or "").encode("utf-8", "surrogateescape")
+        flags: int = (
+            (_REGION_READABLE if self.readable else 0)
+            | (_REGION_WRITABLE if self.writable else 0)
+            | (_REGION_EXECUTABLE if self.executable else 0))
+        return _REGION.pack(self.start, self.end, flags, self.offset, len(path)) + path
+
+    @classmethod
+    def unpack_from(cls, data: bytes, offset: int=0) -> Tuple["MemoryRegion", int]:
+        """Undoes pack(). Returns the region, and the offset just past it."""
+        start, end, flags, file_offset, path_length, = _REGION.unpack_from(data, offset)
+        offset += _REGION.size
+        path: str = data[offset:offset+path_length].decode("utf-8", "surrogateescape")
+        return cls(
+            start=start,
+            end=end,
+            readable=bool(flags & _REGION_READABLE),
+            writable=bool(flags & _REGION_WRITABLE),
+            executable=bool(flags & _REGION_EXECUTABLE),
+            path=(path or None),
+            offset=file_offset), offset + path_length
+
+    @classmethod
+    def unpack_all(cls, data: bytes) -> List["MemoryRegion"]:
+        """Unpacks a run of packed regions."""
+        result: List[MemoryRegion] = []
+        offset: int = 0
+        while offset < len(data):
+            region, offset, = cls.unpack_from(data, offset)
+            result.append(region)
+        return result
+
+
+# start, end, flags, file offset, path length, then the path
+_REGION = struct.Struct("<QQBQH")
+_REGION_READABLE = 0x1
+_REGION_WRITABLE = 0x2
+_REGION_EXECUTABLE = 0x4
+
+
+# Anything read_into() can fill
+WritableBuffer = Union[bytearray, memoryview, mmap.mmap]
+
+# Anything write_from() can take
+ReadableBuffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
 class DebugInterface(metaclass=ABCMeta):
+    """Access to the memory of an attached process.
+
+    All addresses given to the read and write methods are absolute.
+    Addresses taken from a disassembly of the executable are relative,
+    so run those through from_relative_addr() first.
+    """
     __slots__ = ()
 
     @abstractmethod
@@ -21,11 +113,68 @@ class DebugInterface(metaclass=ABCMeta):
         """Write memory to the attached process."""
         raise NotImplementedError()
 
+    def read_into(self, *, addr: int, buffer: WritableBuffer) -> None:
+        """Fills a buffer with memory from the attached process, starting at addr.
+
+        Backends which can read straight into the buffer do.
+        Everything else copies in whatever read_memory() gives back.
+        """
+        view = memoryview(buffer).cast("B")
+        view[:] = self.read_memory(addr=addr, length=len(view))
+
+    def try_read_into(self, *, addr: int, buffer: WritableBuffer) -> bool:
+        """Like read_into(), but safe to call from any thread, even several at once.
+
+        Returns False if it couldn't, whether because it went wrong or because the only ways
+        of reading left aren't safe from here, in which case read_into() on the thread that
+        attached will either manage or say why. Backends which can't read from other threads
+        at all always return False.
+        """
+        return False
+
+    def write_from(self, *, addr: int, data: ReadableBuffer) -> None:
+        """Writes any bytes-like object to the attached process, without copying it if the backend can manage."""
+        self.write_memory(addr=addr, data=(data if isinstance(data, bytes) else bytes(data)))
+
+    @abstractmethod
+    def read_many(self, *, ranges: Sequence[Tuple[int, int]], max_gap: Optional[int]=None) -> List[Optional[bytes]]:
+        """Read several (address, length) ranges from the attached process in one go.
+
+        Ranges at most max_gap bytes apart may be merged into one transfer.
+        Returns the data for each range in the order given,
+        or None for any range that couldn't be read.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def write_many(self, *, chunks: Sequence[Tuple[int, bytes]], max_gap: Optional[int]=None) -> None:
+        """Write several (address, data) chunks to the attached process in one go.
+
+        Chunks at most max_gap bytes apart may be merged into one transfer.
+        Where chunks overlap, the later one wins.
+        """
+        raise NotImplementedError()
+
     @abstractmethod
     def from_relative_addr(self, addr: int) -> int:
         """Converts a relative-to-intended-memory-base address to an absolute address."""
         raise NotImplementedError()
 
+    @abstractmethod
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def close(self) -> None:
+        """Lets go of the attached process. Safe to call more than once."""
+        raise NotImplementedError()
+
 
 class TalosVersion(metaclass=ABCMeta):
     __slots__ = ()
@@ -41,8 +190,8 @@ class TalosVersion(metaclass=ABCMeta):
         raise NotImplementedError()
 
     @abstractmethod
-    def patch_memory(self, *, addr: int, old: bytes, new: bytes) -> bool:
-        """Attempts to apply a patch at the given address."""
+    def get_patch_manifest(self) -> Sequence["PatchSpec"]:
+        """Returns every patch this version knows about, described as data."""
         raise NotImplementedError()
 
     #
@@ -55,6 +204,7 @@ class TalosVersion(metaclass=ABCMeta):
 
         Patch-hunting advice:
         Search for gam_esgaStartAs, set a write watchpoint on it, then start a game.
+        (On Linux, `crobar --watchpoint ADDR` will do, and prints where each write came from.)
         That instruction needs to be nopped.
 
         Alternatively, search for "Content/Talos/Levels/Demo.wld",
@@ -94,7 +244,7 @@ class TalosVersion(metaclass=ABCMeta):
         Then NOP out the final crashing call.
         """
         #raise NotImplementedError()
-        print("Unimplmented, not required")
+        logger.debug("Unimplmented, not required")
         return False
 
     @abstractmethod
@@ -1,8 +1,28 @@
+"""Whichever debugging backend suits the platform we're running on.
+
+The backend only gets imported the first time ConcreteDebugInterface or find_talos_pids is used,
+so things which never touch a running game (patching files, replaying logs) don't pay for it,
+and still work on platforms without one.
+"""
+import importlib
 import sys
+from typing import Any
+
+_BACKENDS = {
+    "linux": ("linux", "LinuxDebugInterface"),
+    "win32": ("windows", "WindowsDebugInterface"),
+}
+
 
-if sys.platform.startswith("linux"):
-    from .linux import LinuxDebugInterface as ConcreteDebugInterface
-elif sys.platform.startswith("win32"):
-    from .windows import WindowsDebugInterface as ConcreteDebugInterface
-else:
-    raise NotImplementedError(f"Operating system platform {sys.platform!r} not supported yet")
+def __getattr__(name: str) -> Any:
+    if name not in ("ConcreteDebugInterface", "find_talos_pids"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    for prefix, (module_name, class_name) in _BACKENDS.items():
+        if sys.platform.startswith(prefix):
+            break
+    else:
+        raise NotImplementedError(f"Operating system platform {sys.platform!r} not supported yet")
+    module: Any = importlib.import_module(f"{__name__}.{module_name}")
+    value: Any = getattr(module, class_name if name == "ConcreteDebugInterface" else name)
+    globals()[name] = value
+    return value
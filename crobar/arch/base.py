@@ -1,9 +1,150 @@
 """Base classes for platform-independent debugging and hacking."""
 from abc import ABCMeta
 from abc import abstractmethod
+from ctypes import addressof
+from ctypes import c_char
+from ctypes import c_char_p
+from ctypes import c_void_p
+from ctypes import cast
+from ctypes import create_string_buffer
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
 
 from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import ReadableBuffer
+from crobar.ranges import CoalescedRange
+from crobar.ranges import coalesce_ranges
+from crobar.ranges import coalesce_writes
+from crobar.ranges import find_gaps
+from crobar.ranges import scatter_coalesced
+
+
+class LazyLibrary:
+    """A shared library which only gets loaded the first time anything in it gets used.
+
+    Each function gets looked up once, and then lives on this object like any other attribute.
+    That needs a __dict__, so no __slots__ here.
+    """
+
+    def __init__(self, load: Callable[[], Any]) -> None:
+        self._load = load
+        self._library: Any = None
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if self._library is None:
+            self._library = self._load()
+        value: Any = getattr(self._library, name)
+        setattr(self, name, value)
+        return value
+
+
+def buffer_address(data: ReadableBuffer) -> Tuple[int, Any]:
+    """Returns where a buffer's bytes live, for handing to C, and something to hold on to until C's done with them.
+
+    bytes and anything writable get used where they are. Other read-only buffers get copied.
+    """
+    if isinstance(data, bytes):
+        pointer = c_char_p(data)
+        return cast(pointer, c_void_p).value or 0, pointer
+    view = memoryview(data)
+    if not view.readonly:
+        array = (c_char * view.nbytes).from_buffer(view)
+        return addressof(array), array
+    copy = create_string_buffer(view.tobytes(), view.nbytes)
+    return addressof(copy), copy
 
 
 class BaseDebugInterface(DebugInterface, metaclass=ABCMeta):
     __slots__ = ()
+
+    # By default, ranges at most this many bytes apart get read as a single range.
+    read_coalesce_gap: int = 0x100
+
+    # Same for writes, except that the gaps have to be read in first.
+    # This races against the game if it's writing to the gaps, so it's off by default.
+    write_coalesce_gap: int = 0
+
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        return None
+
+    def close(self) -> None:
+        """Lets go of the attached process. Safe to call more than once."""
+        pass
+
+    def read_many(self, *, ranges: Sequence[Tuple[int, int]], max_gap: Optional[int]=None) -> List[Optional[bytes]]:
+        """Read several (address, length) ranges from the attached process in one go.
+
+        Ranges at most max_gap bytes apart may be merged into one transfer.
+        Returns the data for each range in the order given,
+        or None for any range that couldn't be read.
+        """
+        plan: List[CoalescedRange] = coalesce_ranges(
+            ranges,
+            max_gap=(self.read_coalesce_gap if max_gap is None else max_gap))
+        result: List[Optional[bytes]] = [None] * len(ranges)
+        self._read_plan(ranges, plan, result)
+        return result
+
+    def _read_plan(self, ranges: Sequence[Tuple[int, int]], plan: Sequence[CoalescedRange], result: List[Optional[bytes]]) -> None:
+        """Reads every merged range in a plan into result.
+
+        Backends override this to batch it further.
+        """
+        for merged in plan:
+            self._read_merged(ranges, merged, result)
+
+    def _read_merged(self, ranges: Sequence[Tuple[int, int]], merged: CoalescedRange, result: List[Optional[bytes]]) -> None:
+        """Reads one merged range into result, falling back to its members if it fails.
+
+        If a merged range fails, usually we've glued something onto an unmapped page.
+        """
+        try:
+            data: bytes = self.read_memory(addr=merged.addr, length=merged.length)
+        except HackingOpException:
+            for idx in merged.members:
+                addr, length, = ranges[idx]
+                try:
+                    result[idx] = self.read_memory(addr=addr, length=length)
+                except HackingOpException:
+                    result[idx] = None
+        else:
+            scatter_coalesced(ranges, merged, data, result)
+
+    def write_many(self, *, chunks: Sequence[Tuple[int, bytes]], max_gap: Optional[int]=None) -> None:
+        """Write several (address, data) chunks to the attached process in one go.
+
+        Chunks at most max_gap bytes apart may be merged into one transfer.
+        Where chunks overlap, the later one wins.
+        """
+        plan, merged_data, = coalesce_writes(
+            chunks,
+            max_gap=(self.write_coalesce_gap if max_gap is None else max_gap))
+
+        # Fill in any gaps we glued over with what's already there.
+        gaps: List[Tuple[int, int]] = []
+        gap_owners: List[int] = []
+        for plan_idx, merged in enumerate(plan):
+            for gap in find_gaps(merged, chunks):
+                gaps.append(gap)
+                gap_owners.append(plan_idx)
+        if gaps:
+            for (gap_addr, gap_length), plan_idx, gap_data in zip(gaps, gap_owners, self.read_many(ranges=gaps)):
+                if gap_data is None:
+                    raise HackingOpException(f"could not read {gap_length:d} bytes at 0x{gap_addr:x} to fill a write gap")
+                offs: int = gap_addr - plan[plan_idx].addr
+                merged_data[plan_idx][offs:offs+gap_length] = gap_data
+
+        self._write_plan(plan, [bytes(data) for data in merged_data])
+
+    def _write_plan(self, plan: Sequence[CoalescedRange], data: Sequence[bytes]) -> None:
+        """Writes every merged range in a plan. Backends override this to batch it further."""
+        for merged, merged_data in zip(plan, data):
+            self.write_memory(addr=merged.addr, data=merged_data)
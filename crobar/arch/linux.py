@@ -1,128 +1,443 @@
 """Linux-specific debugging/hacking interface."""
-from ctypes import CDLL
-from ctypes import c_uint32
-from ctypes import c_uint64
-from glob import glob
-import struct
-from typing import Any
+import logging
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
 from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Type
+from typing import TypeVar
 from typing import cast
 
 from .base import BaseDebugInterface
+from .linux_debugreg import HardwareWatchpoints
+from .linux_discovery import ProcessHandle
+from .linux_discovery import ProcessInfo
+from .linux_discovery import TalosWatcher
+from .linux_discovery import find_talos_processes
+from .linux_discovery import read_process_info
+from .linux_freeze import FreezeStats
+from .linux_freeze import ThreadFreezer
+from .linux_maps import RegionIndex
+from .linux_transfer import DEFAULT_TRANSFER_TYPES
+from .linux_transfer import MemoryTransfer
+from .linux_transfer import TransferException
+from .linux_transfer import TransferStats
 from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import ReadableBuffer
+from crobar.api import WritableBuffer
+from crobar.binfmt import ElfImage
+from crobar.ranges import CoalescedRange
+from crobar.ranges import scatter_coalesced
+from crobar.watch import Watchpoint
+from crobar.watch import WatchpointHit
 
-PTRACE_PEEKTEXT = 1
-PTRACE_PEEKDATA = 2
-PTRACE_POKETEXT = 4
-PTRACE_POKEDATA = 5
-PTRACE_CONT = 7
-PTRACE_ATTACH = 16
-PTRACE_DETACH = 17
-PTRACE_INTERRUPT = 0x4207
+logger = logging.getLogger(__name__)
 
-_libc = CDLL("libc.so.6")
+T = TypeVar("T")
 
+PAGE_SIZE: int = 0x1000
 
-class PtraceException(HackingOpException):
-    """Generic exception fires whenever ptrace() fails."""
-    __slots__ = ()
+
+def find_talos_pids() -> List[int]:
+    """Returns the PID of every running Talos process, oldest first."""
+    return [info.pid for info in find_talos_processes()]
 
 
 class LinuxDebugInterface(BaseDebugInterface):
     __slots__ = (
         "_pid",
+        "_process",
+        "_freezer",
+        "_stop_for_session",
+        "_closed",
+        "_transfers",
+        "_transfer_stats",
+        "_readonly_pages",
+        "_regions",
+        "_relocate",
+        "_relocation",
     )
 
-    def __init__(self) -> None:
-        self._find_talos()
+    def __init__(
+            self,
+            *,
+            pid: Optional[int]=None,
+            wait: bool=False,
+            relocate: bool=True,
+            stop_for_session: bool=False,
+            transfer_types: Sequence[Type[MemoryTransfer]]=DEFAULT_TRANSFER_TYPES) -> None:
+        """Finds Talos and gets ready to hack it.
+
+        Talos only gets stopped while we're writing to it,
+        unless stop_for_session is set, in which case it stays stopped until we're done with it.
+        """
+        self._find_talos(pid=pid, wait=wait)
+        self._stop_for_session = stop_for_session
         self._attach_to_talos()
+        self._transfers: List[MemoryTransfer] = [
+            transfer_type(pid=self._pid)
+            for transfer_type in transfer_types
+        ]
+        # Kept separately, so that transfers we've given up on still get counted
+        self._transfer_stats: Dict[str, TransferStats] = {
+            transfer.name: transfer.stats
+            for transfer in self._transfers
+        }
+        # Pages we've seen process_vm_writev() bounce off despite the map saying otherwise
+        self._readonly_pages: Set[int] = set()
+        self._regions: RegionIndex = RegionIndex(pid=self._pid)
+        self._relocate = relocate
+        self._relocation: Optional[int] = None
 
     def __del__(self) -> None:
-        print(f"Deleting {self!r}")
-        result_cont: int = self._ptrace(cmd=PTRACE_CONT)
-        print(f"Continued: {result_cont}")
-        result_detach: int = self._ptrace(cmd=PTRACE_DETACH)
-        print(f"Detached: {result_cont}")
-
-    def _find_talos(self) -> None:
-        """Attempt to find Talos in the process list."""
-        for cmdline_name in glob("/proc/*/comm"):
-            pid_str: str = cmdline_name.partition("/proc/")[-1].partition("/")[0]
-            if pid_str.isdigit():
-                procname: str = open(cmdline_name, "r").read().rstrip()
-                pid: int = int(pid_str)
-                if procname.startswith("Talos"):
-                    print(f"{pid}: {procname!r}")
-                    self._pid: int = pid
-                    return
+        if not hasattr(self, "_pid") or getattr(self, "_closed", False):
+            # Never found anything to attach to, or already let go of it.
+            return
+        logger.debug("Deleting %r", self)
+        self.close()
+        logger.debug("Detached")
+
+    def close(self) -> None:
+        """Lets go of Talos. Safe to call more than once.
+
+        If Talos is frozen, this has to happen on the thread that froze it.
+        """
+        for transfer in getattr(self, "_transfers", ()):
+            transfer.close()
+        if hasattr(self, "_freezer"):
+            self._freezer.close()
+        if hasattr(self, "_process"):
+            self._process.close()
+        self._closed: bool = True
+
+    @property
+    def transfer_stats(self) -> Dict[str, TransferStats]:
+        """How much work each transfer backend has done, by name."""
+        return self._transfer_stats
+
+    def _find_talos(self, *, pid: Optional[int]=None, wait: bool=False) -> None:
+        """Attempt to find Talos in the process list.
+
+        If wait is set and Talos isn't running yet, wait for it to start.
+        """
+        info: Optional[ProcessInfo]
+        if pid is not None:
+            info = read_process_info(pid)
+            if info is None:
+                raise HackingOpException(f"Could not find PID {pid:d} in the process list")
         else:
-            raise HackingOpException(f"Could not find Talos in the process list")
-                    
+            scan_start: float = time.perf_counter()
+            candidates: List[ProcessInfo] = find_talos_processes()
+            logger.debug("Scanned the process list in %.3f ms", (time.perf_counter()-scan_start)*1000.0)
+            if candidates:
+                info = candidates[0]
+                if len(candidates) >= 2:
+                    logger.warning("Found %d Talos processes, picking the oldest one; use a PID to pick another", len(candidates))
+            elif wait:
+                logger.info("Waiting for Talos to start")
+                watcher = TalosWatcher()
+                info = watcher.wait_for_new()
+                logger.info("Spotted Talos %.0f ms after it started (%r)", info.age()*1000.0, watcher.stats)
+            else:
+                raise HackingOpException(f"Could not find Talos in the process list")
+
+        logger.info("%d: %r", info.pid, info.comm)
+        self._pid: int = info.pid
+        self._process: ProcessHandle = ProcessHandle(info)
+
     def _attach_to_talos(self) -> None:
-        """Attempt to attach to Talos."""
-        result: int = self._ptrace(cmd=PTRACE_ATTACH)
-        if result == -1:
-            raise PtraceException(f"PTRACE_ATTACH failed")
-
-        pid_result: int = _libc.waitpid(self._pid, None, 0)
-        if pid_result == -1:
-            raise PtraceException(f"waitpid for PTRACE_ATTACH failed")
-
-    def _ptrace(self, *, cmd: int, addr: Optional[Any]=None, data: Optional[Any]=None) -> int:
-        """Interface to ptrace."""
-        return cast(int, _libc.ptrace(cmd, self._pid, addr, data))
-
-    def _read_word(self, *, addr: int) -> int:
-        """Read a word from the attached process."""
-        # Python assumes the return value is 32 bits wide.
-        # TODO: Somehow get a 64-bit result out of the thing
-        result: int = self._ptrace(cmd=PTRACE_PEEKDATA, addr=c_uint64(addr))
-        #print(hex(result))
-        # FIXME: it's hard to tell if an error has happened here
-        #if result == -1: raise PtraceException(f"PTRACE_PEEKDATA failed for {hex(addr)}")
-        return result
-
-    def _write_word(self, *, addr: int, data: int) -> None:
-        """Read a word from the attached process."""
-        result: int = self._ptrace(cmd=PTRACE_POKEDATA, addr=c_uint64(addr), data=c_uint64(data))
-        #print(result)
-        if result == -1:
-            raise PtraceException(f"PTRACE_POKEDATA failed")
+        """Attempt to attach to Talos.
+
+        This freezes it once, to make sure we're allowed to.
+        Unless we're stopping it for the whole session, it gets let go again straight away.
+        """
+        self._freezer: ThreadFreezer = ThreadFreezer(pid=self._pid)
+        self._freezer.freeze()
+        if not self._stop_for_session:
+            self._freezer.thaw()
+
+        # Make sure the PID didn't get recycled between finding it and attaching to it.
+        if not self._process.is_alive():
+            raise HackingOpException(f"Talos (PID {self._pid:d}) exited before we could attach")
+
+    @property
+    def pid(self) -> int:
+        return self._pid
+
+    def is_alive(self) -> bool:
+        """Returns False once Talos has exited."""
+        return self._process.is_alive()
+
+    @property
+    def freeze_stats(self) -> FreezeStats:
+        """How often and for how long Talos has been stopped."""
+        return self._freezer.stats
+
+    def _drop_transfer(self, transfer: MemoryTransfer, exc: TransferException) -> None:
+        """Stops using a transfer backend that can never work for this process."""
+        logger.warning("Disabling %s transfers: %s", transfer.name, exc)
+        transfer.close()
+        self._transfers.remove(transfer)
 
     def read_memory(self, *, addr: int, length: int) -> bytes:
         """Read memory from the attached process."""
-        result: bytes = b""
+        if length <= 0:
+            return b""
+        return self._read(addr=addr, length=length, read=lambda transfer: transfer.read(addr=addr, length=length))
+
+    def read_into(self, *, addr: int, buffer: WritableBuffer) -> None:
+        """Fills a buffer with memory from the attached process, starting at addr, without any copies on the way."""
+        view = memoryview(buffer).cast("B")
+        if len(view) == 0:
+            return
+        self._read(addr=addr, length=len(view), read=lambda transfer: transfer.read_into(addr=addr, buffer=view))
+
+    def try_read_into(self, *, addr: int, buffer: WritableBuffer) -> bool:
+        """Like read_into(), but safe from any thread, even while other threads are reading.
 
-        for offs in range(0, length, 4):
-            v: int = self._read_word(addr=addr+offs)
-            #print(v)
-            result += struct.pack("<I", v&0xFFFFFFFF)
+        Only transfers which don't need Talos stopped get tried, since stopping it
+        (and ptrace() in general) only works from the thread that attached.
+        Returns False if none of them managed it, leaving read_into() to sort out why.
+        This never freezes anything or drops a transfer, and the region index has its own lock,
+        so the thread that attached can carry on as normal meanwhile.
+        """
+        view = memoryview(buffer).cast("B")
+        if len(view) == 0:
+            return True
+        if not self._regions.is_readable(addr=addr, length=len(view)):
+            return False
+        for transfer in list(self._transfers):
+            if transfer.needs_stop:
+                continue
+            try:
+                transfer.read_into(addr=addr, buffer=view)
+                return True
+            except HackingOpException:
+                continue
+        return False
 
-        return result[:length]
+    def _read(self, *, addr: int, length: int, read: Callable[[MemoryTransfer], T]) -> T:
+        """Tries each transfer in turn until one of them manages to read."""
+        if not self._regions.is_readable(addr=addr, length=length):
+            raise HackingOpException(f"could not read {length:d} bytes at 0x{addr:x}: not mapped readable")
+
+        errors: List[str] = []
+        for transfer in list(self._transfers):
+            if transfer.needs_stop:
+                self._freezer.freeze()
+            try:
+                return read(transfer)
+            except HackingOpException as e:
+                errors.append(str(e))
+                if isinstance(e, TransferException) and e.fatal:
+                    self._drop_transfer(transfer, e)
+            finally:
+                if transfer.needs_stop:
+                    self._freezer.thaw()
+
+        raise HackingOpException(f"could not read {length:d} bytes at 0x{addr:x}: {'; '.join(errors)}")
 
     def write_memory(self, *, addr: int, data: bytes) -> None:
         """Write memory to the attached process."""
+        self.write_from(addr=addr, data=data)
+
+    def write_from(self, *, addr: int, data: ReadableBuffer) -> None:
+        """Writes any bytes-like object to the attached process, straight from where it is."""
+        length: int = memoryview(data).nbytes
+        if length == 0:
+            return
+
+        if self._regions.split(addr=addr, length=length) is None:
+            raise HackingOpException(f"could not write {length:d} bytes at 0x{addr:x}: not mapped")
+
+        pages: range = self._pages_of(addr=addr, length=length)
+        readonly: bool = self._is_readonly(addr=addr, length=length)
 
-        # Pad memory with extra bytes from the process
-        # if the length isn't a whole number of 64-bit words
-        padded_length: int = (len(data)+0x7)&~0x7
-        if padded_length > 0:
-            data += self.read_memory(
-                addr=addr+len(data),
-                length=padded_length-len(data))
+        errors: List[str] = []
+        self._freezer.freeze()
+        try:
+            for transfer in list(self._transfers):
+                if readonly and transfer.honours_protection:
+                    continue
+                try:
+                    transfer.write(addr=addr, data=data)
+                    return
+                except HackingOpException as e:
+                    errors.append(str(e))
+                    if isinstance(e, TransferException) and e.fatal:
+                        self._drop_transfer(transfer, e)
+                    elif transfer.honours_protection:
+                        # Probably the text section. Don't bother trying this one here again.
+                        self._readonly_pages.update(pages)
+        finally:
+            self._freezer.thaw()
+
+        raise HackingOpException(f"could not write {length:d} bytes at 0x{addr:x}: {'; '.join(errors)}")
+
+    def _pages_of(self, *, addr: int, length: int) -> range:
+        return range(addr // PAGE_SIZE, (addr + max(length, 1) - 1) // PAGE_SIZE + 1)
+
+    def _is_readonly(self, *, addr: int, length: int) -> bool:
+        """Returns True if process_vm_writev() won't be able to write here."""
+        return (
+            not self._regions.is_writable(addr=addr, length=length)
+            or any(page in self._readonly_pages for page in self._pages_of(addr=addr, length=length)))
+
+    def _read_plan(self, ranges: Sequence[Tuple[int, int]], plan: Sequence[CoalescedRange], result: List[Optional[bytes]]) -> None:
+        """Reads a whole plan with one vectored transfer, then mops up whatever failed.
+
+        Merged ranges get split on region boundaries,
+        and anything that isn't mapped at all doesn't get sent to the kernel.
+        """
+        if not self._transfers:
+            super()._read_plan(ranges, plan, result)
+            return
+
+        # (plan index, addr, length) for every piece we're sending
+        pieces: List[Tuple[int, int, int]] = []
+        leftovers: Set[int] = set()
+        for plan_idx, merged in enumerate(plan):
+            merged_pieces = self._regions.split(addr=merged.addr, length=merged.length)
+            if merged_pieces is None or not all(region.readable for region, piece_addr, piece_length in merged_pieces):
+                leftovers.add(plan_idx)
+            else:
+                pieces += [(plan_idx, piece_addr, piece_length) for region, piece_addr, piece_length in merged_pieces]
+
+        transfer: MemoryTransfer = self._transfers[0]
+        if transfer.needs_stop:
+            self._freezer.freeze()
+        try:
+            data: List[Optional[bytes]] = transfer.read_vectored(
+                ranges=[(piece_addr, piece_length) for plan_idx, piece_addr, piece_length in pieces])
+        except TransferException as e:
+            if e.fatal:
+                self._drop_transfer(transfer, e)
+            data = [None] * len(pieces)
+        finally:
+            if transfer.needs_stop:
+                self._freezer.thaw()
+
+        merged_data: List[List[Optional[bytes]]] = [[] for merged in plan]
+        for (plan_idx, piece_addr, piece_length), piece_data in zip(pieces, data):
+            merged_data[plan_idx].append(piece_data)
+
+        for plan_idx, merged in enumerate(plan):
+            if plan_idx in leftovers:
+                continue
+            chunks: List[Optional[bytes]] = merged_data[plan_idx]
+            if any(chunk is None for chunk in chunks):
+                self._read_merged(ranges, merged, result)
+            else:
+                scatter_coalesced(ranges, merged, b"".join(cast(List[bytes], chunks)), result)
+
+        for plan_idx in sorted(leftovers):
+            self._read_merged(ranges, plan[plan_idx], result)
+
+    def _write_plan(self, plan: Sequence[CoalescedRange], data: Sequence[bytes]) -> None:
+        """Writes a whole plan with one vectored transfer, then mops up whatever failed."""
+        if not self._transfers:
+            super()._write_plan(plan, data)
+            return
 
-        assert len(data) % 8 == 0
+        # Everything gets written in one freeze, mopping up included.
+        self._freezer.freeze()
+        try:
+            self._write_plan_frozen(plan, data)
+        finally:
+            self._freezer.thaw()
 
-        for offs in range(0, len(data), 8):
-            v: int = struct.unpack("<Q", data[offs:offs+8])[0]
-            self._write_word(
-                addr=addr+offs,
-                data=v)
+    def _write_plan_frozen(self, plan: Sequence[CoalescedRange], data: Sequence[bytes]) -> None:
+        transfer: MemoryTransfer = self._transfers[0]
+        batch: List[int] = []
+        leftovers: List[int] = []
+        for idx, merged in enumerate(plan):
+            if transfer.honours_protection and self._is_readonly(addr=merged.addr, length=merged.length):
+                leftovers.append(idx)
+            else:
+                batch.append(idx)
+
+        if batch:
+            try:
+                written: List[bool] = transfer.write_vectored(
+                    chunks=[(plan[idx].addr, data[idx]) for idx in batch])
+            except TransferException as e:
+                if e.fatal:
+                    self._drop_transfer(transfer, e)
+                written = [False] * len(batch)
+            leftovers += [idx for idx, ok in zip(batch, written) if not ok]
+
+        for idx in sorted(leftovers):
+            self.write_memory(addr=plan[idx].addr, data=data[idx])
 
     def from_relative_addr(self, addr: int) -> int:
         """Converts a relative-to-intended-memory-base address to an absolute address."""
 
-        # The Linux version doesn't appear to use ASLR.
-        # If I'm wrong, parse f"/proc/{self._pid:d}/maps" and infer from there.
-        return addr
+        # The Linux version doesn't appear to use ASLR, being a non-PIE executable.
+        # But if it ever is one, work out where it got loaded.
+        if self._relocation is None:
+            self._relocation = self._find_relocation() if self._relocate else 0
+        return addr + self._relocation
+
+    def _find_relocation(self) -> int:
+        """Works out how far the executable was moved from where it was linked."""
+        try:
+            image: ElfImage = ElfImage.from_path(f"/proc/{self._pid:d}/exe")
+        except (OSError, HackingOpException) as e:
+            logger.warning("Could not inspect the executable, assuming it wasn't relocated: %s", e)
+            return 0
+
+        if not image.is_position_independent:
+            return 0
+
+        image_base: Optional[int] = self._regions.image_base()
+        if image_base is None:
+            logger.warning("Could not find where the executable was mapped, assuming it wasn't relocated")
+            return 0
+
+        return image_base - image.load_base
+
+    def watch_hardware(
+            self,
+            watchpoints: Sequence[Watchpoint],
+            callback: Callable[[WatchpointHit], None],
+            *,
+            timeout: Optional[float]=None,
+            stop: Optional[threading.Event]=None,
+            max_hits: Optional[int]=None) -> int:
+        """Sets up to four hardware watchpoints in every thread of Talos, and reports each hit to callback.
+
+        Keeps going until timeout, stop is set, max_hits is reached, or Talos goes away,
+        then clears them all again. Returns how many hits there were.
+        Talos stays traced throughout, so nothing can be written to it from inside the callback.
+        """
+        if self._freezer.is_frozen:
+            raise HackingOpException(f"can't set watchpoints while Talos is stopped")
+
+        def read_value(addr: int, length: int) -> Optional[bytes]:
+            try:
+                return self.read_memory(addr=addr, length=length)
+            except HackingOpException:
+                return None
+
+        session = HardwareWatchpoints(pid=self._pid, watchpoints=watchpoints, read_value=read_value)
+        session.start()
+        try:
+            return session.run(callback, timeout=timeout, stop=stop, max_hits=max_hits)
+        finally:
+            session.close()
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        self._regions.refresh()
+        return self._regions.regions
 
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        # This works even if the file's since been deleted or replaced.
+        return f"/proc/{self._pid:d}/exe"
@@ -0,0 +1,343 @@
+"""Hardware watchpoints on x86, through the debug registers.
+
+x86 has four debug address registers (DR0-DR3), each of which can watch 1, 2, 4 or 8 bytes
+for being executed, written, or accessed at all (there's no reads-only).
+DR7 says which ones are on and what they watch for, and DR6 says which one went off.
+They're per thread, and ptrace gets at them through PTRACE_POKEUSER into struct user.
+
+A session seizes every thread (and any thread made while it's going),
+programs the same watchpoints into all of them, and lets them run.
+Between hits, we're asleep waiting for the kernel to tell us something happened.
+
+When a watchpoint goes off, the thread stops with a SIGTRAP,
+and we report which watchpoint it was, which thread, where it was, and the value now.
+Writes and accesses are reported after the instruction that did them,
+so the instruction pointer is the one after it.
+Executes are reported before the instruction runs, with the instruction pointer on it.
+
+Everything here keeps the target traced, so nothing else can freeze it until the session's closed.
+"""
+import errno as errno_codes
+from ctypes import addressof
+from ctypes import c_ulong
+import os
+import signal
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+
+from crobar.api import HackingOpException
+from crobar.watch import WATCH_ACCESS
+from crobar.watch import WATCH_EXECUTE
+from crobar.watch import WATCH_WRITE
+from crobar.watch import Watchpoint
+from crobar.watch import WatchpointHit
+from .linux_freeze import list_threads
+from .linux_syscalls import PTRACE_CONT
+from .linux_syscalls import PTRACE_DETACH
+from .linux_syscalls import PTRACE_EVENT_CLONE
+from .linux_syscalls import PTRACE_EVENT_STOP
+from .linux_syscalls import PTRACE_GETEVENTMSG
+from .linux_syscalls import PTRACE_INTERRUPT
+from .linux_syscalls import PTRACE_O_TRACECLONE
+from .linux_syscalls import PTRACE_PEEKUSER
+from .linux_syscalls import PTRACE_POKEUSER
+from .linux_syscalls import PTRACE_SEIZE
+from .linux_syscalls import PtraceException
+from .linux_syscalls import WALL
+from .linux_syscalls import WORD_SIZE
+from .linux_syscalls import errno
+from .linux_syscalls import ptrace
+from .linux_syscalls import waitpid
+
+MAX_WATCHPOINTS: int = 4
+
+# DR7 R/W bits for each kind
+_RW_BITS: Dict[str, int] = {
+    WATCH_EXECUTE: 0b00,
+    WATCH_WRITE: 0b01,
+    WATCH_ACCESS: 0b11,
+}
+
+# DR7 LEN bits for each length
+_LEN_BITS: Dict[int, int] = {
+    1: 0b00,
+    2: 0b01,
+    4: 0b11,
+    8: 0b10,
+}
+
+# Resume flag, which stops an execute watchpoint going off again straight away
+_EFLAGS_RF: int = 1 << 16
+
+# Offsets into the tracer's struct user, which is what PEEKUSER and POKEUSER index.
+# (The tracer's, not the target's, so a 32-bit Talos still gets the 64-bit layout.)
+if WORD_SIZE == 8:
+    _USER_IP: int = 16 * 8
+    _USER_FLAGS: int = 18 * 8
+    _USER_DEBUGREG: int = 848
+else:
+    _USER_IP = 12 * 4
+    _USER_FLAGS = 14 * 4
+    _USER_DEBUGREG = 63 * 4
+
+# How long to sleep at a time, so that stop and timeout get noticed
+_WAKE_INTERVAL: float = 0.25
+
+
+def check_watchpoint(watchpoint: Watchpoint) -> None:
+    """Throws a HackingOpException if the hardware can't do this watchpoint."""
+    if watchpoint.kind not in _RW_BITS:
+        raise HackingOpException(f"can't watch for {watchpoint.kind!r}, only {', '.join(_RW_BITS)}")
+    if watchpoint.kind == WATCH_EXECUTE and watchpoint.length != 1:
+        raise HackingOpException(f"execute watchpoints have to be 1 byte long")
+    if watchpoint.length not in _LEN_BITS:
+        raise HackingOpException(f"watchpoints can only be 1, 2, 4 or 8 bytes long, not {watchpoint.length:d}")
+    if watchpoint.addr % watchpoint.length != 0:
+        raise HackingOpException(f"a {watchpoint.length:d} byte watchpoint has to be aligned to {watchpoint.length:d} bytes, 0x{watchpoint.addr:x} isn't")
+
+
+def dr7_for(watchpoints: Sequence[Watchpoint]) -> int:
+    """Works out DR7 for watchpoints in DR0 onwards."""
+    dr7: int = 0
+    for slot, watchpoint, in enumerate(watchpoints):
+        dr7 |= 1 << (slot * 2)
+        dr7 |= _RW_BITS[watchpoint.kind] << (16 + slot*4)
+        dr7 |= _LEN_BITS[watchpoint.length] << (18 + slot*4)
+    return dr7
+
+
+def _poke_user(tid: int, offset: int, value: int) -> None:
+    if ptrace(cmd=PTRACE_POKEUSER, pid=tid, addr=offset, data=value) == -1:
+        raise PtraceException(f"PTRACE_POKEUSER at {offset:d} failed for thread {tid:d}: {os.strerror(errno())}")
+
+
+def _peek_user(tid: int, offset: int) -> int:
+    value: int = ptrace(cmd=PTRACE_PEEKUSER, pid=tid, addr=offset, data=0)
+    if value == -1 and errno() != 0:
+        raise PtraceException(f"PTRACE_PEEKUSER at {offset:d} failed for thread {tid:d}: {os.strerror(errno())}")
+    return value & ((1 << (WORD_SIZE * 8)) - 1)
+
+
+class HardwareWatchpoints:
+    """One session of hardware watchpoints on every thread of a process.
+
+    Everything has to happen on the thread that called start().
+    """
+    __slots__ = (
+        "watchpoints",
+        "hits",
+        "_pid",
+        "_dr7",
+        "_read_value",
+        # Threads we're tracing -> whether they're running (False means stopped and waiting on us)
+        "_threads",
+        # Threads which have had the debug registers set up
+        "_programmed",
+    )
+
+    def __init__(
+            self,
+            *,
+            pid: int,
+            watchpoints: Sequence[Watchpoint],
+            read_value: Callable[[int, int], Optional[bytes]]) -> None:
+        if not watchpoints:
+            raise HackingOpException(f"nothing to watch")
+        if len(watchpoints) > MAX_WATCHPOINTS:
+            raise HackingOpException(f"can only have {MAX_WATCHPOINTS:d} hardware watchpoints, not {len(watchpoints):d}")
+        for watchpoint in watchpoints:
+            check_watchpoint(watchpoint)
+        self.watchpoints: Sequence[Watchpoint] = list(watchpoints)
+        self.hits: int = 0
+        self._pid = pid
+        self._dr7: int = dr7_for(self.watchpoints)
+        self._read_value = read_value
+        self._threads: Dict[int, bool] = {}
+        self._programmed: Set[int] = set()
+
+    def start(self) -> None:
+        """Seizes every thread and sets the watchpoints in each of them."""
+        try:
+            while True:
+                # Threads made from here on get seized for us, but ones made while we're going round need catching.
+                new_tids: List[int] = sorted(list_threads(self._pid) - set(self._threads))
+                if not new_tids:
+                    break
+                for tid in new_tids:
+                    if ptrace(cmd=PTRACE_SEIZE, pid=tid, addr=0, data=PTRACE_O_TRACECLONE) == -1:
+                        err: int = errno()
+                        if err == errno_codes.ESRCH:
+                            continue
+                        raise PtraceException(f"PTRACE_SEIZE failed for thread {tid:d}: {os.strerror(err)}")
+                    self._threads[tid] = True
+                    ptrace(cmd=PTRACE_INTERRUPT, pid=tid, addr=0, data=0)
+                for tid in new_tids:
+                    if tid in self._threads:
+                        self._wait_until_stopped(tid)
+                for tid, running, in list(self._threads.items()):
+                    if not running:
+                        if tid not in self._programmed:
+                            self._program(tid)
+                        self._resume(tid)
+        except BaseException:
+            self.close()
+            raise
+        if not self._threads:
+            raise HackingOpException(f"PID {self._pid:d} has no threads to watch")
+
+    def _program(self, tid: int) -> None:
+        for slot, watchpoint, in enumerate(self.watchpoints):
+            _poke_user(tid, _USER_DEBUGREG + slot*WORD_SIZE, watchpoint.addr)
+        _poke_user(tid, _USER_DEBUGREG + 6*WORD_SIZE, 0)
+        _poke_user(tid, _USER_DEBUGREG + 7*WORD_SIZE, self._dr7)
+        self._programmed.add(tid)
+
+    def _resume(self, tid: int, signum: int=0) -> None:
+        if ptrace(cmd=PTRACE_CONT, pid=tid, addr=0, data=signum) == -1 and errno() != errno_codes.ESRCH:
+            raise PtraceException(f"PTRACE_CONT failed for thread {tid:d}: {os.strerror(errno())}")
+        self._threads[tid] = True
+
+    def _wait_until_stopped(self, tid: int) -> None:
+        """Blocks until a thread we've interrupted stops, dealing with anything else it does on the way."""
+        while self._threads.get(tid, False):
+            result_pid, status, = waitpid(tid, WALL)
+            if result_pid == -1:
+                if errno() == errno_codes.EINTR:
+                    continue
+                if errno() == errno_codes.ECHILD:
+                    del self._threads[tid]
+                    return
+                raise PtraceException(f"waitpid failed for thread {tid:d}: {os.strerror(errno())}")
+            self._handle(tid, status, None, stopping=True)
+
+    def _handle(
+            self,
+            tid: int,
+            status: int,
+            callback: Optional[Callable[[WatchpointHit], None]],
+            *,
+            stopping: bool=False) -> None:
+        """Deals with one thing a thread did. If stopping is set, it's left stopped rather than resumed."""
+        if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+            self._threads.pop(tid, None)
+            self._programmed.discard(tid)
+            return
+        if not os.WIFSTOPPED(status):
+            return
+
+        self._threads[tid] = False
+        event: int = status >> 16
+        signum: int = os.WSTOPSIG(status)
+        pass_on: int = 0
+        if event == PTRACE_EVENT_CLONE:
+            new_tid = c_ulong(0)
+            if ptrace(cmd=PTRACE_GETEVENTMSG, pid=tid, addr=0, data=addressof(new_tid)) != -1:
+                # It starts out stopped, and gets set up once we hear from it.
+                self._threads.setdefault(new_tid.value, True)
+        elif event == PTRACE_EVENT_STOP:
+            if tid not in self._programmed:
+                self._program(tid)
+        elif signum == signal.SIGTRAP and event == 0:
+            dr6: int = _peek_user(tid, _USER_DEBUGREG + 6*WORD_SIZE)
+            fired: List[int] = [slot for slot in range(len(self.watchpoints)) if dr6 & (1 << slot)]
+            if fired:
+                _poke_user(tid, _USER_DEBUGREG + 6*WORD_SIZE, 0)
+                ip: int = _peek_user(tid, _USER_IP)
+                for slot in fired:
+                    watchpoint: Watchpoint = self.watchpoints[slot]
+                    if watchpoint.kind == WATCH_EXECUTE:
+                        # Otherwise it'd go straight off again when resumed.
+                        _poke_user(tid, _USER_FLAGS, _peek_user(tid, _USER_FLAGS) | _EFLAGS_RF)
+                    self.hits += 1
+                    if callback is not None:
+                        callback(WatchpointHit(
+                            watchpoint=watchpoint,
+                            slot=slot,
+                            tid=tid,
+                            ip=ip,
+                            value=(None if watchpoint.kind == WATCH_EXECUTE else self._read_value(watchpoint.addr, watchpoint.length)),
+                            time=time.monotonic()))
+            else:
+                # Not ours, so it's the game's business.
+                pass_on = signum
+        else:
+            pass_on = signum
+
+        if stopping and pass_on == 0:
+            return
+        # A signal can't wait until we let go, so hand it over now, even if we're stopping.
+        self._resume(tid, pass_on)
+        if stopping:
+            ptrace(cmd=PTRACE_INTERRUPT, pid=tid, addr=0, data=0)
+
+    def run(
+            self,
+            callback: Callable[[WatchpointHit], None],
+            *,
+            timeout: Optional[float]=None,
+            stop: Optional[threading.Event]=None,
+            max_hits: Optional[int]=None) -> int:
+        """Reports each hit to callback, until timeout, stop is set, max_hits is reached, or the target goes away.
+
+        Returns how many hits there were.
+        """
+        started_hits: int = self.hits
+        deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        # Thread stops come with a SIGCHLD, which we wait for rather than polling.
+        old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+        try:
+            while self._threads:
+                if stop is not None and stop.is_set():
+                    break
+                if max_hits is not None and self.hits - started_hits >= max_hits:
+                    break
+                now: float = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+
+                handled: bool = False
+                for tid in list(self._threads):
+                    result_pid, status, = waitpid(tid, WALL | os.WNOHANG)
+                    if result_pid == tid:
+                        self._handle(tid, status, callback)
+                        handled = True
+                    elif result_pid == -1 and errno() == errno_codes.ECHILD:
+                        # Gone without us hearing about it.
+                        self._threads.pop(tid, None)
+                if not handled:
+                    # The SIGCHLD might have gone to some other thread, so don't sleep forever.
+                    wait: float = _WAKE_INTERVAL if deadline is None else min(_WAKE_INTERVAL, deadline - now)
+                    signal.sigtimedwait({signal.SIGCHLD}, max(wait, 0.0))
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+        return self.hits - started_hits
+
+    def close(self) -> None:
+        """Clears the watchpoints from every thread and lets go of them. Safe to call more than once."""
+        errors: List[str] = []
+        for tid, running, in list(self._threads.items()):
+            if running:
+                ptrace(cmd=PTRACE_INTERRUPT, pid=tid, addr=0, data=0)
+        # Stopping one thread can turn up another, so keep going until they're all stopped.
+        while any(self._threads.values()):
+            for tid in [tid for tid, running, in self._threads.items() if running]:
+                try:
+                    self._wait_until_stopped(tid)
+                except HackingOpException as e:
+                    errors.append(str(e))
+                    self._threads.pop(tid, None)
+        for tid in list(self._threads):
+            for offset in (7, 0, 1, 2, 3, 6):
+                ptrace(cmd=PTRACE_POKEUSER, pid=tid, addr=_USER_DEBUGREG + offset*WORD_SIZE, data=0)
+            if ptrace(cmd=PTRACE_DETACH, pid=tid, addr=0, data=0) == -1 and errno() != errno_codes.ESRCH:
+                errors.append(f"{tid:d}: {os.strerror(errno())}")
+        self._threads = {}
+        self._programmed = set()
+        if errors:
+            raise PtraceException(f"could not let go of some threads ({', '.join(errors)})")
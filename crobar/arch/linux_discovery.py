@@ -0,0 +1,234 @@
+"""Finding Talos processes on Linux.
+
+Everything here works off /proc/<pid>/stat, which is one small read per process,
+and which gives us both the name and the start time in one go.
+"""
+import os
+import select
+import time
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+
+from crobar.api import HackingOpException
+
+TALOS_PREFIX: str = "Talos"
+
+_CLK_TCK: int = os.sysconf("SC_CLK_TCK")
+
+
+class ProcessInfo(NamedTuple):
+    pid: int
+    comm: str
+    # Clock ticks since boot. Together with the PID, this identifies a process for good.
+    starttime: int
+
+    def age(self) -> float:
+        """Returns how many seconds ago this process started."""
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - (self.starttime / _CLK_TCK)
+
+
+def read_process_info(pid: int) -> Optional[ProcessInfo]:
+    """Returns the ProcessInfo for a PID, or None if it's gone or unreadable."""
+    try:
+        with open(f"/proc/{pid:d}/stat", "rb") as fp:
+            stat: bytes = fp.read()
+    except OSError:
+        return None
+
+    # The name is in brackets and can contain anything, including brackets.
+    comm_start: int = stat.find(b"(")
+    comm_end: int = stat.rfind(b")")
+    if comm_start < 0 or comm_end < 0:
+        return None
+    fields: List[bytes] = stat[comm_end+2:].split()
+
+    # Field 22 in proc(5) is starttime. fields[0] is field 3.
+    return ProcessInfo(
+        pid=pid,
+        comm=stat[comm_start+1:comm_end].decode("utf-8", "replace"),
+        starttime=int(fields[19]))
+
+
+def list_pids() -> Set[int]:
+    """Returns the PIDs of every process currently in /proc."""
+    with os.scandir("/proc") as it:
+        return {
+            int(entry.name)
+            for entry in it
+            if entry.name.isdigit()}
+
+
+def is_talos(info: ProcessInfo, *, prefix: str=TALOS_PREFIX) -> bool:
+    """Returns True if this looks like a Talos process."""
+    return info.comm.startswith(prefix)
+
+
+def find_talos_processes(*, prefix: str=TALOS_PREFIX) -> List[ProcessInfo]:
+    """Returns every running Talos process, oldest first."""
+    result: List[ProcessInfo] = []
+    for pid in list_pids():
+        info: Optional[ProcessInfo] = read_process_info(pid)
+        if info is not None and is_talos(info, prefix=prefix):
+            result.append(info)
+    result.sort(key=lambda info: (info.starttime, info.pid))
+    return result
+
+
+class ProcessHandle:
+    """Keeps track of one process for as long as it lives.
+
+    Uses a pidfd where the kernel supports it, so that PID reuse can't fool us.
+    """
+    __slots__ = (
+        "info",
+        "_pidfd",
+    )
+
+    def __init__(self, info: ProcessInfo) -> None:
+        self.info = info
+        self._pidfd: Optional[int] = None
+        pidfd_open = getattr(os, "pidfd_open", None)
+        if pidfd_open is not None:
+            try:
+                self._pidfd = pidfd_open(info.pid)
+            except OSError:
+                # Either it's already gone, or the kernel's older than 5.3.
+                pass
+
+    def __del__(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stops tracking the process."""
+        if getattr(self, "_pidfd", None) is not None:
+            assert self._pidfd is not None
+            os.close(self._pidfd)
+            self._pidfd = None
+
+    def fileno(self) -> Optional[int]:
+        """Returns the pidfd, which becomes readable when the process exits. None if we have none."""
+        return self._pidfd
+
+    def is_alive(self) -> bool:
+        """Returns True if the process we found is still running."""
+        if self._pidfd is not None:
+            poller = select.poll()
+            poller.register(self._pidfd, select.POLLIN)
+            return not poller.poll(0)
+
+        # No pidfd, so make sure the PID hasn't been recycled.
+        current: Optional[ProcessInfo] = read_process_info(self.info.pid)
+        return current is not None and current.starttime == self.info.starttime
+
+
+class DiscoveryStats:
+    """How much work the watcher has been doing."""
+    __slots__ = (
+        "scans",
+        "stats_read",
+        "total_scan_time",
+        "max_scan_time",
+    )
+
+    def __init__(self) -> None:
+        self.scans: int = 0
+        self.stats_read: int = 0
+        self.total_scan_time: float = 0.0
+        self.max_scan_time: float = 0.0
+
+    def __repr__(self) -> str:
+        mean: float = self.total_scan_time / self.scans if self.scans else 0.0
+        return (
+            f"{self.scans:d} scans, {self.stats_read:d} stat reads, "
+            f"{mean*1000.0:.3f} ms/scan mean, {self.max_scan_time*1000.0:.3f} ms/scan max")
+
+
+class TalosWatcher:
+    """Watches /proc for Talos processes as they come up.
+
+    Most scans only read the stat of new PIDs,
+    plus any young PIDs which might still be about to exec() into Talos.
+    Every so often we read everything, to catch launcher scripts which exec() into Talos.
+    """
+    __slots__ = (
+        "prefix",
+        "interval",
+        "recheck_window",
+        "full_scan_interval",
+        "stats",
+        "_first_seen",
+        "_last_full_scan",
+    )
+
+    def __init__(
+            self,
+            *,
+            prefix: str=TALOS_PREFIX,
+            interval: float=0.002,
+            recheck_window: float=2.0,
+            full_scan_interval: float=0.25) -> None:
+        self.prefix = prefix
+        self.interval = interval
+        self.recheck_window = recheck_window
+        self.full_scan_interval = full_scan_interval
+        self.stats = DiscoveryStats()
+        # PID -> when we first saw it, for anything still young enough to exec() into Talos
+        self._first_seen: Dict[int, float] = {}
+        self._last_full_scan: float = time.perf_counter()
+
+    def scan(self, *, known: Set[int]) -> List[ProcessInfo]:
+        """Checks for new Talos processes. Updates known to include everything seen."""
+        scan_start: float = time.perf_counter()
+
+        pids: Set[int] = list_pids()
+        new_pids: Set[int] = pids - known
+        known.clear()
+        known.update(pids)
+
+        for pid in new_pids:
+            self._first_seen[pid] = scan_start
+        expired: List[int] = [
+            pid
+            for pid, first_seen in self._first_seen.items()
+            if pid not in pids or scan_start - first_seen > self.recheck_window]
+        for pid in expired:
+            del self._first_seen[pid]
+
+        to_check: Iterable[int] = self._first_seen
+        if scan_start - self._last_full_scan >= self.full_scan_interval:
+            to_check = pids
+            self._last_full_scan = scan_start
+
+        result: List[ProcessInfo] = []
+        for pid in to_check:
+            info: Optional[ProcessInfo] = read_process_info(pid)
+            self.stats.stats_read += 1
+            if info is not None and is_talos(info, prefix=self.prefix):
+                result.append(info)
+
+        scan_time: float = time.perf_counter() - scan_start
+        self.stats.scans += 1
+        self.stats.total_scan_time += scan_time
+        self.stats.max_scan_time = max(self.stats.max_scan_time, scan_time)
+        return result
+
+    def wait_for_new(self, *, timeout: Optional[float]=None, ignore: Optional[Set[int]]=None) -> ProcessInfo:
+        """Blocks until a Talos process that wasn't already running shows up.
+
+        PIDs in ignore are never returned.
+        Anything which is already Talos when we start gets ignored too.
+        """
+        deadline: Optional[float] = None if timeout is None else time.monotonic() + timeout
+        known: Set[int] = list_pids()
+        ignore = set(ignore or ()) | {info.pid for info in find_talos_processes(prefix=self.prefix)}
+        while True:
+            for info in self.scan(known=known):
+                if info.pid not in ignore:
+                    return info
+            if deadline is not None and time.monotonic() >= deadline:
+                raise HackingOpException(f"Talos didn't show up within {timeout} seconds")
+            time.sleep(self.interval)
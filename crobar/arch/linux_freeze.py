@@ -0,0 +1,196 @@
+"""Stopping every thread of a Linux process, for as short a time as we can get away with.
+
+Reading another process's memory doesn't need it to be stopped, or even traced:
+process_vm_readv() and /proc/<pid>/mem only need permission to trace it.
+Writing code while the game's running it is another matter,
+so writes happen with every thread frozen.
+
+Freezing uses PTRACE_SEIZE and PTRACE_INTERRUPT on every thread in /proc/<pid>/task,
+and thawing detaches from all of them again.
+Nothing stays traced in between, so there's nobody to get stuck
+waiting on us when the game gets a signal.
+"""
+import errno as errno_codes
+import os
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+from crobar.api import HackingOpException
+from .linux_syscalls import PTRACE_DETACH
+from .linux_syscalls import PTRACE_EVENT_STOP
+from .linux_syscalls import PTRACE_INTERRUPT
+from .linux_syscalls import PTRACE_SEIZE
+from .linux_syscalls import PtraceException
+from .linux_syscalls import WALL
+from .linux_syscalls import errno
+from .linux_syscalls import ptrace
+from .linux_syscalls import waitpid
+
+
+class FreezeStats:
+    """How often and for how long the target has been frozen."""
+    __slots__ = (
+        "freezes",
+        "threads",
+        "total_time",
+        "max_time",
+        "last_time",
+        "observer",
+    )
+
+    def __init__(self) -> None:
+        self.freezes: int = 0
+        # How many threads the last freeze stopped
+        self.threads: int = 0
+        self.total_time: float = 0.0
+        self.max_time: float = 0.0
+        self.last_time: float = 0.0
+        # Gets called with how long each freeze lasted, as it ends
+        self.observer: Optional[Callable[[float], None]] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.freezes:d} freezes of {self.threads:d} threads, "
+            f"{self.total_time*1000.0:.3f} ms total, {self.max_time*1000.0:.3f} ms max")
+
+
+def list_threads(pid: int) -> Set[int]:
+    """Returns the thread IDs of every thread in a process."""
+    try:
+        with os.scandir(f"/proc/{pid:d}/task") as it:
+            return {
+                int(entry.name)
+                for entry in it
+                if entry.name.isdigit()}
+    except FileNotFoundError:
+        return set()
+
+
+class ThreadFreezer:
+    """Stops and restarts every thread in a process.
+
+    freeze() and thaw() nest, so the target only restarts when the outermost thaw() happens.
+    """
+    __slots__ = (
+        "stats",
+        "_pid",
+        "_depth",
+        "_frozen_at",
+        # Thread ID -> signal to hand back to it when we let go
+        "_threads",
+    )
+
+    def __init__(self, *, pid: int) -> None:
+        self.stats = FreezeStats()
+        self._pid = pid
+        self._depth: int = 0
+        self._frozen_at: float = 0.0
+        self._threads: Dict[int, int] = {}
+
+    @property
+    def is_frozen(self) -> bool:
+        return self._depth > 0
+
+    def freeze(self) -> None:
+        """Stops every thread, if they aren't stopped already."""
+        self._depth += 1
+        if self._depth >= 2:
+            return
+
+        self._frozen_at = time.perf_counter()
+        try:
+            self._stop_all()
+        except BaseException:
+            self._depth = 0
+            self._release_all()
+            raise
+
+    def thaw(self) -> None:
+        """Undoes one freeze(). The last one lets every thread go again."""
+        assert self._depth > 0
+        self._depth -= 1
+        if self._depth >= 1:
+            return
+
+        self._release_all()
+        elapsed: float = time.perf_counter() - self._frozen_at
+        self.stats.freezes += 1
+        self.stats.total_time += elapsed
+        self.stats.max_time = max(self.stats.max_time, elapsed)
+        self.stats.last_time = elapsed
+        if self.stats.observer is not None:
+            self.stats.observer(elapsed)
+
+    def close(self) -> None:
+        """Lets go of everything, however deeply frozen we are."""
+        if self._depth > 0:
+            self._depth = 1
+            self.thaw()
+
+    def _stop_all(self) -> None:
+        gone: Set[int] = set()
+        while True:
+            # Threads can be created while we're stopping the others, so go round until there are no new ones.
+            new_tids: List[int] = sorted(list_threads(self._pid) - set(self._threads) - gone)
+            if not new_tids:
+                break
+
+            seized: List[int] = []
+            for tid in new_tids:
+                if ptrace(cmd=PTRACE_SEIZE, pid=tid, addr=0, data=0) == -1:
+                    err: int = errno()
+                    if err == errno_codes.ESRCH:
+                        # Exited before we got to it.
+                        gone.add(tid)
+                        continue
+                    raise PtraceException(f"PTRACE_SEIZE failed for thread {tid:d}: {os.strerror(err)}")
+                # From here on, we have to detach from it no matter what.
+                self._threads[tid] = 0
+                seized.append(tid)
+
+            # Interrupt everything first, then wait, so the threads all stop at about the same time.
+            for tid in seized:
+                ptrace(cmd=PTRACE_INTERRUPT, pid=tid, addr=0, data=0)
+
+            for tid in seized:
+                self._wait_for_stop(tid, gone)
+
+        if not self._threads:
+            raise HackingOpException(f"PID {self._pid:d} has no threads left to freeze")
+        self.stats.threads = len(self._threads)
+
+    def _wait_for_stop(self, tid: int, gone: Set[int]) -> None:
+        while True:
+            result_pid, status, = waitpid(tid, WALL)
+            if result_pid == -1:
+                if errno() == errno_codes.EINTR:
+                    continue
+                raise PtraceException(f"waitpid failed for thread {tid:d}: {os.strerror(errno())}")
+
+            if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+                del self._threads[tid]
+                gone.add(tid)
+                return
+
+            if os.WIFSTOPPED(status):
+                if (status >> 16) != PTRACE_EVENT_STOP:
+                    # A signal got there before our interrupt did. Hold onto it,
+                    # and it gets delivered when we let go.
+                    # The interrupt itself gets cancelled by the detach.
+                    self._threads[tid] = os.WSTOPSIG(status)
+                return
+
+    def _release_all(self) -> None:
+        errors: List[str] = []
+        for tid, pending_signal in self._threads.items():
+            if ptrace(cmd=PTRACE_DETACH, pid=tid, addr=0, data=pending_signal) == -1:
+                err: int = errno()
+                if err != errno_codes.ESRCH:
+                    errors.append(f"{tid:d}: {os.strerror(err)}")
+        self._threads = {}
+        if errors:
+            raise PtraceException(f"PTRACE_DETACH failed for some threads ({', '.join(errors)})")
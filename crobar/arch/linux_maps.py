@@ -0,0 +1,132 @@
+"""Index of the memory regions in a Linux process, from /proc/<pid>/maps."""
+from bisect import bisect_right
+import os
+import threading
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from crobar.api import MemoryRegion
+
+
+def parse_maps(raw: bytes) -> List[MemoryRegion]:
+    """Parses the contents of /proc/<pid>/maps."""
+    result: List[MemoryRegion] = []
+    for line in raw.splitlines():
+        # start-end perms offset dev inode [path]
+        fields: List[bytes] = line.split(None, 5)
+        if len(fields) < 5:
+            continue
+        start_str, _, end_str = fields[0].partition(b"-")
+        perms: bytes = fields[1]
+        path: Optional[str] = fields[5].strip().decode("utf-8", "replace") if len(fields) >= 6 else None
+        result.append(MemoryRegion(
+            start=int(start_str, 16),
+            end=int(end_str, 16),
+            readable=(perms[0:1] == b"r"),
+            writable=(perms[1:2] == b"w"),
+            executable=(perms[2:3] == b"x"),
+            path=path,
+            offset=int(fields[2], 16)))
+    return result
+
+
+class RegionIndex:
+    """Sorted, searchable view of a process's memory map.
+
+    The map only gets re-read when asked for something it doesn't know about,
+    and only gets re-parsed if the kernel gives us something different.
+    Safe to use from more than one thread.
+    """
+    __slots__ = (
+        "generation",
+        "_pid",
+        "_raw",
+        "_regions",
+        "_starts",
+        "_lock",
+    )
+
+    def __init__(self, *, pid: int) -> None:
+        self._pid = pid
+        self._raw: Optional[bytes] = None
+        self._regions: List[MemoryRegion] = []
+        self._starts: List[int] = []
+        # Bumped every time the map actually changes
+        self.generation: int = 0
+        self._lock = threading.RLock()
+
+    @property
+    def regions(self) -> List[MemoryRegion]:
+        if self._raw is None:
+            self.refresh()
+        return self._regions
+
+    def refresh(self) -> bool:
+        """Re-reads the memory map. Returns True if it changed."""
+        with self._lock:
+            with open(f"/proc/{self._pid:d}/maps", "rb") as fp:
+                raw: bytes = fp.read()
+            if raw == self._raw:
+                return False
+
+            self._raw = raw
+            self._regions = parse_maps(raw)
+            self._starts = [region.start for region in self._regions]
+            self.generation += 1
+            return True
+
+    def _find_cached(self, addr: int) -> Optional[MemoryRegion]:
+        idx: int = bisect_right(self._starts, addr) - 1
+        if idx >= 0 and addr < self._regions[idx].end:
+            return self._regions[idx]
+        return None
+
+    def find(self, addr: int) -> Optional[MemoryRegion]:
+        """Returns the region containing addr, or None if it's not mapped."""
+        with self._lock:
+            if self._raw is None:
+                self.refresh()
+            region: Optional[MemoryRegion] = self._find_cached(addr)
+            if region is None and self.refresh():
+                region = self._find_cached(addr)
+            return region
+
+    def split(self, *, addr: int, length: int) -> Optional[List[Tuple[MemoryRegion, int, int]]]:
+        """Splits a range into (region, addr, length) pieces on region boundaries.
+
+        Returns None if any of it isn't mapped.
+        """
+        result: List[Tuple[MemoryRegion, int, int]] = []
+        end: int = addr + length
+        pos: int = addr
+        while pos < end:
+            region: Optional[MemoryRegion] = self.find(pos)
+            if region is None:
+                return None
+            piece_end: int = min(end, region.end)
+            result.append((region, pos, piece_end - pos))
+            pos = piece_end
+        return result
+
+    def is_readable(self, *, addr: int, length: int) -> bool:
+        """Returns True if the whole range is mapped and readable."""
+        pieces: Optional[List[Tuple[MemoryRegion, int, int]]] = self.split(addr=addr, length=length)
+        return pieces is not None and all(region.readable for region, piece_addr, piece_length in pieces)
+
+    def is_writable(self, *, addr: int, length: int) -> bool:
+        """Returns True if the whole range is mapped and writable without bending the rules."""
+        pieces: Optional[List[Tuple[MemoryRegion, int, int]]] = self.split(addr=addr, length=length)
+        return pieces is not None and all(region.writable for region, piece_addr, piece_length in pieces)
+
+    def image_base(self) -> Optional[int]:
+        """Returns where the main executable got mapped, if we can tell."""
+        try:
+            exe_path: str = os.readlink(f"/proc/{self._pid:d}/exe")
+        except OSError:
+            return None
+        candidates: List[int] = [
+            region.start
+            for region in self.regions
+            if region.path == exe_path and region.offset == 0]
+        return min(candidates) if candidates else None
@@ -0,0 +1,106 @@
+"""Thin ctypes bindings for the Linux syscalls we need."""
+from ctypes import CDLL
+from ctypes import Structure
+from ctypes import byref
+from ctypes import c_int
+from ctypes import c_long
+from ctypes import c_size_t
+from ctypes import c_ssize_t
+from ctypes import c_ulong
+from ctypes import c_void_p
+from ctypes import get_errno
+from ctypes import set_errno
+from ctypes import sizeof
+import os
+from typing import Any
+from typing import Optional
+from typing import Tuple
+
+from crobar.api import HackingOpException
+from .base import LazyLibrary
+
+PTRACE_PEEKTEXT = 1
+PTRACE_PEEKDATA = 2
+PTRACE_PEEKUSER = 3
+PTRACE_POKETEXT = 4
+PTRACE_POKEDATA = 5
+PTRACE_POKEUSER = 6
+PTRACE_CONT = 7
+PTRACE_ATTACH = 16
+PTRACE_DETACH = 17
+PTRACE_GETEVENTMSG = 0x4201
+PTRACE_SEIZE = 0x4206
+PTRACE_INTERRUPT = 0x4207
+
+# PTRACE_SEIZE option: follow new threads, stopping them before they run anything
+PTRACE_O_TRACECLONE = 0x8
+
+# What a thread stops with, in the top bits of the wait status:
+# making a new thread, and being interrupted (or starting out traced)
+PTRACE_EVENT_CLONE = 3
+PTRACE_EVENT_STOP = 128
+
+# waitpid() flag for tracees that aren't our children. Python's os module doesn't have it.
+WALL = 0x40000000
+
+# A ptrace() "word" is whatever the *tracer* thinks a long is.
+# For a 32-bit Talos traced from a 64-bit Python, that's 8 bytes.
+WORD_SIZE: int = sizeof(c_long)
+WORD_MASK: int = (1 << (WORD_SIZE * 8)) - 1
+
+
+def _load_libc() -> CDLL:
+    libc = CDLL("libc.so.6", use_errno=True)
+    libc.ptrace.restype = c_long
+    libc.ptrace.argtypes = [c_long, c_int, c_void_p, c_void_p]
+    libc.waitpid.restype = c_int
+    libc.waitpid.argtypes = [c_int, c_void_p, c_int]
+    libc.process_vm_readv.restype = c_ssize_t
+    libc.process_vm_readv.argtypes = [c_int, c_void_p, c_ulong, c_void_p, c_ulong, c_ulong]
+    libc.process_vm_writev.restype = c_ssize_t
+    libc.process_vm_writev.argtypes = [c_int, c_void_p, c_ulong, c_void_p, c_ulong, c_ulong]
+    return libc
+
+
+# Only loaded once something actually needs it.
+_libc: Any = LazyLibrary(_load_libc)
+
+
+class PtraceException(HackingOpException):
+    """Generic exception fires whenever ptrace() fails."""
+    __slots__ = ()
+
+
+class iovec(Structure):
+    _fields_ = [
+        ("iov_base", c_void_p),
+        ("iov_len", c_size_t),
+    ]
+
+
+def ptrace(*, cmd: int, pid: int, addr: Optional[int]=None, data: Optional[int]=None) -> int:
+    """Raw interface to ptrace().
+
+    Returns whatever ptrace() returned, which for PEEK requests is the word itself.
+    Check errno() afterwards if the result is -1.
+    """
+    set_errno(0)
+    return int(_libc.ptrace(cmd, pid, addr, data))
+
+
+def waitpid(pid: int, options: int=0) -> Tuple[int, int]:
+    """Raw interface to waitpid(). Returns (pid, status), with pid -1 on failure."""
+    status = c_int(0)
+    result: int = _libc.waitpid(pid, byref(status), options)
+    return result, status.value
+
+
+def errno() -> int:
+    """Returns the errno left behind by the last libc call on this thread."""
+    return get_errno()
+
+
+def oserror(what: str) -> OSError:
+    """Builds an OSError from the current errno."""
+    err: int = get_errno()
+    return OSError(err, f"{what}: {os.strerror(err)}")
@@ -0,0 +1,470 @@
+"""Memory transfer backends for the Linux debugging interface.
+
+In order of preference:
+- process_vm_readv()/process_vm_writev(): one syscall per transfer, but it
+  honours page protections, so it can't write to the read-only text pages.
+- pread()/pwrite() on /proc/<pid>/mem: one syscall per transfer, and it
+  *can* write to read-only pages, as long as we're attached with ptrace().
+- PTRACE_PEEKDATA/PTRACE_POKEDATA: one syscall per word. Slow, but it always works.
+"""
+from abc import ABCMeta
+from abc import abstractmethod
+from ctypes import addressof
+from ctypes import byref
+from ctypes import create_string_buffer
+from ctypes import string_at
+import errno as errno_codes
+import os
+import struct
+import threading
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Type
+
+from crobar.api import HackingOpException
+from crobar.api import ReadableBuffer
+from crobar.ranges import CoalescedRange
+from crobar.ranges import coalesce_ranges
+from .base import buffer_address
+from .linux_syscalls import PTRACE_PEEKDATA
+from .linux_syscalls import PTRACE_POKEDATA
+from .linux_syscalls import PtraceException
+from .linux_syscalls import WORD_MASK
+from .linux_syscalls import WORD_SIZE
+from .linux_syscalls import _libc
+from .linux_syscalls import errno
+from .linux_syscalls import iovec
+from .linux_syscalls import oserror
+from .linux_syscalls import ptrace
+
+# The kernel refuses more iovecs than this in one call.
+IOV_MAX: int = 1024
+
+_WORD_STRUCT = struct.Struct("<Q" if WORD_SIZE == 8 else "<I")
+
+# These errno values mean "this backend will never work for this process",
+# as opposed to "this particular range didn't work".
+_FATAL_ERRNOS = frozenset([
+    errno_codes.ENOSYS,
+    errno_codes.EPERM,
+    errno_codes.EACCES,
+])
+
+
+class TransferException(HackingOpException):
+    """Fires when a transfer backend can't move a given range."""
+    __slots__ = (
+        "fatal",
+    )
+
+    def __init__(self, message: str, *, fatal: bool=False) -> None:
+        super().__init__(message)
+        self.fatal = fatal
+
+
+def _raise_transfer(what: str, exc: OSError) -> None:
+    raise TransferException(f"{what} failed: {exc}", fatal=(exc.errno in _FATAL_ERRNOS)) from exc
+
+
+class TransferStats:
+    """Counters for how much work a transfer backend has done."""
+    __slots__ = (
+        "syscalls",
+        "bytes_read",
+        "bytes_written",
+        "_lock",
+    )
+
+    def __init__(self) -> None:
+        self.syscalls: int = 0
+        self.bytes_read: int = 0
+        self.bytes_written: int = 0
+        self._lock = threading.Lock()
+
+    def count(self, *, bytes_read: int=0, bytes_written: int=0) -> None:
+        """Counts one syscall. Safe from any thread, for transfers that get used from more than one."""
+        with self._lock:
+            self.syscalls += 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def __repr__(self) -> str:
+        return f"{self.syscalls:d} syscalls, {self.bytes_read:d} bytes read, {self.bytes_written:d} bytes written"
+
+
+class MemoryTransfer(metaclass=ABCMeta):
+    """A way of moving bytes in and out of another process."""
+    __slots__ = (
+        "stats",
+        "_pid",
+    )
+
+    name: str = "?"
+
+    # True if this transfer can't write to read-only pages.
+    honours_protection: bool = False
+
+    # True if the target has to be stopped for this transfer to work at all.
+    # Transfers which don't can read from any thread, and count what they do with stats.count().
+    needs_stop: bool = False
+
+    def __init__(self, *, pid: int) -> None:
+        self.stats = TransferStats()
+        self._pid = pid
+
+    def close(self) -> None:
+        """Releases anything this transfer holds open."""
+        pass
+
+    @abstractmethod
+    def read(self, *, addr: int, length: int) -> bytes:
+        """Reads exactly length bytes, or raises a TransferException."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def write(self, *, addr: int, data: ReadableBuffer) -> None:
+        """Writes all of data, or raises a TransferException."""
+        raise NotImplementedError()
+
+    def read_into(self, *, addr: int, buffer: memoryview) -> None:
+        """Fills a byte-format memoryview, or raises a TransferException.
+
+        Transfers which can't read straight into it copy in what read() gives back.
+        """
+        buffer[:] = self.read(addr=addr, length=len(buffer))
+
+    def read_vectored(self, *, ranges: Sequence[Tuple[int, int]]) -> List[Optional[bytes]]:
+        """Reads several (addr, length) ranges. Ranges that fail come back as None."""
+        result: List[Optional[bytes]] = []
+        for addr, length in ranges:
+            try:
+                result.append(self.read(addr=addr, length=length))
+            except HackingOpException:
+                result.append(None)
+        return result
+
+    def write_vectored(self, *, chunks: Sequence[Tuple[int, bytes]]) -> List[bool]:
+        """Writes several (addr, data) chunks. Returns whether each one made it."""
+        result: List[bool] = []
+        for addr, data in chunks:
+            try:
+                self.write(addr=addr, data=data)
+                result.append(True)
+            except HackingOpException:
+                result.append(False)
+        return result
+
+
+class ProcessVmTransfer(MemoryTransfer):
+    """process_vm_readv()/process_vm_writev() transfers."""
+    __slots__ = ()
+
+    name = "process_vm"
+    honours_protection = True
+
+    def _read_to(self, *, addr: int, local_addr: int, length: int) -> None:
+        local = iovec(local_addr, length)
+        remote = iovec(addr, length)
+        result: int = _libc.process_vm_readv(self._pid, byref(local), 1, byref(remote), 1, 0)
+        if result == -1:
+            err: OSError = oserror("process_vm_readv")
+            self.stats.count()
+            _raise_transfer(f"process_vm_readv at 0x{addr:x}", err)
+        self.stats.count(bytes_read=result)
+        if result != length:
+            raise TransferException(f"process_vm_readv at 0x{addr:x} read {result:d} of {length:d} bytes")
+
+    def read(self, *, addr: int, length: int) -> bytes:
+        buf = create_string_buffer(length)
+        self._read_to(addr=addr, local_addr=addressof(buf), length=length)
+        return buf.raw
+
+    def read_into(self, *, addr: int, buffer: memoryview) -> None:
+        local_addr, keep, = buffer_address(buffer)
+        self._read_to(addr=addr, local_addr=local_addr, length=len(buffer))
+
+    def write(self, *, addr: int, data: ReadableBuffer) -> None:
+        # Straight from wherever the data already is, unless it's somewhere read-only that isn't bytes.
+        local_addr, keep, = buffer_address(data)
+        length: int = memoryview(data).nbytes
+        local = iovec(local_addr, length)
+        remote = iovec(addr, length)
+        result: int = _libc.process_vm_writev(self._pid, byref(local), 1, byref(remote), 1, 0)
+        if result == -1:
+            err: OSError = oserror("process_vm_writev")
+            self.stats.count()
+            _raise_transfer(f"process_vm_writev at 0x{addr:x}", err)
+        self.stats.count(bytes_written=result)
+        if result != length:
+            raise TransferException(f"process_vm_writev at 0x{addr:x} wrote {result:d} of {length:d} bytes")
+
+    def read_vectored(self, *, ranges: Sequence[Tuple[int, int]]) -> List[Optional[bytes]]:
+        # Everything lands in one local buffer, scattered from many remote iovecs.
+        total: int = sum(length for addr, length in ranges)
+        buf = create_string_buffer(max(total, 1))
+        offsets: List[int] = []
+        pos: int = 0
+        for addr, length in ranges:
+            offsets.append(pos)
+            pos += length
+
+        result: List[Optional[bytes]] = [None] * len(ranges)
+        first: int = 0
+        while first < len(ranges):
+            count: int = min(len(ranges) - first, IOV_MAX)
+            remote = (iovec * count)(*(
+                iovec(addr, length)
+                for addr, length in ranges[first:first+count]))
+            wanted: int = sum(length for addr, length in ranges[first:first+count])
+            local = iovec(addressof(buf) + offsets[first], wanted)
+            transferred: int = _libc.process_vm_readv(self._pid, byref(local), 1, remote, count, 0)
+            if transferred == -1:
+                err: OSError = oserror("process_vm_readv")
+                self.stats.count()
+                if err.errno in _FATAL_ERRNOS:
+                    _raise_transfer("process_vm_readv", err)
+                transferred = 0
+            else:
+                self.stats.count(bytes_read=transferred)
+
+            # Everything up to the first short iovec made it. Skip that one and carry on.
+            done: int = 0
+            for idx in range(first, first+count):
+                length: int = ranges[idx][1]
+                if done + length > transferred:
+                    first = idx + 1
+                    break
+                result[idx] = string_at(addressof(buf) + offsets[idx], length)
+                done += length
+            else:
+                first += count
+
+        return result
+
+    def write_vectored(self, *, chunks: Sequence[Tuple[int, bytes]]) -> List[bool]:
+        data: bytes = b"".join(chunk_data for addr, chunk_data in chunks)
+        buf = create_string_buffer(data, max(len(data), 1))
+        offsets: List[int] = []
+        pos: int = 0
+        for addr, chunk_data in chunks:
+            offsets.append(pos)
+            pos += len(chunk_data)
+
+        result: List[bool] = [False] * len(chunks)
+        first: int = 0
+        while first < len(chunks):
+            count: int = min(len(chunks) - first, IOV_MAX)
+            remote = (iovec * count)(*(
+                iovec(addr, len(chunk_data))
+                for addr, chunk_data in chunks[first:first+count]))
+            wanted: int = sum(len(chunk_data) for addr, chunk_data in chunks[first:first+count])
+            local = iovec(addressof(buf) + offsets[first], wanted)
+            transferred: int = _libc.process_vm_writev(self._pid, byref(local), 1, remote, count, 0)
+            if transferred == -1:
+                err: OSError = oserror("process_vm_writev")
+                self.stats.count()
+                if err.errno in _FATAL_ERRNOS:
+                    _raise_transfer("process_vm_writev", err)
+                transferred = 0
+            else:
+                self.stats.count(bytes_written=transferred)
+
+            done: int = 0
+            for idx in range(first, first+count):
+                length: int = len(chunks[idx][1])
+                if done + length > transferred:
+                    first = idx + 1
+                    break
+                result[idx] = True
+                done += length
+            else:
+                first += count
+
+        return result
+
+
+class ProcMemTransfer(MemoryTransfer):
+    """pread()/pwrite() on /proc/<pid>/mem."""
+    __slots__ = (
+        "_fd",
+        "_fd_lock",
+    )
+
+    name = "proc_mem"
+
+    def __init__(self, *, pid: int) -> None:
+        super().__init__(pid=pid)
+        self._fd: Optional[int] = None
+        self._fd_lock = threading.Lock()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _get_fd(self) -> int:
+        if self._fd is None:
+            # Two threads turning up at once should still only open it once.
+            with self._fd_lock:
+                if self._fd is None:
+                    try:
+                        self._fd = os.open(f"/proc/{self._pid:d}/mem", os.O_RDWR | os.O_CLOEXEC)
+                    except OSError as e:
+                        _raise_transfer(f"opening /proc/{self._pid:d}/mem", e)
+        assert self._fd is not None
+        return self._fd
+
+    def read(self, *, addr: int, length: int) -> bytes:
+        fd: int = self._get_fd()
+        try:
+            result: bytes = os.pread(fd, length, addr)
+        except OSError as e:
+            self.stats.count()
+            _raise_transfer(f"pread at 0x{addr:x}", e)
+        self.stats.count(bytes_read=len(result))
+        if len(result) != length:
+            raise TransferException(f"pread at 0x{addr:x} read {len(result):d} of {length:d} bytes")
+        return result
+
+    def read_into(self, *, addr: int, buffer: memoryview) -> None:
+        fd: int = self._get_fd()
+        try:
+            result: int = os.preadv(fd, [buffer], addr)
+        except OSError as e:
+            self.stats.count()
+            _raise_transfer(f"preadv at 0x{addr:x}", e)
+        self.stats.count(bytes_read=result)
+        if result != len(buffer):
+            raise TransferException(f"preadv at 0x{addr:x} read {result:d} of {len(buffer):d} bytes")
+
+    def write(self, *, addr: int, data: ReadableBuffer) -> None:
+        fd: int = self._get_fd()
+        length: int = memoryview(data).nbytes
+        try:
+            result: int = os.pwrite(fd, data, addr)
+        except OSError as e:
+            self.stats.count()
+            _raise_transfer(f"pwrite at 0x{addr:x}", e)
+        self.stats.count(bytes_written=result)
+        if result != length:
+            raise TransferException(f"pwrite at 0x{addr:x} wrote {result:d} of {length:d} bytes")
+
+
+class PtraceWordTransfer(MemoryTransfer):
+    """One PTRACE_PEEKDATA/PTRACE_POKEDATA per word. Requires the target to be stopped."""
+    __slots__ = ()
+
+    name = "ptrace"
+    needs_stop = True
+
+    def _read_word(self, *, addr: int) -> int:
+        """Read a word from the attached process."""
+        result: int = ptrace(cmd=PTRACE_PEEKDATA, pid=self._pid, addr=addr)
+        self.stats.syscalls += 1
+        if result == -1 and errno() != 0:
+            raise PtraceException(f"PTRACE_PEEKDATA failed for 0x{addr:x}: {os.strerror(errno())}")
+        self.stats.bytes_read += WORD_SIZE
+        return result & WORD_MASK
+
+    def _write_word(self, *, addr: int, data: int) -> None:
+        """Write a word to the attached process."""
+        result: int = ptrace(cmd=PTRACE_POKEDATA, pid=self._pid, addr=addr, data=data)
+        self.stats.syscalls += 1
+        if result == -1:
+            raise PtraceException(f"PTRACE_POKEDATA failed for 0x{addr:x}: {os.strerror(errno())}")
+        self.stats.bytes_written += WORD_SIZE
+
+    def read(self, *, addr: int, length: int) -> bytes:
+        # Stick to aligned words so that we never straddle a page we didn't ask for.
+        start: int = addr & ~(WORD_SIZE-1)
+        end: int = (addr + length + WORD_SIZE-1) & ~(WORD_SIZE-1)
+        result = bytearray(end - start)
+        for offs in range(0, end - start, WORD_SIZE):
+            _WORD_STRUCT.pack_into(result, offs, self._read_word(addr=start+offs))
+        return bytes(result[addr-start:addr-start+length])
+
+    def read_into(self, *, addr: int, buffer: memoryview) -> None:
+        # Whole words inside the buffer go straight in. Only the ragged ends need reading somewhere else first.
+        start: int = (addr + WORD_SIZE-1) & ~(WORD_SIZE-1)
+        end: int = max(start, (addr + len(buffer)) & ~(WORD_SIZE-1))
+        head: int = min(start - addr, len(buffer))
+        if head > 0:
+            buffer[:head] = self.read(addr=addr, length=head)
+        for word_addr in range(start, end, WORD_SIZE):
+            _WORD_STRUCT.pack_into(buffer, word_addr - addr, self._read_word(addr=word_addr))
+        tail: int = max(end, addr + head)
+        if addr + len(buffer) > tail:
+            buffer[tail-addr:] = self.read(addr=tail, length=addr + len(buffer) - tail)
+
+    def write(self, *, addr: int, data: ReadableBuffer) -> None:
+        length: int = memoryview(data).nbytes
+        start: int = addr & ~(WORD_SIZE-1)
+        end: int = (addr + length + WORD_SIZE-1) & ~(WORD_SIZE-1)
+        buf = bytearray(end - start)
+
+        # Only the partially-covered words at either end need the original contents.
+        if start != addr:
+            _WORD_STRUCT.pack_into(buf, 0, self._read_word(addr=start))
+        if end != addr + length and (end - WORD_SIZE != start or start == addr):
+            _WORD_STRUCT.pack_into(buf, len(buf)-WORD_SIZE, self._read_word(addr=end-WORD_SIZE))
+        buf[addr-start:addr-start+length] = data
+
+        for offs in range(0, len(buf), WORD_SIZE):
+            v: int
+            v, = _WORD_STRUCT.unpack_from(buf, offs)
+            self._write_word(addr=start+offs, data=v)
+
+    def write_vectored(self, *, chunks: Sequence[Tuple[int, bytes]]) -> List[bool]:
+        """Writes several chunks, touching each word once however many chunks land in it.
+
+        Chunks sharing or touching words get merged into runs of whole words.
+        Only words a run doesn't completely cover get read in first.
+        """
+        plan: List[CoalescedRange] = coalesce_ranges(
+            [
+                (addr & ~(WORD_SIZE-1), ((addr + len(data) + WORD_SIZE-1) & ~(WORD_SIZE-1)) - (addr & ~(WORD_SIZE-1)))
+                for addr, data in chunks
+                if len(data) > 0],
+            max_gap=0)
+        # coalesce_ranges() numbers members by position in what it was given, which skipped empty chunks.
+        nonempty: List[int] = [idx for idx, (addr, data) in enumerate(chunks) if len(data) > 0]
+
+        result: List[bool] = [len(data) == 0 for addr, data in chunks]
+        for run in plan:
+            members: List[int] = sorted(nonempty[idx] for idx in run.members)
+            buf = bytearray(run.length)
+            covered = bytearray(run.length)
+            for idx in members:
+                addr, data, = chunks[idx]
+                buf[addr-run.addr:addr-run.addr+len(data)] = data
+                covered[addr-run.addr:addr-run.addr+len(data)] = b"\x01" * len(data)
+
+            try:
+                for offs in range(0, run.length, WORD_SIZE):
+                    word_covered: bytes = covered[offs:offs+WORD_SIZE]
+                    if word_covered.count(0) != 0:
+                        original = bytearray(_WORD_STRUCT.pack(self._read_word(addr=run.addr+offs)))
+                        for byte_idx in range(WORD_SIZE):
+                            if word_covered[byte_idx]:
+                                original[byte_idx] = buf[offs+byte_idx]
+                        buf[offs:offs+WORD_SIZE] = original
+                for offs in range(0, run.length, WORD_SIZE):
+                    v: int
+                    v, = _WORD_STRUCT.unpack_from(buf, offs)
+                    self._write_word(addr=run.addr+offs, data=v)
+            except HackingOpException:
+                continue
+
+            for idx in members:
+                result[idx] = True
+
+        return result
+
+
+DEFAULT_TRANSFER_TYPES: Sequence[Type[MemoryTransfer]] = (
+    ProcessVmTransfer,
+    ProcMemTransfer,
+    PtraceWordTransfer,
+)
@@ -3,21 +3,34 @@
 FIXME: THIS IS COMPLETELY UNTESTED AT THIS STAGE.
 """
 import ctypes
-from ctypes import CDLL
+from ctypes import Structure
 from ctypes import c_byte
 from ctypes import c_uint32
 from ctypes import c_uint64
 from ctypes import c_size_t
+from ctypes import c_void_p
 from ctypes import create_string_buffer
 from ctypes import pointer
 from ctypes import sizeof
+import logging
 import struct
 from typing import Any
+from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import Sequence
+from typing import Tuple
 from typing import cast
 
 from .base import BaseDebugInterface
+from .base import LazyLibrary
+from .base import buffer_address
 from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import ReadableBuffer
+from crobar.api import WritableBuffer
+
+logger = logging.getLogger(__name__)
 
 # NOTE: Windows Vista and upwards supports PROCESS_QUERY_LIMITED_INFORMATION.
 # This allows access to a subset of the information.
@@ -28,10 +41,144 @@ PROCESS_VM_OPERATION = 0x0008
 PROCESS_VM_READ = 0x0010
 PROCESS_VM_WRITE = 0x0020
 
+MEM_COMMIT = 0x1000
+
+PAGE_NOACCESS = 0x01
+PAGE_READONLY = 0x02
+PAGE_READWRITE = 0x04
+PAGE_WRITECOPY = 0x08
+PAGE_EXECUTE = 0x10
+PAGE_EXECUTE_READ = 0x20
+PAGE_EXECUTE_READWRITE = 0x40
+PAGE_EXECUTE_WRITECOPY = 0x80
+PAGE_GUARD = 0x100
+
+_PAGE_READABLE = PAGE_READONLY | PAGE_READWRITE | PAGE_WRITECOPY | PAGE_EXECUTE_READ | PAGE_EXECUTE_READWRITE | PAGE_EXECUTE_WRITECOPY
+_PAGE_WRITABLE = PAGE_READWRITE | PAGE_WRITECOPY | PAGE_EXECUTE_READWRITE | PAGE_EXECUTE_WRITECOPY
+_PAGE_EXECUTABLE = PAGE_EXECUTE | PAGE_EXECUTE_READ | PAGE_EXECUTE_READWRITE | PAGE_EXECUTE_WRITECOPY
+
+class MEMORY_BASIC_INFORMATION(Structure):
+    # Natural alignment takes care of the 64-bit padding around RegionSize.
+    _fields_ = [
+        ("BaseAddress", c_void_p),
+        ("AllocationBase", c_void_p),
+        ("AllocationProtect", c_uint32),
+        ("RegionSize", c_size_t),
+        ("State", c_uint32),
+        ("Protect", c_uint32),
+        ("Type", c_uint32),
+    ]
+
+
 # doing it this way to keep mypy happy --GM
-_windll = ctypes.windll # type: ignore
-_kernel32: CDLL = _windll.kernel32
-_psapi: CDLL = _windll.psapi
+# Nothing gets loaded until it's used, so importing this is harmless anywhere.
+_kernel32: Any = LazyLibrary(lambda: ctypes.windll.kernel32) # type: ignore
+_psapi: Any = LazyLibrary(lambda: ctypes.windll.psapi) # type: ignore
+
+
+def enum_talos_processes(*, pid: Optional[int]=None) -> Iterator[Tuple[int, int]]:
+    """Yields (PID, base address of the first module) for every Talos process.
+
+    If a PID is given, only that process is considered.
+    """
+
+    # I forgot how terrible this was on Windows.
+    #
+    # Here's how it works according to what I could scrape on MSDN.
+    # - Call EnumProcesses() to get a list of process IDs.
+    # - For every process:
+    #   - Call OpenProcess() to attach to the process.
+    #   - Call EnumProcessModules() to get the first module in the process.
+    #   - If the module could be found at all:
+    #     - Call GetModuleBaseNameA() on that module.
+    #   - Call CloseHandle().
+    #
+    # Windows XP added some fun where you had to get your process security right,
+    # and I think Wine straight up doesn't emulate this.
+    # Then again, ovl075 was a thing, so I've definitely had it working on official Windows.
+    # I don't quite recall how to get that garbage working.
+
+    # Fetch all processes.
+    # This should be large enough, hopefully
+    process_list = (c_uint32 * 4096)()
+    process_count_bytes = c_uint32(0)
+    did_enum: int = _psapi.EnumProcesses(
+        pointer(process_list),
+        c_uint32(sizeof(process_list)),
+        pointer(process_count_bytes))
+
+    if did_enum == 0:
+        raise HackingOpException(f"EnumProcesses failed")
+
+    process_count: int = process_count_bytes.value // sizeof(c_uint32)
+
+    if process_count > len(process_list):
+        raise HackingOpException(f"EnumProcesses process count overflowed: {process_count:d} > {len(process_list):d}")
+
+    wanted_pid: Optional[int] = pid
+    for pid_idx in range(process_count):
+        pid = process_list[pid_idx]
+        if wanted_pid is not None and pid != wanted_pid:
+            continue
+
+        # Open the process.
+        prochandle: int = _kernel32.OpenProcess(
+            c_uint32(0
+                | PROCESS_QUERY_INFORMATION
+                | PROCESS_VM_READ
+                ),
+            c_uint32(int(False)),
+            c_uint32(pid))
+
+        if prochandle == 0:
+            logger.debug("OpenProcess failed for pid %d, skipping", pid)
+            continue
+
+        try:
+            # Grab the first module we can.
+            module_buf = c_size_t(0)
+            module_buf_needed = c_uint32(0)
+            result_enum_modules: int = _psapi.EnumProcessModules(
+                prochandle,
+                pointer(module_buf),
+                sizeof(module_buf),
+                pointer(module_buf_needed))
+
+            if result_enum_modules == 0:
+                logger.debug("EnumProcessModules failed for pid %d, skipping", pid)
+                continue
+
+            if module_buf_needed.value == 0:
+                logger.debug("EnumProcessModules yielded no modules for pid %d, skipping", pid)
+                continue
+
+            procmodule: int = module_buf.value
+
+            # Get the first module's name.
+            procname_buf = create_string_buffer(1024)
+            result_basename: int = _psapi.GetModuleBaseNameA(
+                c_uint32(prochandle),
+                c_size_t(procmodule),
+                pointer(procname_buf),
+                sizeof(procname_buf))
+
+            if result_basename == 0:
+                logger.debug("GetModuleBaseNameA failed for pid %d, skipping", pid)
+                continue
+
+            procname: bytes = procname_buf.raw.partition(b"\x00")[0]
+            if procname.lower().startswith(b"talos") and procname.lower().endswith(b".exe"):
+                logger.info("%d: %08X %016X %r", pid, prochandle, procmodule, procname)
+                yield pid, procmodule
+        finally:
+            result_close: int = _kernel32.CloseHandle(prochandle)
+            if result_close == 0:
+                raise HackingOpException(f"CloseHandle failed for pid {pid:d}")
+
+
+def find_talos_pids() -> List[int]:
+    """Returns the PID of every running Talos process."""
+    return [pid for pid, procmodule in enum_talos_processes()]
 
 
 class WindowsDebugInterface(BaseDebugInterface):
@@ -41,117 +188,42 @@ class WindowsDebugInterface(BaseDebugInterface):
         "_image_base_offset",
     )
 
-    def __init__(self) -> None:
-        self._find_talos()
+    def __init__(self, *, pid: Optional[int]=None) -> None:
+        self._find_talos(pid=pid)
         self._attach_to_talos()
 
     def __del__(self) -> None:
-        print(f"Deleting {self!r}")
-        result_close: int = _kernel32.CloseHandle(self._process_handle)
-        print(f"Closed: {result_close}")
-
-    def _find_talos(self) -> None:
-        """Attempt to find Talos in the process list."""
-
-        # I forgot how terrible this was on Windows.
-        #
-        # Here's how it works according to what I could scrape on MSDN.
-        # - Call EnumProcesses() to get a list of process IDs.
-        # - For every process:
-        #   - Call OpenProcess() to attach to the process.
-        #   - Call EnumProcessModules() to get the first module in the process.
-        #   - If the module could be found at all:
-        #     - Call GetModuleBaseNameA() on that module.
-        #   - Call CloseHandle().
-        #
-        # Windows XP added some fun where you had to get your process security right,
-        # and I think Wine straight up doesn't emulate this.
-        # Then again, ovl075 was a thing, so I've definitely had it working on official Windows.
-        # I don't quite recall how to get that garbage working.
-
-        # Fetch all processes.
-        # This should be large enough, hopefully
-        process_list = (c_uint32 * 4096)()
-        process_count_bytes = c_uint32(0)
-        did_enum: int = _psapi.EnumProcesses(
-            pointer(process_list),
-            c_uint32(sizeof(process_list)),
-            pointer(process_count_bytes))
-
-        if did_enum == 0:
-            raise HackingOpException(f"EnumProcesses failed")
-
-        process_count: int = process_count_bytes.value // sizeof(c_uint32)
-
-        if process_count > len(process_list):
-            raise HackingOpException(f"EnumProcesses process count overflowed: {process_count:d} > {len(process_list):d}")
-
-        for pid_idx in range(process_count):
-            pid: int = process_list[pid_idx]
-
-            # Open the process.
-            prochandle: int = _kernel32.OpenProcess(
-                c_uint32(0
-                    | PROCESS_QUERY_INFORMATION
-                    | PROCESS_VM_READ
-                    ),
-                c_uint32(int(False)),
-                c_uint32(pid))
-
-            if prochandle == 0:
-                # print(f"OpenProcess failed for pid {pid:d}, skipping")
-                continue
-
-            try:
-                # Grab the first module we can.
-                module_buf = c_size_t(0)
-                module_buf_needed = c_uint32(0)
-                result_enum_modules: int = _psapi.EnumProcessModules(
-                    prochandle,
-                    pointer(module_buf),
-                    sizeof(module_buf),
-                    pointer(module_buf_needed))
-
-                if result_enum_modules == 0:
-                    # print(f"EnumProcessModules failed for pid {pid:d}, skipping")
-                    continue
-
-                if module_buf_needed.value == 0:
-                    print(f"EnumProcessModules yielded no modules for pid {pid:d}, skipping")
-                    continue
-
-                procmodule: int = module_buf.value
-
-                # Get the first module's name.
-                procname_buf = create_string_buffer(1024)
-                result_basename: int = _psapi.GetModuleBaseNameA(
-                    c_uint32(prochandle),
-                    c_size_t(procmodule),
-                    pointer(procname_buf),
-                    sizeof(procname_buf))
-
-                if result_basename == 0:
-                    print(f"GetModuleBaseNameA failed for pid {pid:d}, skipping")
-                    continue
-
-                procname: bytes = procname_buf.raw.partition(b"\x00")[0]
-                if procname.lower().startswith(b"talos") and procname.lower().endswith(b".exe"):
-                    print(f"{pid}: {prochandle:08X} {procmodule:016X} {procname!r}")
-                    self._pid: int = pid
-                    self._image_base_offset: int = procmodule - 0x00400000
-                    return
-            finally:
-                result_close: int = _kernel32.CloseHandle(prochandle)
-                if result_close == 0:
-                    raise HackingOpException(f"CloseHandle failed for pid {pid:d}")
-        else:
-            raise HackingOpException(f"Could not find Talos in the process list")
+        logger.debug("Deleting %r", self)
+        self.close()
+
+    @property
+    def pid(self) -> int:
+        return self._pid
+
+    def close(self) -> None:
+        """Lets go of the attached process. Safe to call more than once."""
+        if getattr(self, "_process_handle", 0):
+            result_close: int = _kernel32.CloseHandle(self._process_handle)
+            logger.debug("Closed: %d", result_close)
+            self._process_handle = 0
+
+    def _find_talos(self, *, pid: Optional[int]=None) -> None:
+        """Attempt to find Talos in the process list.
+
+        If a PID is given, only that process is considered.
+        """
+        for found_pid, procmodule in enum_talos_processes(pid=pid):
+            self._pid: int = found_pid
+            self._image_base_offset: int = procmodule - 0x00400000
+            return
+        raise HackingOpException(f"Could not find Talos in the process list")
 
     def _attach_to_talos(self) -> None:
         """Attempt to attach to Talos."""
 
         self._process_handle: int = _kernel32.OpenProcess(
             c_uint32(0
+                | PROCESS_QUERY_INFORMATION
                 | PROCESS_VM_OPERATION
                 | PROCESS_VM_READ
                 | PROCESS_VM_WRITE
@@ -164,6 +236,12 @@ class WindowsDebugInterface(BaseDebugInterface):
 
     def read_memory(self, *, addr: int, length: int) -> bytes:
         """Read memory from the attached process."""
+        result_buf = bytearray(length)
+        self.read_into(addr=addr, buffer=result_buf)
+        return bytes(result_buf)
+
+    def read_into(self, *, addr: int, buffer: WritableBuffer) -> None:
+        """Fills a buffer with memory from the attached process, starting at addr, without any copies on the way."""
 
         # On the other hand, the Windows interface for actually hacking stuff is nice.
         #
@@ -176,11 +254,15 @@ class WindowsDebugInterface(BaseDebugInterface):
         #
         # THANKS SUN YOUR INTERFACE TOTALLY DOESN'T FUCKING SUCK BALLS
 
-        result_buf = (c_byte * length)()
+        view = memoryview(buffer).cast("B")
+        length: int = len(view)
+        if length == 0:
+            return
+        result_buf = (c_byte * length).from_buffer(view)
         number_of_bytes_read_buf = c_size_t(0)
         result_read: int = _kernel32.ReadProcessMemory(
             c_uint32(self._process_handle),
-            c_size_t(self.from_relative_addr(addr)),
+            c_size_t(addr),
             pointer(result_buf),
             c_size_t(sizeof(result_buf)),
             pointer(number_of_bytes_read_buf))
@@ -191,30 +273,67 @@ class WindowsDebugInterface(BaseDebugInterface):
         if number_of_bytes_read_buf.value == 0:
             raise HackingOpException(f"ReadProcessMemory couldn't read {length:d} bytes, it read {number_of_bytes_read_buf.value:d} bytes instead")
 
-        return bytes(result_buf)
-
     def write_memory(self, *, addr: int, data: bytes) -> None:
         """Write memory to the attached process."""
+        self.write_from(addr=addr, data=data)
+
+    def write_from(self, *, addr: int, data: ReadableBuffer) -> None:
+        """Writes any bytes-like object to the attached process, straight from where it is."""
 
-        # This approach is kinda disgusting to be honest...
-        result_buf = (c_byte * len(data))(*data)
+        # Used to build a c_byte array one byte at a time, which was kinda disgusting to be honest...
+        length: int = memoryview(data).nbytes
+        if length == 0:
+            return
+        data_addr, keep, = buffer_address(data)
 
         number_of_bytes_written_buf = c_size_t(0)
         result_read: int = _kernel32.WriteProcessMemory(
             c_size_t(self._process_handle),
-            c_size_t(self.from_relative_addr(addr)),
-            pointer(result_buf),
-            c_size_t(sizeof(result_buf)),
+            c_size_t(addr),
+            c_void_p(data_addr),
+            c_size_t(length),
             pointer(number_of_bytes_written_buf))
 
         if result_read == 0:
             raise HackingOpException(f"WriteProcessMemory failed")
 
         if number_of_bytes_written_buf.value == 0:
-            raise HackingOpException(f"WriteProcessMemory couldn't write {len(data):d} bytes, it wrote {number_of_bytes_written_buf.value:d} bytes instead")
+            raise HackingOpException(f"WriteProcessMemory couldn't write {length:d} bytes, it wrote {number_of_bytes_written_buf.value:d} bytes instead")
 
 
     def from_relative_addr(self, addr: int) -> int:
         """Converts a relative-to-intended-memory-base address to an absolute address."""
 
         return addr + self._image_base_offset
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        result: List[MemoryRegion] = []
+        info = MEMORY_BASIC_INFORMATION()
+        addr: int = 0
+        while True:
+            result_query: int = _kernel32.VirtualQueryEx(
+                c_size_t(self._process_handle),
+                c_size_t(addr),
+                pointer(info),
+                c_size_t(sizeof(info)))
+
+            if result_query == 0:
+                # We've walked off the end of the address space.
+                break
+
+            base: int = info.BaseAddress or 0
+            protect: int = info.Protect
+            if info.State == MEM_COMMIT and (protect & PAGE_GUARD) == 0 and (protect & PAGE_NOACCESS) == 0:
+                result.append(MemoryRegion(
+                    start=base,
+                    end=base + info.RegionSize,
+                    readable=((protect & _PAGE_READABLE) != 0),
+                    writable=((protect & _PAGE_WRITABLE) != 0),
+                    executable=((protect & _PAGE_EXECUTABLE) != 0)))
+
+            addr = base + info.RegionSize
+            if info.RegionSize == 0:
+                break
+
+        return result
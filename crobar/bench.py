@@ -0,0 +1,316 @@
+"""Benchmarks for the debugging backends, run against a stand-in Talos.
+
+`python -m crobar.bench` measures:
+- attach latency
+- read, read_into() and write throughput by transfer size, for each transfer backend
+- identification time
+- full patch-run time
+- full-process snapshot time, with and without compression, and reading back out of one
+- CLI startup time, how long crobar's own imports take, and how many version modules get loaded
+  just to start up (which should be none)
+
+Results get saved as JSON, and compared against the last run.
+Startup figures also have to stay within STARTUP_BUDGETS, however many versions we support.
+
+Each figure is the median of several runs, in microseconds per operation (lower is better),
+or in megabytes per second (higher is better).
+Linux only, since that's where the backends worth comparing are.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Type
+
+from crobar.arch.linux import LinuxDebugInterface
+from crobar.arch.linux_transfer import DEFAULT_TRANSFER_TYPES
+from crobar.arch.linux_transfer import MemoryTransfer
+from crobar.cache import CachingDebugInterface
+from crobar.identify import VersionIndex
+from crobar.patchplan import PatchPlan
+from crobar.patchplan import compile_plan
+from crobar.snapshot import SnapshotDebugInterface
+from crobar.snapshot import SnapshotStats
+from crobar.snapshot import take_snapshot
+from crobar.standin import StandinProcess
+from crobar.standin import python_env
+from crobar.versions import ALL_VERSIONS
+
+SIZES: Sequence[int] = (8, 64, 4096, 65536, 1024 * 1024, 16 * 1024 * 1024)
+
+# Peeking and poking a word at a time gets very slow very quickly.
+MAX_SIZES: Dict[str, int] = {
+    "ptrace": 65536,
+}
+
+# Keep going until either of these is reached, whichever's first
+MIN_REPEATS: int = 5
+MIN_TIME: float = 0.2
+
+# A change bigger than this between runs gets called out
+REGRESSION_THRESHOLD: float = 0.10
+
+# Startup figures which have to stay below these, regardless of how the last run did
+STARTUP_BUDGETS: Dict[str, float] = {
+    "startup.cli.us": 150000.0,
+    # Self time of every crobar module added up, not counting what they import
+    "startup.imports.us": 60000.0,
+    "startup.version_modules": 0.0,
+}
+
+# How many times to start the CLI, since each one takes a while
+STARTUP_REPEATS: int = 5
+
+
+def default_results_dir() -> str:
+    """Where results get saved, unless told otherwise."""
+    cache_home: str = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "crobar", "bench")
+
+
+def _measure(op: Callable[[], Any], *, setup: Optional[Callable[[], Any]]=None) -> float:
+    """Returns the median time taken by op, in seconds."""
+    times: List[float] = []
+    started: float = time.perf_counter()
+    while len(times) < MIN_REPEATS or time.perf_counter() - started < MIN_TIME:
+        if setup is not None:
+            setup()
+        start: float = time.perf_counter()
+        op()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def _attach(standin: StandinProcess, transfer_types: Sequence[Type[MemoryTransfer]]=DEFAULT_TRANSFER_TYPES) -> LinuxDebugInterface:
+    return LinuxDebugInterface(pid=standin.pid, relocate=False, transfer_types=transfer_types)
+
+
+def bench_attach(standin: StandinProcess, results: Dict[str, float]) -> None:
+    def attach_and_detach() -> None:
+        debug_interface: LinuxDebugInterface = _attach(standin)
+        debug_interface.close()
+    results["attach.us"] = _measure(attach_and_detach) * 1e6
+
+
+def bench_transfers(standin: StandinProcess, results: Dict[str, float]) -> None:
+    for transfer_type in DEFAULT_TRANSFER_TYPES:
+        debug_interface: LinuxDebugInterface = _attach(standin, [transfer_type])
+        try:
+            for size in SIZES:
+                if size > MAX_SIZES.get(transfer_type.name, size):
+                    continue
+                data: bytes = bytes(size)
+                buf = bytearray(size)
+                for direction, op, in (
+                        ("read", lambda: debug_interface.read_memory(addr=standin.image.scratch, length=size)),
+                        ("read_into", lambda: debug_interface.read_into(addr=standin.image.scratch, buffer=buf)),
+                        ("write", lambda: debug_interface.write_memory(addr=standin.image.scratch, data=data))):
+                    seconds: float = _measure(op)
+                    results[f"{direction}.{transfer_type.name}.{size:d}.us"] = seconds * 1e6
+                    results[f"{direction}.{transfer_type.name}.{size:d}.MB/s"] = size / seconds / 1e6
+        finally:
+            debug_interface.close()
+
+
+def bench_identify(standin: StandinProcess, results: Dict[str, float]) -> None:
+    debug_interface: LinuxDebugInterface = _attach(standin)
+    try:
+        index = VersionIndex(ALL_VERSIONS)
+        assert index.identify(debug_interface) is standin.image.version
+        results["identify.us"] = _measure(lambda: index.identify(debug_interface)) * 1e6
+    finally:
+        debug_interface.close()
+
+
+def bench_patch_run(standin: StandinProcess, results: Dict[str, float]) -> None:
+    """Times everything from attaching to having applied every patch."""
+    debug_interface: Optional[LinuxDebugInterface] = None
+
+    def revert() -> None:
+        nonlocal debug_interface
+        if debug_interface is not None:
+            debug_interface.close()
+            debug_interface = None
+        # Put it back as it was, without timing it.
+        cleanup: LinuxDebugInterface = _attach(standin)
+        compile_plan(cleanup, standin.image.version(debug_interface=cleanup).get_patch_manifest()).revert(cleanup)
+        cleanup.close()
+
+    def patch_run() -> None:
+        nonlocal debug_interface
+        debug_interface = _attach(standin)
+        cached_interface = CachingDebugInterface(debug_interface)
+        version_type = VersionIndex(ALL_VERSIONS).identify(cached_interface)
+        assert version_type is not None
+        plan: PatchPlan = compile_plan(cached_interface, version_type(debug_interface=cached_interface).get_patch_manifest())
+        plan.apply(debug_interface)
+
+    results["patch_run.us"] = _measure(patch_run, setup=revert) * 1e6
+    revert()
+
+
+def bench_snapshot(standin: StandinProcess, results: Dict[str, float]) -> None:
+    debug_interface: LinuxDebugInterface = _attach(standin)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path: str = os.path.join(tmp_dir, "snapshot")
+            for compress in (False, True):
+                label: str = "compressed" if compress else "raw"
+                stats: List[SnapshotStats] = []
+                results[f"snapshot.{label}.us"] = _measure(
+                    lambda: stats.append(take_snapshot(debug_interface, path, compress=compress))) * 1e6
+                results[f"snapshot.{label}.MB/s"] = stats[-1].mapped_bytes / (results[f"snapshot.{label}.us"] / 1e6) / 1e6
+                results[f"snapshot.{label}.stored.MB"] = os.path.getsize(path) / 1e6
+
+            snapshot = SnapshotDebugInterface(path)
+            try:
+                index = VersionIndex(ALL_VERSIONS)
+                assert index.identify(snapshot) is standin.image.version
+                results["snapshot.identify.us"] = _measure(lambda: index.identify(snapshot)) * 1e6
+            finally:
+                snapshot.close()
+    finally:
+        debug_interface.close()
+
+
+def _run_python(*args: str) -> "subprocess.CompletedProcess[str]":
+    """Runs a fresh Python, with crobar importable from wherever this one got it."""
+    return subprocess.run([sys.executable, *args], env=python_env(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+
+
+def bench_startup(standin: StandinProcess, results: Dict[str, float]) -> None:
+    """Times the CLI getting as far as printing its help, less however long Python takes to start at all."""
+    def median_run(*args: str) -> float:
+        times: List[float] = []
+        for idx in range(STARTUP_REPEATS):
+            start: float = time.perf_counter()
+            _run_python(*args)
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+
+    results["startup.cli.us"] = max(0.0, median_run("-m", "crobar", "--help") - median_run("-c", "pass")) * 1e6
+
+    # Each line of -X importtime is "import time: self | cumulative | name", indented by depth.
+    # startup.imports.us adds up the self column of every crobar module, however deeply it got imported,
+    # so it's the time spent in our own modules, and not in whatever they import.
+    imports_us: float = 0.0
+    version_modules: int = 0
+    for line in _run_python("-X", "importtime", "-m", "crobar", "--help").stderr.splitlines():
+        parts: List[str] = line.split("|")
+        if len(parts) != 3 or not parts[0].split(":")[-1].strip().isdigit():
+            continue
+        name: str = parts[2].strip()
+        if name == "crobar" or name.startswith("crobar."):
+            imports_us += float(parts[0].split(":")[-1])
+        if name.startswith("crobar.versions.v"):
+            version_modules += 1
+    results["startup.imports.us"] = imports_us
+    results["startup.version_modules"] = float(version_modules)
+
+
+BENCHMARKS: Dict[str, Callable[[StandinProcess, Dict[str, float]], None]] = {
+    "attach": bench_attach,
+    "transfers": bench_transfers,
+    "identify": bench_identify,
+    "patch_run": bench_patch_run,
+    "snapshot": bench_snapshot,
+    "startup": bench_startup,
+}
+
+
+def run_benchmarks(names: Optional[Sequence[str]]=None, *, threads: int=4) -> Dict[str, Any]:
+    """Runs benchmarks against a fresh stand-in, and returns the results with some context."""
+    results: Dict[str, float] = {}
+    with StandinProcess(threads=threads) as standin:
+        for name in (names or list(BENCHMARKS)):
+            print(f"Running {name}")
+            BENCHMARKS[name](standin, results)
+    return {
+        "time": time.time(),
+        "host": platform.node(),
+        "kernel": platform.release(),
+        "python": platform.python_version(),
+        "standin_threads": threads,
+        "results": results,
+    }
+
+
+def compare(old: Dict[str, float], new: Dict[str, float]) -> List[str]:
+    """Describes how each figure changed between two runs, flagging anything that got worse."""
+    lines: List[str] = []
+    for key, value in new.items():
+        old_value: Optional[float] = old.get(key)
+        if not old_value:
+            lines.append(f"{key:>32}: {value:12.3f}")
+            continue
+        change: float = (value - old_value) / old_value
+        # Throughput going down is bad. Everything else going up is bad.
+        worse: bool = (change < -REGRESSION_THRESHOLD) if key.endswith("MB/s") else (change > REGRESSION_THRESHOLD)
+        lines.append(f"{key:>32}: {value:12.3f} ({change*100.0:+6.1f}%){' REGRESSED' if worse else ''}")
+    return lines
+
+
+def over_budget(results: Dict[str, float]) -> List[str]:
+    """Describes every startup figure that's over its budget."""
+    return [
+        f"{key:>32}: {results[key]:12.3f} OVER BUDGET of {budget:.3f}"
+        for key, budget in STARTUP_BUDGETS.items()
+        if key in results and results[key] > budget]
+
+
+def _latest_results(results_dir: str) -> Optional[str]:
+    try:
+        names: List[str] = sorted(name for name in os.listdir(results_dir) if name.endswith(".json"))
+    except FileNotFoundError:
+        return None
+    return os.path.join(results_dir, names[-1]) if names else None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="crobar.bench", description="Benchmark crobar's backends against a stand-in Talos.")
+    parser.add_argument("benchmarks", nargs="*", help=f"which benchmarks to run, out of {', '.join(BENCHMARKS)} (default: all of them)")
+    parser.add_argument("--threads", type=int, default=4, help="how many extra threads the stand-in runs (default: %(default)s)")
+    parser.add_argument("--results-dir", default=default_results_dir(), help="where results are kept (default: %(default)s)")
+    parser.add_argument("--compare", metavar="PATH", help="compare against these results instead of the last run")
+    parser.add_argument("--no-save", action="store_true", help="don't save the results")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"no benchmark called {name!r}")
+
+    baseline_path: Optional[str] = args.compare or _latest_results(args.results_dir)
+    run: Dict[str, Any] = run_benchmarks(args.benchmarks, threads=args.threads)
+
+    baseline: Dict[str, float] = {}
+    if baseline_path is not None:
+        with open(baseline_path, "r") as fp:
+            baseline = json.load(fp)["results"]
+        print(f"Compared with {baseline_path}")
+    lines: List[str] = compare(baseline, run["results"])
+    lines += over_budget(run["results"])
+    for line in lines:
+        print(line)
+
+    if not args.no_save:
+        os.makedirs(args.results_dir, exist_ok=True)
+        path: str = os.path.join(args.results_dir, time.strftime("%Y%m%d-%H%M%S.json", time.localtime(run["time"])))
+        with open(path, "w") as fp:
+            json.dump(run, fp, indent=1, sort_keys=True)
+        print(f"Saved results to {path}")
+
+    sys.exit(1 if any(line.endswith(" REGRESSED") or " OVER BUDGET " in line for line in lines) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Just enough executable format parsing to find our way around a Talos binary."""
+from abc import ABCMeta
+from abc import abstractmethod
+import mmap
+import struct
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+
+ET_EXEC = 2
+ET_DYN = 3
+
+PT_LOAD = 1
+PT_NOTE = 4
+
+NT_GNU_BUILD_ID = 3
+
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+
+class BinaryFormatException(HackingOpException):
+    """Fires whenever an executable doesn't look like what we expected."""
+    __slots__ = ()
+
+
+class ElfSegment(NamedTuple):
+    type: int
+    flags: int
+    offset: int
+    vaddr: int
+    filesz: int
+    memsz: int
+    align: int
+
+
+class ExecutableImage(metaclass=ABCMeta):
+    """A parsed executable file, which knows where each of its bytes gets loaded."""
+    __slots__ = ()
+
+    data: bytes
+
+    @abstractmethod
+    def vaddr_to_offset(self, vaddr: int) -> Optional[int]:
+        """Returns where in the file the byte linked at vaddr lives, or None if it isn't in the file."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_memory_regions(self) -> List[MemoryRegion]:
+        """Returns the parts of the file that get loaded, at the addresses they were linked at, lowest first."""
+        raise NotImplementedError()
+
+    def read_vaddr(self, vaddr: int, length: int) -> Optional[bytes]:
+        """Returns the bytes linked at vaddr, or None if they aren't all in the file."""
+        offset: Optional[int] = self.vaddr_to_offset(vaddr)
+        if offset is None or self.vaddr_to_offset(vaddr + length - 1) != offset + length - 1:
+            return None
+        return bytes(self.data[offset:offset+length])
+
+
+class ElfImage(ExecutableImage):
+    """A parsed ELF executable, backed by anything that supports the buffer protocol."""
+    __slots__ = (
+        "data",
+        "bits",
+        "endian",
+        "type",
+        "segments",
+    )
+
+    def __init__(self, data: bytes) -> None:
+        if data[:4] != b"\x7fELF":
+            raise BinaryFormatException("not an ELF file")
+
+        self.data = data
+        self.bits: int = {1: 32, 2: 64}.get(data[4], 0)
+        if self.bits == 0:
+            raise BinaryFormatException(f"unknown ELF class {data[4]:d}")
+        self.endian: str = {1: "<", 2: ">"}.get(data[5], "")
+        if self.endian == "":
+            raise BinaryFormatException(f"unknown ELF data encoding {data[5]:d}")
+
+        e_phoff: int
+        e_phentsize: int
+        e_phnum: int
+        if self.bits == 32:
+            self.type, e_phoff, = struct.unpack_from(self.endian + "H10xI", data, 16)
+            e_phentsize, e_phnum, = struct.unpack_from(self.endian + "HH", data, 42)
+        else:
+            self.type, e_phoff, = struct.unpack_from(self.endian + "H14xQ", data, 16)
+            e_phentsize, e_phnum, = struct.unpack_from(self.endian + "HH", data, 54)
+
+        self.segments: List[ElfSegment] = []
+        for idx in range(e_phnum):
+            offs: int = e_phoff + idx*e_phentsize
+            if self.bits == 32:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align, = struct.unpack_from(
+                    self.endian + "8I", data, offs)
+            else:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align, = struct.unpack_from(
+                    self.endian + "II6Q", data, offs)
+            self.segments.append(ElfSegment(
+                type=p_type,
+                flags=p_flags,
+                offset=p_offset,
+                vaddr=p_vaddr,
+                filesz=p_filesz,
+                memsz=p_memsz,
+                align=p_align))
+
+    @classmethod
+    def from_path(cls, path: str) -> "ElfImage":
+        """Maps an ELF file read-only and parses it."""
+        with open(path, "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data)  # type: ignore[arg-type]
+
+    @property
+    def is_position_independent(self) -> bool:
+        """True if the loader gets to pick where this goes."""
+        return self.type == ET_DYN
+
+    @property
+    def load_base(self) -> int:
+        """The address the first loadable segment was linked at, rounded down to a page."""
+        loads: List[ElfSegment] = [segment for segment in self.segments if segment.type == PT_LOAD]
+        if not loads:
+            raise BinaryFormatException("no loadable segments")
+        return min(segment.vaddr & ~0xFFF for segment in loads)
+
+    def vaddr_to_offset(self, vaddr: int) -> Optional[int]:
+        """Returns where in the file the byte linked at vaddr lives, or None if it isn't in the file."""
+        for segment in self.segments:
+            if segment.type == PT_LOAD and segment.vaddr <= vaddr < segment.vaddr + segment.filesz:
+                return segment.offset + (vaddr - segment.vaddr)
+        return None
+
+    def get_memory_regions(self) -> List[MemoryRegion]:
+        """Returns the parts of the file that get loaded, at the addresses they were linked at, lowest first."""
+        return sorted(
+            (
+                MemoryRegion(
+                    start=segment.vaddr,
+                    end=segment.vaddr + segment.filesz,
+                    readable=((segment.flags & PF_R) != 0),
+                    writable=((segment.flags & PF_W) != 0),
+                    executable=((segment.flags & PF_X) != 0),
+                    offset=segment.offset)
+                for segment in self.segments
+                if segment.type == PT_LOAD and segment.filesz > 0),
+            key=lambda region: region.start)
+
+    @property
+    def build_id(self) -> Optional[bytes]:
+        """The GNU build ID the linker stamped on this, if it did."""
+        for segment in self.segments:
+            if segment.type != PT_NOTE:
+                continue
+            offs: int = segment.offset
+            end: int = segment.offset + segment.filesz
+            # Notes are (namesz, descsz, type), then the name and desc, each padded to 4 bytes.
+            while offs + 12 <= end:
+                namesz, descsz, note_type, = struct.unpack_from(self.endian + "III", self.data, offs)
+                name_offs: int = offs + 12
+                desc_offs: int = name_offs + ((namesz + 3) & ~3)
+                if note_type == NT_GNU_BUILD_ID and self.data[name_offs:name_offs+namesz] == b"GNU\x00":
+                    return bytes(self.data[desc_offs:desc_offs+descsz])
+                offs = desc_offs + ((descsz + 3) & ~3)
+        return None
+
+
+class PeSection(NamedTuple):
+    name: bytes
+    virtual_address: int
+    virtual_size: int
+    raw_offset: int
+    raw_size: int
+    characteristics: int
+
+
+IMAGE_SCN_MEM_EXECUTE = 0x20000000
+IMAGE_SCN_MEM_READ = 0x40000000
+IMAGE_SCN_MEM_WRITE = 0x80000000
+
+
+class PeImage(ExecutableImage):
+    """A parsed PE executable, backed by anything that supports the buffer protocol."""
+    __slots__ = (
+        "data",
+        "bits",
+        "image_base",
+        "headers_size",
+        "sections",
+    )
+
+    def __init__(self, data: bytes) -> None:
+        if data[:2] != b"MZ":
+            raise BinaryFormatException("not a PE file")
+
+        self.data = data
+        e_lfanew: int
+        e_lfanew, = struct.unpack_from("<I", data, 0x3C)
+        if data[e_lfanew:e_lfanew+4] != b"PE\x00\x00":
+            raise BinaryFormatException("MZ file without a PE header")
+
+        # COFF file header, then the optional header, then the section table.
+        number_of_sections: int
+        size_of_optional_header: int
+        number_of_sections, = struct.unpack_from("<H", data, e_lfanew + 6)
+        size_of_optional_header, = struct.unpack_from("<H", data, e_lfanew + 20)
+        optional_header: int = e_lfanew + 24
+        magic: int
+        magic, = struct.unpack_from("<H", data, optional_header)
+        if magic == 0x10B:
+            self.bits: int = 32
+            self.image_base: int = struct.unpack_from("<I", data, optional_header + 28)[0]
+        elif magic == 0x20B:
+            self.bits = 64
+            self.image_base = struct.unpack_from("<Q", data, optional_header + 24)[0]
+        else:
+            raise BinaryFormatException(f"unknown PE optional header magic 0x{magic:x}")
+        self.headers_size: int = struct.unpack_from("<I", data, optional_header + 60)[0]
+
+        self.sections: List[PeSection] = []
+        section_table: int = optional_header + size_of_optional_header
+        for idx in range(number_of_sections):
+            name, virtual_size, virtual_address, raw_size, raw_offset, = struct.unpack_from(
+                "<8sIIII", data, section_table + idx*40)
+            characteristics: int
+            characteristics, = struct.unpack_from("<I", data, section_table + idx*40 + 36)
+            self.sections.append(PeSection(
+                name=name.rstrip(b"\x00"),
+                virtual_address=virtual_address,
+                virtual_size=virtual_size,
+                raw_offset=raw_offset,
+                raw_size=raw_size,
+                characteristics=characteristics))
+
+    @classmethod
+    def from_path(cls, path: str) -> "PeImage":
+        """Maps a PE file read-only and parses it."""
+        with open(path, "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data)  # type: ignore[arg-type]
+
+    def _loaded_size(self, section: PeSection) -> int:
+        # Anything past the raw data is zero-filled, not in the file.
+        return min(section.virtual_size or section.raw_size, section.raw_size)
+
+    def vaddr_to_offset(self, vaddr: int) -> Optional[int]:
+        """Returns where in the file the byte linked at vaddr lives, or None if it isn't in the file."""
+        rva: int = vaddr - self.image_base
+        if 0 <= rva < self.headers_size:
+            return rva
+        for section in self.sections:
+            if section.virtual_address <= rva < section.virtual_address + self._loaded_size(section):
+                return section.raw_offset + (rva - section.virtual_address)
+        return None
+
+    def get_memory_regions(self) -> List[MemoryRegion]:
+        """Returns the parts of the file that get loaded, at the addresses they were linked at, lowest first."""
+        result: List[MemoryRegion] = [
+            MemoryRegion(
+                start=self.image_base,
+                end=self.image_base + self.headers_size,
+                readable=True,
+                writable=False,
+                executable=False)]
+        for section in self.sections:
+            if self._loaded_size(section) > 0:
+                result.append(MemoryRegion(
+                    start=self.image_base + section.virtual_address,
+                    end=self.image_base + section.virtual_address + self._loaded_size(section),
+                    readable=((section.characteristics & IMAGE_SCN_MEM_READ) != 0),
+                    writable=((section.characteristics & IMAGE_SCN_MEM_WRITE) != 0),
+                    executable=((section.characteristics & IMAGE_SCN_MEM_EXECUTE) != 0),
+                    offset=section.raw_offset))
+        result.sort(key=lambda region: region.start)
+        return result
+
+
+def parse_image(data: bytes) -> ExecutableImage:
+    """Parses an executable, whichever format it's in."""
+    if data[:4] == b"\x7fELF":
+        return ElfImage(data)
+    elif data[:2] == b"MZ":
+        return PeImage(data)
+    else:
+        raise BinaryFormatException("not an executable format we know")
+
+
+def open_image(path: str) -> ExecutableImage:
+    """Maps an executable file read-only and parses it, whichever format it's in."""
+    with open(path, "rb") as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return parse_image(data)  # type: ignore[arg-type]
@@ -0,0 +1,142 @@
+"""Reusable buffers, for reading into with DebugInterface.read_into().
+
+read_memory() hands back fresh bytes every time, which is fine for one-offs,
+but a loop that reads the same sizes over and over just churns through memory.
+Borrow a buffer from a BufferPool instead, read into it, and give it back:
+
+    with pool.borrow(length) as buf:
+        debug_interface.read_into(addr=addr, buffer=buf)
+        ...
+
+Buffers are kept by exact length, since hot loops tend to ask for the same few sizes.
+Anything still holding on to a buffer after giving it back will see it get overwritten,
+so copy out whatever needs to outlive the with block.
+
+read_pages_into() is for when a big read fails, and whatever can be read of it is still wanted.
+"""
+import contextlib
+import threading
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+
+# How many spare buffers of each length to keep
+DEFAULT_MAX_FREE: int = 8
+
+# How many bytes of spare buffers to keep, across every length
+DEFAULT_MAX_BYTES: int = 64 * 1024 * 1024
+
+PAGE_SIZE: int = 0x1000
+
+
+class BufferStats:
+    """Counters for how often the pool actually had something to hand out."""
+    __slots__ = (
+        "acquires",
+        "allocations",
+        "discards",
+    )
+
+    def __init__(self) -> None:
+        self.acquires: int = 0
+        # Acquires the pool couldn't satisfy from a spare buffer
+        self.allocations: int = 0
+        # Buffers given back, but dropped because the pool was full
+        self.discards: int = 0
+
+    def __repr__(self) -> str:
+        return f"{self.acquires:d} acquires, {self.allocations:d} allocations, {self.discards:d} discards"
+
+
+class BufferPool:
+    """Hands out bytearrays, and keeps them once they're given back to hand out again.
+
+    Safe to share between threads.
+    """
+    __slots__ = (
+        "stats",
+        "max_free",
+        "max_bytes",
+        "_free",
+        "_free_bytes",
+        "_lock",
+    )
+
+    def __init__(self, *, max_free: int=DEFAULT_MAX_FREE, max_bytes: int=DEFAULT_MAX_BYTES) -> None:
+        self.stats = BufferStats()
+        self.max_free = max_free
+        self.max_bytes = max_bytes
+        self._free: Dict[int, List[bytearray]] = {}
+        self._free_bytes: int = 0
+        self._lock = threading.Lock()
+
+    @property
+    def free_bytes(self) -> int:
+        """How many bytes of spare buffers the pool is holding on to."""
+        return self._free_bytes
+
+    def acquire(self, length: int) -> bytearray:
+        """Returns a buffer exactly length bytes long. Whatever was in it last is still there."""
+        with self._lock:
+            self.stats.acquires += 1
+            free: List[bytearray] = self._free.get(length, [])
+            if free:
+                self._free_bytes -= length
+                return free.pop()
+            self.stats.allocations += 1
+        return bytearray(length)
+
+    def release(self, buf: bytearray) -> None:
+        """Gives a buffer back. Don't use it again afterwards."""
+        length: int = len(buf)
+        with self._lock:
+            free: List[bytearray] = self._free.setdefault(length, [])
+            if len(free) >= self.max_free or self._free_bytes + length > self.max_bytes:
+                self.stats.discards += 1
+                return
+            free.append(buf)
+            self._free_bytes += length
+
+    @contextlib.contextmanager
+    def borrow(self, length: int) -> Iterator[bytearray]:
+        """Acquires a buffer for the length of a with block."""
+        buf: bytearray = self.acquire(length)
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def clear(self) -> None:
+        """Drops every spare buffer."""
+        with self._lock:
+            self._free = {}
+            self._free_bytes = 0
+
+
+def read_pages_into(debug_interface: DebugInterface, *, addr: int, buffer: bytearray) -> List[Tuple[int, int]]:
+    """Reads a page at a time, skipping pages that can't be read.
+
+    Returns (start, end) offsets into buffer of each run that was read. Anything else is left as it was.
+    Call this from the thread that attached, like read_into().
+    """
+    readable: List[Tuple[int, int]] = []
+    with memoryview(buffer) as view:
+        # Pages are counted from addr's page, so that every read stays within one.
+        offs: int = 0
+        while offs < len(buffer):
+            piece: int = min(PAGE_SIZE - ((addr + offs) & (PAGE_SIZE-1)), len(buffer) - offs)
+            try:
+                debug_interface.read_into(addr=addr + offs, buffer=view[offs:offs+piece])
+            except HackingOpException:
+                pass
+            else:
+                if readable and readable[-1][1] == offs:
+                    readable[-1] = (readable[-1][0], offs + piece)
+                else:
+                    readable.append((offs, offs + piece))
+            offs += piece
+    return readable
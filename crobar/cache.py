@@ -0,0 +1,220 @@
+"""Page cache for debugging interfaces.
+
+Wrap a DebugInterface in a CachingDebugInterface, and repeated reads of the same
+pages get served from here instead of going back to the target process.
+
+The game doesn't stop changing its memory just because we've cached it,
+so anything long-running needs to call new_epoch() whenever it wants fresh data.
+"""
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import MemoryRegion
+from crobar.arch.base import BaseDebugInterface
+
+DEFAULT_PAGE_SIZE: int = 0x1000
+DEFAULT_MAX_BYTES: int = 4 * 1024 * 1024
+
+
+class CacheStats:
+    """Counters for how well the cache is doing."""
+    __slots__ = (
+        "hits",
+        "misses",
+        "evictions",
+        "invalidations",
+        "bypasses",
+    )
+
+    def __init__(self) -> None:
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+        # Reads which couldn't be done a page at a time, and went straight through
+        self.bypasses: int = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.hits:d} hits, {self.misses:d} misses, {self.evictions:d} evictions, "
+            f"{self.invalidations:d} invalidations, {self.bypasses:d} bypasses")
+
+
+class CachingDebugInterface(BaseDebugInterface):
+    """Caches reads from another DebugInterface a page at a time, least recently used first out."""
+    __slots__ = (
+        "stats",
+        "_inner",
+        "_page_size",
+        "_max_bytes",
+        "_epoch",
+        "_pages",
+    )
+
+    def __init__(
+            self,
+            inner: DebugInterface,
+            *,
+            page_size: int=DEFAULT_PAGE_SIZE,
+            max_bytes: int=DEFAULT_MAX_BYTES) -> None:
+        assert page_size > 0 and (page_size & (page_size-1)) == 0
+        self.stats = CacheStats()
+        self._inner = inner
+        self._page_size = page_size
+        self._max_bytes = max_bytes
+        self._epoch: int = 0
+        # Page number -> (epoch it was read in, contents), oldest use first
+        self._pages: "OrderedDict[int, Tuple[int, bytes]]" = OrderedDict()
+
+    @property
+    def inner(self) -> DebugInterface:
+        """The DebugInterface we're caching."""
+        return self._inner
+
+    def close(self) -> None:
+        """Lets go of the attached process. Safe to call more than once."""
+        self._inner.close()
+
+    @property
+    def epoch(self) -> int:
+        """The current epoch. Pages read in earlier epochs are stale."""
+        return self._epoch
+
+    @property
+    def cached_bytes(self) -> int:
+        return len(self._pages) * self._page_size
+
+    def new_epoch(self) -> int:
+        """Marks everything cached so far as stale. Returns the new epoch."""
+        self._epoch += 1
+        self.stats.invalidations += 1
+        return self._epoch
+
+    def invalidate(self, *, addr: int, length: int) -> None:
+        """Forgets any cached pages overlapping the given range."""
+        for page in self._pages_of(addr=addr, length=length):
+            self._pages.pop(page, None)
+
+    def _pages_of(self, *, addr: int, length: int) -> range:
+        return range(addr // self._page_size, (addr + max(length, 1) - 1) // self._page_size + 1)
+
+    def _lookup(self, page: int) -> Optional[bytes]:
+        entry: Optional[Tuple[int, bytes]] = self._pages.get(page)
+        if entry is None or entry[0] != self._epoch:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self._pages.move_to_end(page)
+        return entry[1]
+
+    def _store(self, page: int, data: bytes) -> None:
+        self._pages[page] = (self._epoch, data)
+        self._pages.move_to_end(page)
+        while len(self._pages) * self._page_size > self._max_bytes:
+            self._pages.popitem(last=False)
+            self.stats.evictions += 1
+
+    def _fetch_pages(self, pages: Set[int]) -> Dict[int, Optional[bytes]]:
+        """Returns the contents of each page, reading any misses in one batch."""
+        result: Dict[int, Optional[bytes]] = {}
+        missing: List[int] = []
+        for page in sorted(pages):
+            data: Optional[bytes] = self._lookup(page)
+            if data is None:
+                missing.append(page)
+            result[page] = data
+
+        if missing:
+            fetched: List[Optional[bytes]] = self._inner.read_many(
+                ranges=[(page * self._page_size, self._page_size) for page in missing],
+                max_gap=0)
+            for page, page_data in zip(missing, fetched):
+                result[page] = page_data
+                if page_data is not None:
+                    self._store(page, page_data)
+
+        return result
+
+    def _assemble(self, *, addr: int, length: int, pages: Dict[int, Optional[bytes]]) -> Optional[bytes]:
+        chunks: List[bytes] = []
+        for page in self._pages_of(addr=addr, length=length):
+            page_data: Optional[bytes] = pages[page]
+            if page_data is None:
+                return None
+            chunks.append(page_data)
+        offs: int = addr - (addr // self._page_size) * self._page_size
+        return b"".join(chunks)[offs:offs+length]
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory from the attached process."""
+        if length <= 0:
+            return b""
+        pages: Dict[int, Optional[bytes]] = self._fetch_pages(set(self._pages_of(addr=addr, length=length)))
+        result: Optional[bytes] = self._assemble(addr=addr, length=length, pages=pages)
+        if result is None:
+            # Some of the page isn't readable. Try the exact range instead.
+            self.stats.bypasses += 1
+            return self._inner.read_memory(addr=addr, length=length)
+        return result
+
+    def read_many(self, *, ranges: Sequence[Tuple[int, int]], max_gap: Optional[int]=None) -> List[Optional[bytes]]:
+        """Read several (address, length) ranges from the attached process in one go.
+
+        Every page needed by every range gets fetched in a single batch.
+        """
+        wanted: Set[int] = set()
+        for addr, length in ranges:
+            if length > 0:
+                wanted.update(self._pages_of(addr=addr, length=length))
+        pages: Dict[int, Optional[bytes]] = self._fetch_pages(wanted)
+
+        result: List[Optional[bytes]] = []
+        bypass: List[int] = []
+        for idx, (addr, length) in enumerate(ranges):
+            if length <= 0:
+                result.append(b"")
+                continue
+            data: Optional[bytes] = self._assemble(addr=addr, length=length, pages=pages)
+            if data is None:
+                bypass.append(idx)
+            result.append(data)
+
+        if bypass:
+            self.stats.bypasses += len(bypass)
+            for idx, data in zip(bypass, self._inner.read_many(ranges=[ranges[idx] for idx in bypass], max_gap=max_gap)):
+                result[idx] = data
+
+        return result
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Write memory to the attached process."""
+        try:
+            self._inner.write_memory(addr=addr, data=data)
+        finally:
+            self.invalidate(addr=addr, length=len(data))
+
+    def write_many(self, *, chunks: Sequence[Tuple[int, bytes]], max_gap: Optional[int]=None) -> None:
+        """Write several (address, data) chunks to the attached process in one go."""
+        try:
+            self._inner.write_many(chunks=chunks, max_gap=max_gap)
+        finally:
+            for addr, data in chunks:
+                self.invalidate(addr=addr, length=len(data))
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        return self._inner.from_relative_addr(addr)
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        return self._inner.get_memory_regions()
+
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        return self._inner.get_executable_path()
@@ -0,0 +1,235 @@
+"""Keeping patches patched, after the game's had a chance to put things back.
+
+The game can rewrite or reload the code we patched long after we've patched it.
+Rather than finding out from a crash or a refused map vote,
+a PatchGuard checks every patched range every so often, and patches again whatever got put back.
+
+Each check is a single read_many() of every site, run through zlib.crc32() as it comes in.
+If the combined checksum matches, that's the whole check.
+Only if it doesn't do the sites get compared one by one, to find which ones drifted.
+
+Only sites which have gone back to their old bytes get patched again.
+Anything else is something we don't understand, so it gets reported (once, until it changes again) and left alone.
+
+Guard the raw debug interface, not a caching one, or nothing will ever drift.
+"""
+import collections
+import logging
+import threading
+import time
+import zlib
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import PatchSite
+from crobar.metrics import Metrics
+from crobar.patchplan import PatchPlan
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL: float = 5.0
+
+# How many drifts to remember
+MAX_EVENTS: int = 100
+
+# What happened to a site that drifted
+DRIFT_REPAIRED = "repaired"
+# It went back to its old bytes, but patching it again didn't stick
+DRIFT_FAILED = "failed"
+# It's neither old nor new, so we left it alone
+DRIFT_UNKNOWN = "unknown"
+# It couldn't be read at all
+DRIFT_UNREADABLE = "unreadable"
+
+
+class GuardedSite(NamedTuple):
+    """One patched range, and the checksum of what should be there."""
+    name: str
+    site: PatchSite
+    crc: int
+
+
+class DriftEvent(NamedTuple):
+    """A patched range found not to be patched any more."""
+    name: str
+    addr: int
+    # What was there instead, or None if it couldn't be read
+    found: Optional[bytes]
+    outcome: str
+    # time.monotonic() when the check that found it started
+    time: float
+
+
+class GuardStats:
+    """Counters for what the guard's been up to."""
+    __slots__ = (
+        "checks",
+        "drifts",
+        "repairs",
+        "busy_time",
+        "max_time",
+    )
+
+    def __init__(self) -> None:
+        self.checks: int = 0
+        self.drifts: int = 0
+        self.repairs: int = 0
+        self.busy_time: float = 0.0
+        self.max_time: float = 0.0
+
+    def __repr__(self) -> str:
+        mean: float = self.busy_time / self.checks if self.checks else 0.0
+        return (
+            f"{self.checks:d} checks, {self.drifts:d} drifts, {self.repairs:d} repairs, "
+            f"{mean*1e6:.0f} us mean, {self.max_time*1e6:.0f} us max per check")
+
+
+class PatchGuard:
+    """Checks that a plan's patches are still in place, and puts back any that aren't."""
+    __slots__ = (
+        "interval",
+        "stats",
+        "events",
+        "_debug_interface",
+        "_metrics",
+        "_sites",
+        "_ranges",
+        "_crc",
+        "_stuck",
+    )
+
+    def __init__(
+            self,
+            debug_interface: DebugInterface,
+            plan: PatchPlan,
+            *,
+            interval: float=DEFAULT_INTERVAL,
+            metrics: Optional[Metrics]=None) -> None:
+        """Guards every site in the plan, which should already have been applied."""
+        self.interval = interval
+        self.stats = GuardStats()
+        # The most recent drifts, oldest first
+        self.events: Deque[DriftEvent] = collections.deque(maxlen=MAX_EVENTS)
+        self._debug_interface = debug_interface
+        self._metrics = metrics
+        self._sites: List[GuardedSite] = [
+            GuardedSite(name=step.name, site=site, crc=zlib.crc32(site.new))
+            for step in plan.steps
+            for site in step.sites]
+        self._ranges: List[Tuple[int, int]] = [(guarded.site.addr, len(guarded.site.new)) for guarded in self._sites]
+        # What the whole lot comes to when every site is patched
+        self._crc: int = 0
+        for guarded in self._sites:
+            self._crc = zlib.crc32(guarded.site.new, self._crc)
+        # Sites we couldn't do anything about, and what we found there, so they only get reported once
+        self._stuck: Dict[int, Optional[bytes]] = {}
+
+    @property
+    def sites(self) -> Sequence[GuardedSite]:
+        return self._sites
+
+    def check(self) -> List[DriftEvent]:
+        """Reads every site once, patches again whatever went back to its old bytes, and returns what drifted."""
+        start: float = time.monotonic()
+        raw: List[Optional[bytes]] = self._debug_interface.read_many(ranges=self._ranges)
+        crc: int = 0
+        for data in raw:
+            if data is None:
+                crc = -1
+                break
+            crc = zlib.crc32(data, crc)
+
+        events: List[DriftEvent] = []
+        if crc != self._crc:
+            events = self._repair(raw, start)
+        elif self._stuck:
+            self._stuck = {}
+
+        elapsed: float = time.monotonic() - start
+        self.stats.checks += 1
+        self.stats.busy_time += elapsed
+        self.stats.max_time = max(self.stats.max_time, elapsed)
+        if self._metrics is not None:
+            self._metrics.count("crobar_guard_checks_total")
+            self._metrics.observe("crobar_guard_check_seconds", elapsed)
+        return events
+
+    def _repair(self, raw: List[Optional[bytes]], start: float) -> List[DriftEvent]:
+        drifted: List[Tuple[GuardedSite, Optional[bytes]]] = [
+            (guarded, data)
+            for guarded, data, in zip(self._sites, raw)
+            if data is None or zlib.crc32(data) != guarded.crc]
+        drifted_addrs: Set[int] = {guarded.site.addr for guarded, data, in drifted}
+        self._stuck = {addr: data for addr, data in self._stuck.items() if addr in drifted_addrs}
+        drifted = [
+            (guarded, data)
+            for guarded, data, in drifted
+            if guarded.site.addr not in self._stuck or self._stuck[guarded.site.addr] != data]
+        writes: List[GuardedSite] = [guarded for guarded, data, in drifted if data == guarded.site.old]
+
+        repaired: List[bool] = []
+        if writes:
+            try:
+                self._debug_interface.write_many(chunks=[(guarded.site.addr, guarded.site.new) for guarded in writes])
+                check: List[Optional[bytes]] = self._debug_interface.read_many(
+                    ranges=[(guarded.site.addr, len(guarded.site.new)) for guarded in writes])
+                repaired = [data == guarded.site.new for guarded, data, in zip(writes, check)]
+            except HackingOpException as e:
+                logger.warning("Could not patch again: %s", e)
+        repaired_addrs: Set[int] = {guarded.site.addr for guarded, ok, in zip(writes, repaired) if ok}
+
+        events: List[DriftEvent] = []
+        for guarded, data in drifted:
+            outcome: str
+            if data is None:
+                outcome = DRIFT_UNREADABLE
+            elif data != guarded.site.old:
+                outcome = DRIFT_UNKNOWN
+            elif guarded.site.addr in repaired_addrs:
+                outcome = DRIFT_REPAIRED
+            else:
+                outcome = DRIFT_FAILED
+            if outcome != DRIFT_REPAIRED:
+                self._stuck[guarded.site.addr] = data
+            event = DriftEvent(name=guarded.name, addr=guarded.site.addr, found=data, outcome=outcome, time=start)
+            events.append(event)
+            if outcome == DRIFT_REPAIRED:
+                logger.debug("patch_%s drifted at 0x%x, patched it again", guarded.name, guarded.site.addr)
+            else:
+                logger.warning("patch_%s drifted at 0x%x: %s", guarded.name, guarded.site.addr, outcome)
+            if self._metrics is not None:
+                self._metrics.count("crobar_guard_drifts_total", patch=guarded.name, outcome=outcome)
+
+        self.events.extend(events)
+        self.stats.drifts += len(events)
+        self.stats.repairs += len(repaired_addrs)
+        return events
+
+    def run(
+            self,
+            callback: Optional[Callable[[DriftEvent], None]]=None,
+            *,
+            stop: Optional[threading.Event]=None,
+            duration: Optional[float]=None) -> None:
+        """Checks every interval seconds, calling back with each drift, until stop is set or duration runs out."""
+        started: float = time.monotonic()
+        while not (stop is not None and stop.is_set()):
+            for event in self.check():
+                if callback is not None:
+                    callback(event)
+            now: float = time.monotonic()
+            if duration is not None and now - started >= duration:
+                break
+            if stop is not None:
+                stop.wait(self.interval)
+            else:
+                time.sleep(self.interval)
@@ -0,0 +1,226 @@
+"""Working out which Talos build we're looking at.
+
+Every version has a probe: a string at a known address.
+A VersionIndex groups those by address, so that each address only gets read once
+no matter how many versions share it, and the answer comes out of a dict.
+Versions can be given as entries from crobar.versions, which only get loaded once they match.
+
+Where we can get at the executable itself, we can skip the process entirely
+and look the probe up in the file instead. The answer gets remembered on disk,
+keyed by the file's identity, so the next run doesn't even need to do that.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Type
+
+from crobar.api import DebugInterface
+from crobar.api import TalosVersion
+from crobar.binfmt import BinaryFormatException
+from crobar.binfmt import ElfImage
+from crobar.binfmt import ExecutableImage
+from crobar.binfmt import open_image
+from crobar.versions import AnyVersion
+from crobar.versions import load_version
+from crobar.versions import version_name
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_path() -> str:
+    """Where identified executables get remembered."""
+    cache_home: str = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "crobar", "fingerprints.json")
+
+
+class VersionIndex:
+    """Every known version, indexed by probe address."""
+    __slots__ = (
+        "_by_probe",
+        "_lengths",
+        "_by_name",
+    )
+
+    def __init__(self, versions: Sequence[AnyVersion]) -> None:
+        # (address, expected bytes) -> version
+        self._by_probe: Dict[Tuple[int, bytes], AnyVersion] = {}
+        # address -> every probe length wanted there
+        self._lengths: Dict[int, Set[int]] = {}
+        self._by_name: Dict[str, AnyVersion] = {}
+        for version in versions:
+            ver_addr, ver_string = version.get_version_identifier()
+            self._by_probe[(ver_addr, ver_string)] = version
+            self._lengths.setdefault(ver_addr, set()).add(len(ver_string))
+            self._by_name[version_name(version)] = version
+
+    def by_name(self, name: str) -> Optional[Type[TalosVersion]]:
+        """Looks a version up by class name."""
+        version: Optional[AnyVersion] = self._by_name.get(name)
+        return load_version(version) if version is not None else None
+
+    def _match(self, ver_addr: int, data: Optional[bytes]) -> Optional[Type[TalosVersion]]:
+        if data is None:
+            return None
+        for length in self._lengths[ver_addr]:
+            version: Optional[AnyVersion] = self._by_probe.get((ver_addr, data[:length]))
+            if version is not None:
+                return load_version(version)
+        return None
+
+    def identify(self, debug_interface: DebugInterface) -> Optional[Type[TalosVersion]]:
+        """Identifies the attached process with one batched read. Returns None if nothing matches."""
+        addrs: List[int] = list(self._lengths)
+        datas: List[Optional[bytes]] = debug_interface.read_many(
+            ranges=[
+                (debug_interface.from_relative_addr(ver_addr), max(self._lengths[ver_addr]))
+                for ver_addr in addrs])
+        for ver_addr, data in zip(addrs, datas):
+            # An unreadable probe is probably not even mapped in this build
+            version: Optional[Type[TalosVersion]] = self._match(ver_addr, data)
+            if version is not None:
+                return version
+        return None
+
+    def identify_image(self, image: ExecutableImage) -> Optional[Type[TalosVersion]]:
+        """Identifies an executable file without running it. Returns None if nothing matches."""
+        for ver_addr, lengths in self._lengths.items():
+            version: Optional[Type[TalosVersion]] = self._match(ver_addr, image.read_vaddr(ver_addr, max(lengths)))
+            if version is not None:
+                return version
+        return None
+
+
+class FingerprintCache:
+    """Remembers which version each executable file turned out to be.
+
+    Files are keyed by device, inode, size and modification time,
+    which changes whenever the file does.
+    Build IDs get remembered too, so a copy of a known build is recognised straight away.
+    Safe to share between threads.
+    """
+    __slots__ = (
+        "path",
+        "_files",
+        "_build_ids",
+        "_dirty",
+        "_lock",
+    )
+
+    def __init__(self, path: Optional[str]=None) -> None:
+        self.path: str = path if path is not None else default_cache_path()
+        self._files: Dict[str, str] = {}
+        self._build_ids: Dict[str, str] = {}
+        self._dirty: bool = False
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r") as fp:
+                contents = json.load(fp)
+            self._files = dict(contents.get("files", {}))
+            self._build_ids = dict(contents.get("build_ids", {}))
+        except (OSError, ValueError, AttributeError):
+            # Missing or mangled. Either way we start afresh.
+            pass
+
+    @staticmethod
+    def file_key(st: os.stat_result) -> str:
+        return f"{st.st_dev:d}:{st.st_ino:d}:{st.st_size:d}:{st.st_mtime_ns:d}"
+
+    def lookup_file(self, st: os.stat_result) -> Optional[str]:
+        with self._lock:
+            return self._files.get(self.file_key(st))
+
+    def lookup_build_id(self, build_id: bytes) -> Optional[str]:
+        with self._lock:
+            return self._build_ids.get(build_id.hex())
+
+    def store(self, st: os.stat_result, *, version_name: str, build_id: Optional[bytes]) -> None:
+        with self._lock:
+            self._files[self.file_key(st)] = version_name
+            if build_id is not None:
+                self._build_ids[build_id.hex()] = version_name
+            self._dirty = True
+
+    def save(self) -> None:
+        """Writes the cache back out, if anything changed. Failing to do so isn't fatal."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path: str = f"{self.path}.{os.getpid():d}.{threading.get_ident():d}.tmp"
+                with open(tmp_path, "w") as fp:
+                    json.dump({"files": self._files, "build_ids": self._build_ids}, fp, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+            except OSError as e:
+                logger.warning("Could not save the fingerprint cache to %r: %s", self.path, e)
+
+
+def identify_executable(
+        path: str,
+        *,
+        index: VersionIndex,
+        cache: Optional[FingerprintCache]=None) -> Optional[Type[TalosVersion]]:
+    """Identifies an executable file from disk, without touching any running process.
+
+    Returns None if it's not something we know, or not something we can read.
+    """
+    try:
+        st: os.stat_result = os.stat(path)
+    except OSError:
+        return None
+
+    version: Optional[Type[TalosVersion]] = None
+    if cache is not None:
+        cached_name: Optional[str] = cache.lookup_file(st)
+        if cached_name is not None:
+            version = index.by_name(cached_name)
+            if version is not None:
+                return version
+
+    try:
+        image: ExecutableImage = open_image(path)
+    except (OSError, ValueError, BinaryFormatException):
+        # Unreadable, empty, or not an executable we know.
+        return None
+
+    build_id: Optional[bytes] = image.build_id if isinstance(image, ElfImage) else None
+    if cache is not None and build_id is not None:
+        cached_name = cache.lookup_build_id(build_id)
+        if cached_name is not None:
+            version = index.by_name(cached_name)
+
+    if version is None:
+        version = index.identify_image(image)
+
+    if version is not None and cache is not None:
+        cache.store(st, version_name=version.__name__, build_id=build_id)
+        cache.save()
+    return version
+
+
+def identify_process(
+        debug_interface: DebugInterface,
+        *,
+        index: VersionIndex,
+        cache: Optional[FingerprintCache]=None,
+        use_file: bool=True) -> Optional[Type[TalosVersion]]:
+    """Identifies the attached process. Returns None if nothing matches.
+
+    The executable file gets looked at first, if we can get at it and use_file is set,
+    since that doesn't need to read any memory.
+    """
+    version: Optional[Type[TalosVersion]] = None
+    exe_path: Optional[str] = debug_interface.get_executable_path() if use_file else None
+    if exe_path is not None:
+        version = identify_executable(exe_path, index=index, cache=cache)
+    if version is None:
+        version = index.identify(debug_interface)
+    return version
@@ -0,0 +1,338 @@
+"""Counting what crobar does to Talos, and how long it takes.
+
+An InstrumentedDebugInterface wraps another DebugInterface and times every operation on it,
+counting calls, bytes and failures, with a latency histogram for each kind of operation.
+Metrics.collect() adds whatever the backend counts for itself:
+syscalls and bytes per transfer, and how long the target spent stopped.
+
+Everything ends up in a Metrics, which can be written out as JSON
+or as a Prometheus textfile (for node_exporter's textfile collector).
+
+When nobody asks for metrics, nothing gets wrapped, so it costs nothing at all.
+"""
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import ReadableBuffer
+from crobar.api import WritableBuffer
+from crobar.arch.base import BaseDebugInterface
+
+# Upper bounds of each histogram bucket, in seconds: 1 us, 2 us, 4 us, ..., about 8 s
+HISTOGRAM_BOUNDS: Sequence[float] = tuple(1e-6 * (1 << shift) for shift in range(24))
+
+_INF_LABEL: str = 'le="+Inf"'
+
+# (metric name, ((label, value), ...))
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_HELP: Dict[str, str] = {
+    "crobar_operations_total": "Operations made on the debug interface.",
+    "crobar_operation_failures_total": "Operations on the debug interface that failed.",
+    "crobar_operation_bytes_total": "Bytes moved by operations on the debug interface.",
+    "crobar_operation_seconds": "How long each operation on the debug interface took.",
+    "crobar_transfer_syscalls_total": "Syscalls made by each transfer backend.",
+    "crobar_transfer_bytes_read_total": "Bytes read by each transfer backend.",
+    "crobar_transfer_bytes_written_total": "Bytes written by each transfer backend.",
+    "crobar_cache_total": "What the read cache did, by outcome.",
+    "crobar_target_stops_total": "Times the target was stopped.",
+    "crobar_target_stopped_seconds_total": "Time the target spent stopped, all told.",
+    "crobar_target_stopped_seconds": "How long the target stayed stopped each time.",
+    "crobar_guard_checks_total": "Times the patch guard checked every patched range.",
+    "crobar_guard_check_seconds": "How long each patch guard check took.",
+    "crobar_guard_drifts_total": "Patched ranges found not to be patched any more, by what happened next.",
+}
+
+
+class Histogram:
+    """Counts of observations falling into each of HISTOGRAM_BOUNDS, plus one for anything bigger."""
+    __slots__ = (
+        "buckets",
+        "count",
+        "total",
+    )
+
+    def __init__(self) -> None:
+        self.buckets: List[int] = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """Roughly where the given quantile lies, as the upper bound of the bucket it falls in."""
+        wanted: float = q * self.count
+        seen: int = 0
+        for bound, count, in zip(HISTOGRAM_BOUNDS, self.buckets):
+            seen += count
+            if seen >= wanted and seen:
+                return bound
+        return float("inf")
+
+    def __repr__(self) -> str:
+        if not self.count:
+            return "nothing"
+        return (
+            f"{self.count:d} in {self.total*1000.0:.3f} ms, "
+            f"p50 < {self.quantile(0.5)*1e6:.0f} us, p99 < {self.quantile(0.99)*1e6:.0f} us")
+
+
+class Metrics:
+    """Counters and histograms, keyed by name and labels. Safe to share between threads."""
+    __slots__ = (
+        "counters",
+        "histograms",
+        "_lock",
+    )
+
+    def __init__(self) -> None:
+        self.counters: Dict[MetricKey, float] = {}
+        self.histograms: Dict[MetricKey, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: float=1, **labels: str) -> None:
+        key: MetricKey = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key: MetricKey = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram: Optional[Histogram] = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def collect(self, debug_interface: DebugInterface, **labels: str) -> None:
+        """Picks up whatever a debug interface (and anything it wraps) counts for itself.
+
+        These are running totals, so they replace anything collected with the same labels before.
+        """
+        seen: List[DebugInterface] = []
+        current: Optional[DebugInterface] = debug_interface
+        while current is not None and current not in seen:
+            seen.append(current)
+            for transfer_name, transfer_stats in getattr(current, "transfer_stats", {}).items():
+                self._set("crobar_transfer_syscalls_total", transfer_stats.syscalls, transfer=transfer_name, **labels)
+                self._set("crobar_transfer_bytes_read_total", transfer_stats.bytes_read, transfer=transfer_name, **labels)
+                self._set("crobar_transfer_bytes_written_total", transfer_stats.bytes_written, transfer=transfer_name, **labels)
+            freeze_stats: Any = getattr(current, "freeze_stats", None)
+            if freeze_stats is not None:
+                self._set("crobar_target_stops_total", freeze_stats.freezes, **labels)
+                self._set("crobar_target_stopped_seconds_total", freeze_stats.total_time, **labels)
+            cache_stats: Any = getattr(current, "stats", None)
+            if cache_stats is not None and hasattr(cache_stats, "hits"):
+                for outcome in type(cache_stats).__slots__:
+                    self._set("crobar_cache_total", getattr(cache_stats, outcome), outcome=outcome, **labels)
+            current = getattr(current, "inner", None)
+
+    def _set(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] = value
+
+    def to_json(self) -> Dict[str, Any]:
+        """Everything as plain data, for json.dump()."""
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.total,
+                        "bounds": list(HISTOGRAM_BOUNDS),
+                        "buckets": list(histogram.buckets),
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self) -> str:
+        """Everything in Prometheus's text exposition format."""
+        def label_text(labels: Tuple[Tuple[str, str], ...], extra: str="") -> str:
+            parts: List[str] = [f'{label}="{value}"' for label, value, in labels]
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines: List[str] = []
+        described: Set[str] = set()
+
+        def describe(name: str, kind: str) -> None:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                describe(name, "counter")
+                lines.append(f"{name}{label_text(labels)} {value:g}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                describe(name, "histogram")
+                cumulative: int = 0
+                for bound, count, in zip(HISTOGRAM_BOUNDS, histogram.buckets):
+                    cumulative += count
+                    le: str = f'le="{bound:g}"'
+                    lines.append(f"{name}_bucket{label_text(labels, le)} {cumulative:d}")
+                lines.append(f"{name}_bucket{label_text(labels, _INF_LABEL)} {histogram.count:d}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram.total:g}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram.count:d}")
+        return "".join(f"{line}\n" for line in lines)
+
+    def save(self, path: str) -> None:
+        """Writes everything out, as JSON if the path ends in .json, otherwise as a Prometheus textfile.
+
+        The file gets replaced in one go, so a collector never sees half of it.
+        """
+        text: str
+        if path.endswith(".json"):
+            text = json.dumps(self.to_json(), indent=1, sort_keys=True) + "\n"
+        else:
+            text = self.to_prometheus()
+        tmp_path: str = f"{path}.{os.getpid():d}.tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(text)
+        os.replace(tmp_path, path)
+
+
+class InstrumentedDebugInterface(BaseDebugInterface):
+    """Passes everything through to another DebugInterface, timing and counting it as it goes.
+
+    Any labels given get put on everything it counts, e.g. pid= when there's more than one target.
+    """
+    __slots__ = (
+        "metrics",
+        "_inner",
+        "_labels",
+    )
+
+    def __init__(self, inner: DebugInterface, metrics: Metrics, **labels: str) -> None:
+        self.metrics = metrics
+        self._inner = inner
+        self._labels = labels
+        # Stops get timed where they happen, if the backend can stop things.
+        freeze_stats: Any = getattr(inner, "freeze_stats", None)
+        if freeze_stats is not None:
+            freeze_stats.observer = functools.partial(metrics.observe, "crobar_target_stopped_seconds", **labels)
+
+    @property
+    def inner(self) -> DebugInterface:
+        """The DebugInterface we're instrumenting."""
+        return self._inner
+
+    def close(self) -> None:
+        """Lets go of the attached process. Safe to call more than once."""
+        self._inner.close()
+
+    def _done(self, op: str, start: float, nbytes: int, failed: bool=False) -> None:
+        elapsed: float = time.perf_counter() - start
+        self.metrics.count("crobar_operations_total", op=op, **self._labels)
+        if failed:
+            self.metrics.count("crobar_operation_failures_total", op=op, **self._labels)
+        if nbytes:
+            self.metrics.count("crobar_operation_bytes_total", nbytes, op=op, **self._labels)
+        self.metrics.observe("crobar_operation_seconds", elapsed, op=op, **self._labels)
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory from the attached process."""
+        start: float = time.perf_counter()
+        try:
+            data: bytes = self._inner.read_memory(addr=addr, length=length)
+        except HackingOpException:
+            self._done("read", start, 0, failed=True)
+            raise
+        self._done("read", start, len(data))
+        return data
+
+    def read_into(self, *, addr: int, buffer: WritableBuffer) -> None:
+        """Fills a buffer with memory from the attached process, starting at addr."""
+        start: float = time.perf_counter()
+        try:
+            self._inner.read_into(addr=addr, buffer=buffer)
+        except HackingOpException:
+            self._done("read_into", start, 0, failed=True)
+            raise
+        self._done("read_into", start, memoryview(buffer).nbytes)
+
+    def read_many(self, *, ranges: Sequence[Tuple[int, int]], max_gap: Optional[int]=None) -> List[Optional[bytes]]:
+        """Read several (address, length) ranges from the attached process in one go."""
+        start: float = time.perf_counter()
+        try:
+            result: List[Optional[bytes]] = self._inner.read_many(ranges=ranges, max_gap=max_gap)
+        except HackingOpException:
+            self._done("read_many", start, 0, failed=True)
+            raise
+        self._done(
+            "read_many",
+            start,
+            sum(len(data) for data in result if data is not None),
+            failed=any(data is None for data in result))
+        return result
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Write memory to the attached process."""
+        start: float = time.perf_counter()
+        try:
+            self._inner.write_memory(addr=addr, data=data)
+        except HackingOpException:
+            self._done("write", start, 0, failed=True)
+            raise
+        self._done("write", start, len(data))
+
+    def write_from(self, *, addr: int, data: ReadableBuffer) -> None:
+        """Writes any bytes-like object to the attached process."""
+        start: float = time.perf_counter()
+        try:
+            self._inner.write_from(addr=addr, data=data)
+        except HackingOpException:
+            self._done("write_from", start, 0, failed=True)
+            raise
+        self._done("write_from", start, memoryview(data).nbytes)
+
+    def write_many(self, *, chunks: Sequence[Tuple[int, bytes]], max_gap: Optional[int]=None) -> None:
+        """Write several (address, data) chunks to the attached process in one go."""
+        start: float = time.perf_counter()
+        try:
+            self._inner.write_many(chunks=chunks, max_gap=max_gap)
+        except HackingOpException:
+            self._done("write_many", start, 0, failed=True)
+            raise
+        self._done("write_many", start, sum(len(data) for addr, data in chunks))
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        return self._inner.from_relative_addr(addr)
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        start: float = time.perf_counter()
+        try:
+            regions: Sequence[MemoryRegion] = self._inner.get_memory_regions()
+        except HackingOpException:
+            self._done("regions", start, 0, failed=True)
+            raise
+        self._done("regions", start, 0)
+        return regions
+
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        return self._inner.get_executable_path()
@@ -0,0 +1,173 @@
+"""Patching every running Talos at once.
+
+Each target gets a thread of its own, which does everything for that target,
+from attaching to letting go. ptrace only listens to the thread that attached,
+so a target never changes threads partway through.
+
+The threads are daemon threads. If a target hangs (stuck in the kernel, say),
+it gets reported as timed out, and it can't hold up the others or stop us exiting.
+"""
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Type
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import TalosVersion
+from crobar import arch
+from crobar.cache import CachingDebugInterface
+from crobar.identify import FingerprintCache
+from crobar.identify import VersionIndex
+from crobar.identify import identify_process
+from crobar.metrics import InstrumentedDebugInterface
+from crobar.metrics import Metrics
+from crobar.patchplan import PatchPlan
+from crobar.patchplan import compile_plan
+from crobar.versions import AnyVersion
+
+MODE_APPLY = "apply"
+MODE_REVERT = "revert"
+MODE_VERIFY = "verify"
+
+
+class TargetResult(NamedTuple):
+    """What happened to one Talos process."""
+    pid: int
+    version: Optional[Type[TalosVersion]]
+    # Patch name -> whether it changed anything (or its state, when verifying)
+    results: Dict[str, object]
+    error: Optional[str]
+    # Phase -> seconds spent in it, plus "total"
+    timings: Dict[str, float]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def patch_target(
+        pid: int,
+        *,
+        index: VersionIndex,
+        mode: str=MODE_APPLY,
+        interface_args: Optional[Mapping[str, Any]]=None,
+        cache_reads: bool=True,
+        fingerprint_cache: Optional[FingerprintCache]=None,
+        metrics: Optional[Metrics]=None) -> TargetResult:
+    """Attaches to one Talos process, identifies it and patches it, all on the calling thread.
+
+    Never throws. Whatever goes wrong ends up in the result's error.
+    """
+    timings: Dict[str, float] = {}
+    version: Optional[Type[TalosVersion]] = None
+    results: Dict[str, object] = {}
+    error: Optional[str] = None
+    start: float = time.perf_counter()
+    phase_start: float = start
+
+    def lap(phase: str) -> None:
+        nonlocal phase_start
+        now: float = time.perf_counter()
+        timings[phase] = now - phase_start
+        phase_start = now
+
+    raw_debug_interface: Optional[DebugInterface] = None
+    try:
+        raw_debug_interface = arch.ConcreteDebugInterface(pid=pid, **dict(interface_args or {}))
+        debug_interface: DebugInterface = raw_debug_interface
+        if metrics is not None:
+            debug_interface = InstrumentedDebugInterface(debug_interface, metrics, pid=str(pid))
+        if cache_reads:
+            debug_interface = CachingDebugInterface(debug_interface)
+        lap("attach")
+
+        version = identify_process(debug_interface, index=index, cache=fingerprint_cache)
+        if version is None:
+            raise HackingOpException(f"could not identify the version of PID {pid:d}")
+        lap("identify")
+
+        talos_version: TalosVersion = version(debug_interface=debug_interface)
+        plan: PatchPlan = compile_plan(debug_interface, talos_version.get_patch_manifest())
+        lap("compile")
+
+        if mode == MODE_VERIFY:
+            results = dict(plan.verify(debug_interface))
+        elif mode == MODE_REVERT:
+            results = dict(plan.revert(debug_interface))
+        else:
+            results = dict(plan.apply(debug_interface))
+        lap("patch")
+    except Exception as e:
+        # Anything at all, so that one broken target can't take the rest down with it.
+        error = str(e) or type(e).__name__
+    finally:
+        if raw_debug_interface is not None:
+            if metrics is not None:
+                metrics.collect(debug_interface, pid=str(pid))
+            # Has to happen here, on the thread that did the attaching.
+            try:
+                raw_debug_interface.close()
+            except Exception as e:
+                error = error or f"could not let go of PID {pid:d}: {e}"
+
+    timings["total"] = time.perf_counter() - start
+    return TargetResult(pid=pid, version=version, results=results, error=error, timings=timings)
+
+
+def patch_all(
+        pids: Sequence[int],
+        *,
+        versions: Sequence[AnyVersion],
+        mode: str=MODE_APPLY,
+        interface_args: Optional[Mapping[str, Any]]=None,
+        cache_reads: bool=True,
+        fingerprint_cache: Optional[FingerprintCache]=None,
+        metrics: Optional[Metrics]=None,
+        timeout: Optional[float]=None) -> List[TargetResult]:
+    """Patches every given Talos process concurrently, one thread each.
+
+    Returns a result for every PID, in the order given.
+    Targets still going after timeout seconds get reported as timed out.
+    """
+    index = VersionIndex(versions)
+    finished: Dict[int, TargetResult] = {}
+    done = threading.Condition()
+
+    def worker(pid: int) -> None:
+        result: TargetResult = patch_target(
+            pid,
+            index=index,
+            mode=mode,
+            interface_args=interface_args,
+            cache_reads=cache_reads,
+            fingerprint_cache=fingerprint_cache,
+            metrics=metrics)
+        with done:
+            finished[pid] = result
+            done.notify_all()
+
+    start: float = time.perf_counter()
+    for pid in pids:
+        threading.Thread(target=worker, args=(pid,), name=f"crobar-{pid:d}", daemon=True).start()
+
+    with done:
+        done.wait_for(lambda: len(finished) >= len(pids), timeout=timeout)
+        # Take a copy, so stragglers finishing now don't change what we report.
+        snapshot: Dict[int, TargetResult] = dict(finished)
+
+    elapsed: float = time.perf_counter() - start
+    return [
+        snapshot.get(pid) or TargetResult(
+            pid=pid,
+            version=None,
+            results={},
+            error=f"timed out after {elapsed:.1f} s",
+            timings={"total": elapsed})
+        for pid in pids]
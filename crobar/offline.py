@@ -0,0 +1,283 @@
+"""Patching Talos executables on disk, without running them.
+
+A copy of the executable gets mapped into memory and treated as if it were
+a running process, with every address mapped back to where it lives in the file.
+That way the same versions, manifests and patch plans work on it unchanged.
+
+Every byte changed gets recorded in a FileDiff, which can undo the patch later.
+Patches which can only be located in a running game (the game mode table, say)
+get skipped.
+"""
+import hashlib
+import mmap
+import os
+import shutil
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Type
+
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import TalosVersion
+from crobar.api import WritableBuffer
+from crobar.arch.base import BaseDebugInterface
+from crobar.binfmt import ExecutableImage
+from crobar.binfmt import parse_image
+from crobar.identify import VersionIndex
+from crobar.patchplan import PatchPlan
+from crobar.patchplan import compile_plan
+from crobar.versions import AnyVersion
+
+DIFF_SUFFIX: str = ".crobar-diff"
+_DIFF_HEADER: str = "# crobar executable diff v1"
+
+
+class OfflinePatchException(HackingOpException):
+    """Fires when an executable on disk can't be patched or unpatched."""
+    __slots__ = ()
+
+
+def file_sha256(path: str) -> str:
+    """Returns the SHA-256 of a file, in hex."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            block: bytes = fp.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileChange(NamedTuple):
+    """Some bytes changed at an offset in a file."""
+    offset: int
+    old: bytes
+    new: bytes
+
+
+class FileDiff:
+    """Every change made to a file, and the hashes of the file before and after.
+
+    Saved as text, one change per line, so it's easy to eyeball.
+    """
+    __slots__ = (
+        "source_sha256",
+        "result_sha256",
+        "changes",
+    )
+
+    def __init__(self, *, source_sha256: str, result_sha256: str, changes: Sequence[FileChange]) -> None:
+        self.source_sha256 = source_sha256
+        self.result_sha256 = result_sha256
+        self.changes: List[FileChange] = list(changes)
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as fp:
+            fp.write(f"{_DIFF_HEADER}\n")
+            fp.write(f"source {self.source_sha256}\n")
+            fp.write(f"result {self.result_sha256}\n")
+            for offset, old, new in self.changes:
+                fp.write(f"0x{offset:08x} {old.hex()} {new.hex()}\n")
+
+    @classmethod
+    def load(cls, path: str) -> "FileDiff":
+        hashes: Dict[str, str] = {}
+        changes: List[FileChange] = []
+        with open(path, "r") as fp:
+            if fp.readline().rstrip("\n") != _DIFF_HEADER:
+                raise OfflinePatchException(f"{path!r} isn't a crobar diff")
+            for line in fp:
+                fields: List[str] = line.split()
+                if len(fields) == 2:
+                    hashes[fields[0]] = fields[1]
+                elif len(fields) == 3:
+                    changes.append(FileChange(
+                        offset=int(fields[0], 16),
+                        old=bytes.fromhex(fields[1]),
+                        new=bytes.fromhex(fields[2])))
+                elif fields:
+                    raise OfflinePatchException(f"bad line in {path!r}: {line!r}")
+        if "source" not in hashes or "result" not in hashes:
+            raise OfflinePatchException(f"{path!r} is missing its hashes")
+        return cls(source_sha256=hashes["source"], result_sha256=hashes["result"], changes=changes)
+
+    def apply(self, path: str, *, reverse: bool=False) -> None:
+        """Applies this diff to a file in place, or undoes it if reverse is set.
+
+        The file has to be exactly what the diff expects, byte for byte.
+        """
+        expected: str = self.result_sha256 if reverse else self.source_sha256
+        if file_sha256(path) != expected:
+            raise OfflinePatchException(f"{path!r} isn't the file this diff was made {'by' if reverse else 'for'}")
+
+        with open(path, "r+b") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_WRITE)
+            try:
+                for offset, old, new in (reversed(self.changes) if reverse else self.changes):
+                    have, want, = (new, old) if reverse else (old, new)
+                    if data[offset:offset+len(have)] != have:
+                        raise OfflinePatchException(f"unexpected data at file offset 0x{offset:x}")
+                    data[offset:offset+len(want)] = want
+                data.flush()
+            finally:
+                data.close()
+
+
+class ImageDebugInterface(BaseDebugInterface):
+    """Treats an executable file as if it were a running process that's only just been loaded.
+
+    Addresses are the ones the executable was linked at,
+    and anything that isn't in the file (.bss, the heap, etc.) isn't mapped.
+    """
+    __slots__ = (
+        "path",
+        "image",
+        "changes",
+        "_fp",
+        "_data",
+    )
+
+    def __init__(self, path: str, *, writable: bool=False) -> None:
+        self.path = path
+        self.changes: List[FileChange] = []
+        self._fp = open(path, "r+b" if writable else "rb")
+        self._data = mmap.mmap(self._fp.fileno(), 0, access=(mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ))
+        self.image: ExecutableImage = parse_image(self._data)  # type: ignore[arg-type]
+
+    def close(self) -> None:
+        """Writes back any changes and unmaps the file."""
+        if not self._data.closed:
+            self._data.flush()
+            self._data.close()
+        self._fp.close()
+
+    def _offset_of(self, *, addr: int, length: int) -> int:
+        offset: Optional[int] = self.image.vaddr_to_offset(addr)
+        if offset is None or self.image.vaddr_to_offset(addr + length - 1) != offset + length - 1:
+            raise HackingOpException(f"0x{addr:x}+{length:d} isn't in {self.path!r}")
+        return offset
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory from the attached process."""
+        if length <= 0:
+            return b""
+        offset: int = self._offset_of(addr=addr, length=length)
+        return bytes(self._data[offset:offset+length])
+
+    def read_into(self, *, addr: int, buffer: WritableBuffer) -> None:
+        """Fills a buffer straight from the mapped file."""
+        view = memoryview(buffer).cast("B")
+        if len(view) == 0:
+            return
+        offset: int = self._offset_of(addr=addr, length=len(view))
+        # Let go of the mmap straight away, or it can't be closed.
+        with memoryview(self._data) as data:
+            view[:] = data[offset:offset+len(view)]
+
+    def try_read_into(self, *, addr: int, buffer: WritableBuffer) -> bool:
+        """Reading a mapped file is fine from any thread."""
+        try:
+            self.read_into(addr=addr, buffer=buffer)
+        except HackingOpException:
+            return False
+        return True
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Write memory to the attached process."""
+        if len(data) == 0:
+            return
+        offset: int = self._offset_of(addr=addr, length=len(data))
+        self.changes.append(FileChange(offset=offset, old=bytes(self._data[offset:offset+len(data)]), new=bytes(data)))
+        self._data[offset:offset+len(data)] = data
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        # Nothing's been loaded anywhere, so everything is where it was linked.
+        return addr
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        return [region._replace(path=self.path) for region in self.image.get_memory_regions()]
+
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        return self.path
+
+
+class OfflinePatchResult(NamedTuple):
+    version: Type[TalosVersion]
+    # Patch name -> whether it changed anything (or its state, when verifying)
+    results: Dict[str, object]
+    # Patch name -> why it couldn't be done offline
+    skipped: Dict[str, str]
+    diff: Optional[FileDiff]
+
+
+def _compile_for_image(image_interface: ImageDebugInterface, versions: Sequence[AnyVersion]) -> Tuple[Type[TalosVersion], PatchPlan]:
+    version_type: Optional[Type[TalosVersion]] = VersionIndex(versions).identify(image_interface)
+    if version_type is None:
+        raise OfflinePatchException(f"could not identify the version of {image_interface.path!r}")
+    talos_version: TalosVersion = version_type(debug_interface=image_interface)
+    plan: PatchPlan = compile_plan(image_interface, talos_version.get_patch_manifest(), skip_unresolved=True)
+    return version_type, plan
+
+
+def verify_file(path: str, *, versions: Sequence[AnyVersion]) -> OfflinePatchResult:
+    """Reports which patches an executable on disk has, without changing it."""
+    image_interface = ImageDebugInterface(path)
+    try:
+        version_type, plan, = _compile_for_image(image_interface, versions)
+        return OfflinePatchResult(
+            version=version_type,
+            results=dict(plan.verify(image_interface)),
+            skipped=plan.skipped,
+            diff=None)
+    finally:
+        image_interface.close()
+
+
+def patch_file(
+        src: str,
+        dst: str,
+        *,
+        versions: Sequence[AnyVersion],
+        revert: bool=False,
+        diff_path: Optional[str]=None) -> OfflinePatchResult:
+    """Writes a patched (or with revert, unpatched) copy of an executable.
+
+    The original is left alone. A diff of the changes goes to diff_path,
+    which defaults to the output path plus DIFF_SUFFIX.
+    dst only appears once everything has gone through.
+    """
+    tmp_path: str = f"{dst}.{os.getpid():d}.tmp"
+    shutil.copyfile(src, tmp_path)
+    try:
+        shutil.copymode(src, tmp_path)
+        image_interface = ImageDebugInterface(tmp_path, writable=True)
+        try:
+            version_type, plan, = _compile_for_image(image_interface, versions)
+            results: Dict[str, bool] = plan.revert(image_interface) if revert else plan.apply(image_interface)
+            changes: List[FileChange] = list(image_interface.changes)
+        finally:
+            image_interface.close()
+
+        diff = FileDiff(
+            source_sha256=file_sha256(src),
+            result_sha256=file_sha256(tmp_path),
+            changes=changes)
+        diff.save(diff_path if diff_path is not None else dst + DIFF_SUFFIX)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return OfflinePatchResult(
+        version=version_type,
+        results=dict(results),
+        skipped=plan.skipped,
+        diff=diff)
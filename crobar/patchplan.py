@@ -0,0 +1,287 @@
+"""Patches as data, and the machinery to apply them all at once.
+
+Each version describes its patches as a manifest of PatchSpecs.
+compile_plan() turns a manifest into a PatchPlan, which knows exactly which bytes go where.
+
+Applying a plan reads every site in one batch and checks all of them
+before writing anything, then writes everything in one batch.
+If any site turns out wrong afterwards, everything written gets put back.
+"""
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import PatchSite
+from crobar.signature import Signature
+from crobar.signature import SignatureScanner
+
+# What verify() says about each patch
+STATE_UNPATCHED = "unpatched"
+STATE_PATCHED = "patched"
+# Some sites are patched, and the rest are as they were
+STATE_PARTIAL = "partial"
+# Something's there that's neither the old nor the new bytes, or it couldn't be read
+STATE_MISMATCH = "mismatch"
+
+
+class PatchPlanException(HackingOpException):
+    """Fires when a plan can't be compiled or applied."""
+    __slots__ = ()
+
+
+class SignatureSite(NamedTuple):
+    """A patch site found by signature instead of by address.
+
+    The site is offset bytes into wherever the signature matches.
+    The signature has to match exactly once, either as it is, or with new already written over it.
+    """
+    signature: Signature
+    old: bytes
+    new: bytes
+    offset: int = 0
+
+
+AnySite = Union[PatchSite, SignatureSite]
+
+
+class PatchSpec(NamedTuple):
+    """One named patch, described as data.
+
+    Sites whose addresses can only be found by poking around in memory
+    come from locate, which gets called when the plan is compiled.
+    Every patch named in requires gets pulled into the plan too.
+    """
+    name: str
+    sites: Sequence[AnySite] = ()
+    locate: Optional[Callable[[], Sequence[AnySite]]] = None
+    requires: Sequence[str] = ()
+
+
+class PlanStep(NamedTuple):
+    """One patch in a compiled plan, with every site at a known address."""
+    name: str
+    sites: Sequence[PatchSite]
+
+
+class PatchPlan:
+    """A compiled set of patches, ready to verify, apply or revert."""
+    __slots__ = (
+        "steps",
+        "skipped",
+    )
+
+    def __init__(self, steps: Sequence[PlanStep], *, skipped: Optional[Dict[str, str]]=None) -> None:
+        self.steps: List[PlanStep] = list(steps)
+        # Patches left out because they couldn't be located, and why
+        self.skipped: Dict[str, str] = dict(skipped or {})
+
+    @property
+    def sites(self) -> List[PatchSite]:
+        return [site for step in self.steps for site in step.sites]
+
+    def _read_sites(self, debug_interface: DebugInterface) -> List[Optional[bytes]]:
+        return debug_interface.read_many(
+            ranges=[(site.addr, len(site.old)) for site in self.sites])
+
+    def verify(self, debug_interface: DebugInterface) -> Dict[str, str]:
+        """Returns the state of each patch, by name, without changing anything."""
+        refs: List[Optional[bytes]] = self._read_sites(debug_interface)
+        result: Dict[str, str] = {}
+        idx: int = 0
+        for step in self.steps:
+            states: Set[str] = set()
+            for site in step.sites:
+                ref: Optional[bytes] = refs[idx]
+                idx += 1
+                if ref == site.new:
+                    states.add(STATE_PATCHED)
+                elif ref == site.old:
+                    states.add(STATE_UNPATCHED)
+                else:
+                    states.add(STATE_MISMATCH)
+            if STATE_MISMATCH in states:
+                result[step.name] = STATE_MISMATCH
+            elif len(states) >= 2:
+                result[step.name] = STATE_PARTIAL
+            else:
+                result[step.name] = states.pop() if states else STATE_PATCHED
+        return result
+
+    def apply(self, debug_interface: DebugInterface) -> Dict[str, bool]:
+        """Applies every patch in the plan, or none of them.
+
+        Returns whether each patch changed anything, by name.
+        Throws a PatchPlanException if any site is neither old nor new,
+        or if the writes didn't stick, in which case they've been undone.
+        """
+        return self._transition(debug_interface, forwards=True)
+
+    def revert(self, debug_interface: DebugInterface) -> Dict[str, bool]:
+        """Undoes every patch in the plan, or none of them. Otherwise works like apply()."""
+        return self._transition(debug_interface, forwards=False)
+
+    def _transition(self, debug_interface: DebugInterface, *, forwards: bool) -> Dict[str, bool]:
+        refs: List[Optional[bytes]] = self._read_sites(debug_interface)
+
+        # Check everything before touching anything.
+        writes: List[Tuple[int, bytes, bytes]] = []
+        result: Dict[str, bool] = {}
+        idx: int = 0
+        for step in self.steps:
+            changed: bool = False
+            for site in step.sites:
+                ref: Optional[bytes] = refs[idx]
+                idx += 1
+                want: bytes = site.new if forwards else site.old
+                have: bytes = site.old if forwards else site.new
+                if ref is None:
+                    raise PatchPlanException(f"{step.name}: could not read data to be patched at 0x{site.addr:x}")
+                elif ref == want:
+                    # Already done.
+                    pass
+                elif ref == have:
+                    writes.append((site.addr, have, want))
+                    changed = True
+                else:
+                    # Unexpected data!
+                    raise PatchPlanException(f"{step.name}: unexpected data to be patched at 0x{site.addr:x}: {ref!r}")
+            result[step.name] = changed
+
+        if not writes:
+            return result
+
+        try:
+            debug_interface.write_many(chunks=[(addr, want) for addr, have, want in writes])
+            check: List[Optional[bytes]] = debug_interface.read_many(
+                ranges=[(addr, len(want)) for addr, have, want in writes])
+            bad: List[int] = [
+                addr
+                for (addr, have, want), ref in zip(writes, check)
+                if ref != want]
+            if bad:
+                raise PatchPlanException(f"writes didn't stick at {', '.join(f'0x{addr:x}' for addr in bad)}")
+        except HackingOpException as e:
+            # Everything we were going to write was verified as the old bytes, so putting those back is safe.
+            try:
+                debug_interface.write_many(chunks=[(addr, have) for addr, have, want in writes])
+            except HackingOpException as rollback_exc:
+                raise PatchPlanException(f"patching failed ({e}), and so did rolling back ({rollback_exc})") from e
+            raise PatchPlanException(f"patching failed, rolled back: {e}") from e
+
+        return result
+
+
+def _order_specs(manifest: Sequence[PatchSpec], names: Optional[Iterable[str]]) -> List[PatchSpec]:
+    """Returns the wanted specs plus everything they require, dependencies first."""
+    by_name: Dict[str, PatchSpec] = {spec.name: spec for spec in manifest}
+    wanted: List[str] = list(names) if names is not None else [spec.name for spec in manifest]
+
+    result: List[PatchSpec] = []
+    done: Set[str] = set()
+    visiting: Set[str] = set()
+
+    def visit(name: str) -> None:
+        if name in done:
+            return
+        if name in visiting:
+            raise PatchPlanException(f"patch {name!r} ends up requiring itself")
+        spec: Optional[PatchSpec] = by_name.get(name)
+        if spec is None:
+            raise PatchPlanException(f"no patch named {name!r} for this version")
+        visiting.add(name)
+        for dep in spec.requires:
+            visit(dep)
+        visiting.remove(name)
+        done.add(name)
+        result.append(spec)
+
+    for name in wanted:
+        visit(name)
+    return result
+
+
+def compile_plan(
+        debug_interface: DebugInterface,
+        manifest: Sequence[PatchSpec],
+        *,
+        names: Optional[Iterable[str]]=None,
+        skip_unresolved: bool=False) -> PatchPlan:
+    """Compiles a manifest into a plan. Defaults to every patch in the manifest.
+
+    All the signature sites get found in one scan.
+
+    If skip_unresolved is set, patches whose sites can't be found get left out
+    (along with anything requiring them) and listed in the plan's skipped dict,
+    rather than failing the whole plan.
+    """
+    specs: List[PatchSpec] = _order_specs(manifest, names)
+    skipped: Dict[str, str] = {}
+
+    def skip(spec: PatchSpec, exc: HackingOpException) -> None:
+        if not skip_unresolved:
+            raise exc
+        skipped[spec.name] = str(exc)
+
+    spec_sites: List[List[AnySite]] = []
+    for spec in specs:
+        sites: List[AnySite] = list(spec.sites)
+        if spec.locate is not None:
+            try:
+                sites += spec.locate()
+            except HackingOpException as e:
+                skip(spec, e)
+        spec_sites.append(sites)
+
+    # Each signature site gets searched for both before and after patching.
+    signatures: Dict[Tuple[str, int], Tuple[Signature, Signature]] = {}
+    for spec, sites in zip(specs, spec_sites):
+        for site_idx, site in enumerate(sites):
+            if isinstance(site, SignatureSite):
+                if len(site.old) != len(site.new):
+                    raise PatchPlanException(f"{spec.name}: old and new bytes differ in length")
+                signatures[(spec.name, site_idx)] = (
+                    Signature(pattern=site.signature.pattern, mask=site.signature.mask, name=f"{spec.name}#{site_idx:d}"),
+                    site.signature.overlay(site.offset, site.new, name=f"{spec.name}#{site_idx:d}/patched"))
+
+    found: Dict[str, List[int]] = {}
+    if signatures:
+        scanner = SignatureScanner(sig for pair in signatures.values() for sig in pair)
+        found = scanner.find_all(debug_interface)
+
+    steps: List[PlanStep] = []
+    for spec, sites in zip(specs, spec_sites):
+        if spec.name in skipped:
+            continue
+        missing: List[str] = [dep for dep in spec.requires if dep in skipped]
+        if missing:
+            skip(spec, PatchPlanException(f"{spec.name}: requires {', '.join(missing)}, which got skipped"))
+            continue
+
+        resolved: List[PatchSite] = []
+        try:
+            for site_idx, site in enumerate(sites):
+                if isinstance(site, SignatureSite):
+                    unpatched, patched, = signatures[(spec.name, site_idx)]
+                    addrs: List[int] = sorted(set(found[unpatched.name]) | set(found[patched.name]))
+                    if len(addrs) != 1:
+                        raise PatchPlanException(f"{spec.name}: expected signature {str(site.signature)!r} exactly once, found it {len(addrs):d} times")
+                    resolved.append(PatchSite(addr=addrs[0] + site.offset, old=site.old, new=site.new))
+                else:
+                    if len(site.old) != len(site.new):
+                        raise PatchPlanException(f"{spec.name}: old and new bytes differ in length")
+                    resolved.append(site)
+        except PatchPlanException as e:
+            skip(spec, e)
+            continue
+        steps.append(PlanStep(name=spec.name, sites=resolved))
+
+    return PatchPlan(steps, skipped=skipped)
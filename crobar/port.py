@@ -0,0 +1,699 @@
+"""Porting patches from one Talos build to another, from the executables alone.
+
+Given an executable we already have a version for, PortReference takes a snapshot
+of the code around every patch site, and around every piece of code which refers to
+one of the version's data addresses (any class attribute ending in _addr).
+Anything in there which looks like it points into the executable gets wildcarded,
+since that's exactly what moves between builds.
+
+port_executables() then looks for all of that in the code of each new executable,
+which gets mapped rather than read, with one executable per process.
+Each thing gets searched for with its widest context first, then narrower ones until it turns up,
+and only counts as found if it turns up exactly once.
+Its confidence is how much of the widest context it took to find it, so 1.0 means all of it.
+
+generate_version() turns what was found into the source of a candidate TalosVersion subclass,
+with a confidence next to everything. It's somewhere to start, not a finished version:
+check it in a disassembler before adding it to ALL_VERSIONS.
+
+`python -m crobar.port REFERENCE EXECUTABLE_OR_DIRECTORY...` does the lot.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+import struct
+import sys
+from types import CodeType
+from types import FunctionType
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Type
+
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import PatchSite
+from crobar.api import TalosVersion
+from crobar.binfmt import ElfImage
+from crobar.binfmt import PeImage
+from crobar.identify import VersionIndex
+from crobar.offline import ImageDebugInterface
+from crobar.patchplan import PatchPlan
+from crobar.patchplan import PatchSpec
+from crobar.patchplan import compile_plan
+from crobar.remote import StructLayout
+from crobar.signature import Signature
+from crobar.signature import SignatureException
+from crobar.signature import SignatureScanner
+from crobar.versions import ALL_VERSIONS
+from crobar.versions import AnyVersion
+from crobar.versions import layouts
+
+# Bytes of context on either side of each site, widest first
+DEFAULT_CONTEXTS: Sequence[int] = (48, 24, 12)
+
+# How many references to each data address to look for
+MAX_ADDRESS_REFERENCES: int = 8
+
+_VERSION_PREFIX: bytes = b"$Version:"
+_MAX_IDENTIFIER: int = 256
+_BUILD_NUMBER = re.compile(rb"; (\d+) ")
+
+_U32 = struct.Struct("<I")
+
+
+class PortException(HackingOpException):
+    """Fires when a reference build can't be used to port anything."""
+    __slots__ = ()
+
+
+class Anchor(NamedTuple):
+    """Something to find in a new build: a patch site, or a reference to a data address."""
+    name: str
+    # (signature, how far into it the thing itself starts), widest context first
+    tiers: Sequence[Tuple[Signature, int]]
+    # How many bytes of the thing itself to read back once it's found
+    length: int
+    # What a patch site looks like once it's been patched, so it can be found either way
+    patched: Optional[bytes] = None
+
+
+class SiteTemplate(NamedTuple):
+    """A patch site in the reference build, and the anchor to find it by."""
+    anchor: str
+    old: bytes
+    new: bytes
+
+
+class SpecTemplate(NamedTuple):
+    """A patch in the reference build, with its sites ready to be found elsewhere."""
+    name: str
+    sites: Sequence[SiteTemplate]
+    # The name of the version method which locates its other sites, if it has one
+    locate: Optional[str]
+    requires: Sequence[str]
+    # Every attribute the locate method might use, directly or through other methods
+    locate_uses: Sequence[str] = ()
+
+
+class AnchorMatch(NamedTuple):
+    """Where an anchor turned up in a new build, if it did."""
+    addr: Optional[int]
+    # The bytes at addr
+    found: Optional[bytes]
+    confidence: float
+    # How many places the deciding context matched (0 for nowhere at all)
+    matches: int
+    # Bytes of context either side which decided it
+    context: int
+    # Whether it was found already patched
+    patched: bool = False
+
+
+class PortResult(NamedTuple):
+    """Everything found in one new executable."""
+    path: str
+    os_name: str = ""
+    bits: int = 0
+    # Where it gets loaded, start and end
+    bounds: Tuple[int, int] = (0, 0)
+    # Where its $Version string is, and what it says
+    identifier: Optional[Tuple[int, bytes]] = None
+    # The version we already have for it, if we do
+    known_as: Optional[str] = None
+    anchors: Dict[str, AnchorMatch] = {}
+    error: Optional[str] = None
+
+
+def _fixed_bytes(signature: Signature) -> int:
+    return sum(1 for m in signature.mask if m == 0xFF)
+
+
+def _address_positions(data: bytes, base_addr: int, lo: int, hi: int, *, relative: bool=True) -> List[int]:
+    """Offsets of every 32-bit value in data which looks like it points between lo and hi.
+
+    That's either as an absolute address, or (if relative is set) relative to the end
+    of a call, jump or conditional jump.
+    """
+    positions: List[int] = []
+    idx: int = 0
+    while idx + 4 <= len(data):
+        value: int = _U32.unpack_from(data, idx)[0]
+        is_address: bool = lo <= value < hi
+        if not is_address and relative and (
+                (idx >= 1 and data[idx-1] in (0xE8, 0xE9))
+                or (idx >= 2 and data[idx-2] == 0x0F and 0x80 <= data[idx-1] <= 0x8F)):
+            displacement: int = value - (1 << 32) if value & 0x80000000 else value
+            is_address = lo <= base_addr + idx + 4 + displacement < hi
+        if is_address:
+            positions.append(idx)
+            idx += 4
+        else:
+            idx += 1
+    return positions
+
+
+def _image_bounds(regions: Sequence[MemoryRegion]) -> Tuple[int, int]:
+    return min(region.start for region in regions), max(region.end for region in regions)
+
+
+def _os_name(image_interface: ImageDebugInterface) -> str:
+    if isinstance(image_interface.image, ElfImage):
+        return "linux"
+    elif isinstance(image_interface.image, PeImage):
+        return "windows"
+    return "unknown"
+
+
+def _find_identifier(image_interface: ImageDebugInterface) -> Optional[Tuple[int, bytes]]:
+    """Finds the $Version string, preferring one which mentions Talos."""
+    data: bytes = image_interface.image.data
+    regions: Sequence[MemoryRegion] = image_interface.get_memory_regions()
+    found: List[Tuple[int, bytes]] = []
+    offset: int = data.find(_VERSION_PREFIX)
+    while offset != -1:
+        end: int = data.find(b"$", offset + 1, offset + _MAX_IDENTIFIER)
+        if end != -1:
+            for region in regions:
+                if region.offset <= offset < region.offset + region.size:
+                    found.append((region.start + offset - region.offset, bytes(data[offset:end+1])))
+                    break
+        offset = data.find(_VERSION_PREFIX, offset + 1)
+    for addr, identifier in found:
+        if b"Talos" in identifier:
+            return addr, identifier
+    return found[0] if found else None
+
+
+class PortReference:
+    """A known-good build, boiled down into everything needed to find its patches in other builds."""
+    __slots__ = (
+        "version",
+        "path",
+        "specs",
+        "anchors",
+        "address_attrs",
+        "layout_attrs",
+    )
+
+    def __init__(self, path: str, *, versions: Sequence[AnyVersion], contexts: Sequence[int]=DEFAULT_CONTEXTS) -> None:
+        """Identifies the executable at path, and takes its patches apart."""
+        self.path = path
+        image_interface = ImageDebugInterface(path)
+        try:
+            version: Optional[Type[TalosVersion]] = VersionIndex(versions).identify_image(image_interface.image)
+            if version is None:
+                raise PortException(f"{path!r} isn't a build we have a version for")
+            self.version: Type[TalosVersion] = version
+
+            code: List[MemoryRegion] = [
+                region
+                for region in image_interface.get_memory_regions()
+                if region.executable and region.readable]
+            lo, hi, = _image_bounds(image_interface.get_memory_regions())
+            self.anchors: List[Anchor] = []
+            self.specs: List[SpecTemplate] = []
+            self._take_patches(image_interface, contexts, lo, hi)
+
+            # Data addresses get found through the code that uses them.
+            self.address_attrs: Dict[str, List[str]] = {}
+            for attr, value in sorted(vars(version).items()):
+                if not (attr.endswith("_addr") and isinstance(value, int)):
+                    continue
+                self.address_attrs[attr] = []
+                for ref_addr in self._find_references(image_interface, code, value):
+                    anchor = self._make_anchor(
+                        image_interface,
+                        f"{attr}#{len(self.address_attrs[attr]):d}",
+                        ref_addr,
+                        _U32.size,
+                        contexts,
+                        lo,
+                        hi)
+                    if anchor is not None:
+                        self.anchors.append(anchor)
+                        self.address_attrs[attr].append(anchor.name)
+
+            # Layouts can't be found like that, so they're assumed to be unchanged.
+            layout_names: Dict[int, str] = {
+                id(value): name
+                for name, value in vars(layouts).items()
+                if isinstance(value, StructLayout)}
+            self.layout_attrs: Dict[str, str] = {
+                attr: layout_names[id(value)]
+                for attr, value in sorted(vars(version).items())
+                if isinstance(value, StructLayout) and id(value) in layout_names}
+        finally:
+            image_interface.close()
+
+    def _take_patches(self, image_interface: ImageDebugInterface, contexts: Sequence[int], lo: int, hi: int) -> None:
+        talos_version: TalosVersion = self.version(debug_interface=image_interface)
+        manifest: Sequence[PatchSpec] = talos_version.get_patch_manifest()
+        # Signature sites get resolved, and anything which needs a running game gets skipped.
+        plan: PatchPlan = compile_plan(image_interface, manifest, skip_unresolved=True)
+        resolved: Dict[str, Sequence[PatchSite]] = {step.name: step.sites for step in plan.steps}
+
+        for spec in manifest:
+            sites: List[SiteTemplate] = []
+            locate: Optional[str] = None
+            if spec.locate is not None:
+                locate = getattr(spec.locate, "__name__", None)
+                # The located sites come from the running game, so only the fixed ones get ported.
+                fixed: Sequence[PatchSite] = [site for site in spec.sites if isinstance(site, PatchSite)]
+            else:
+                fixed = resolved.get(spec.name, ())
+            for site_idx, site in enumerate(fixed):
+                anchor: Optional[Anchor] = self._make_anchor(
+                    image_interface,
+                    f"{spec.name}#{site_idx:d}",
+                    site.addr,
+                    len(site.old),
+                    contexts,
+                    lo,
+                    hi,
+                    override=site.old,
+                    patched=site.new)
+                if anchor is None:
+                    raise PortException(f"{spec.name}: site at 0x{site.addr:x} isn't in {self.path!r}")
+                self.anchors.append(anchor)
+                sites.append(SiteTemplate(anchor=anchor.name, old=site.old, new=site.new))
+            self.specs.append(SpecTemplate(
+                name=spec.name,
+                sites=sites,
+                locate=locate,
+                requires=tuple(spec.requires),
+                locate_uses=(sorted(_names_used(self.version, locate)) if locate is not None else ())))
+
+    @staticmethod
+    def _find_references(image_interface: ImageDebugInterface, code: Sequence[MemoryRegion], value: int) -> List[int]:
+        needle: bytes = _U32.pack(value)
+        data: bytes = image_interface.image.data
+        result: List[int] = []
+        for region in code:
+            offset: int = data.find(needle, region.offset, region.offset + region.size)
+            while offset != -1 and len(result) < MAX_ADDRESS_REFERENCES:
+                result.append(region.start + offset - region.offset)
+                offset = data.find(needle, offset + 1, region.offset + region.size)
+        return result
+
+    @staticmethod
+    def _make_anchor(
+            image_interface: ImageDebugInterface,
+            name: str,
+            addr: int,
+            length: int,
+            contexts: Sequence[int],
+            lo: int,
+            hi: int,
+            override: Optional[bytes]=None,
+            patched: Optional[bytes]=None) -> Optional[Anchor]:
+        tiers: List[Tuple[Signature, int]] = []
+        for context in contexts:
+            data: Optional[bytes] = image_interface.image.read_vaddr(addr - context, length + 2*context)
+            if data is None:
+                # Too close to the edge of whatever it's in.
+                continue
+            pattern = bytearray(data)
+            if override is not None:
+                # It might have been patched already, so go by what it's meant to be.
+                pattern[context:context+length] = override
+            mask = bytearray(b"\xFF" * len(pattern))
+            for position in _address_positions(bytes(pattern), addr - context, lo, hi):
+                mask[position:position+4] = b"\x00\x00\x00\x00"
+            try:
+                tiers.append((Signature(pattern=bytes(pattern), mask=bytes(mask), name=f"{name}/{context:d}"), context))
+            except SignatureException:
+                continue
+        if not tiers:
+            return None
+        return Anchor(name=name, tiers=tiers, length=length, patched=patched)
+
+
+def port_executable(
+        path: str,
+        anchors: Sequence[Anchor],
+        known: Sequence[AnyVersion]=()) -> PortResult:
+    """Finds every anchor in one executable, unless it's one of the known versions."""
+    try:
+        image_interface = ImageDebugInterface(path)
+    except (OSError, ValueError, HackingOpException) as e:
+        return PortResult(path=path, error=str(e))
+
+    try:
+        known_as: Optional[Type[TalosVersion]] = VersionIndex(known).identify_image(image_interface.image)
+        if known_as is not None:
+            return PortResult(path=path, known_as=known_as.__name__)
+
+        code: List[MemoryRegion] = [
+            region
+            for region in image_interface.get_memory_regions()
+            if region.executable and region.readable]
+        found: Dict[str, List[int]] = {}
+        if code:
+            signatures: List[Signature] = []
+            for anchor in anchors:
+                for signature, context in anchor.tiers:
+                    signatures.append(signature)
+                    if anchor.patched is not None:
+                        signatures.append(signature.overlay(context, anchor.patched, name=f"{signature.name}/patched"))
+            scanner = SignatureScanner(signatures)
+            # Everything else in the pool is busy with other executables.
+            for match in scanner.scan(image_interface, regions=code, workers=1):
+                found.setdefault(match.signature.name, []).append(match.addr)
+
+        matches: Dict[str, AnchorMatch] = {}
+        for anchor in anchors:
+            widest: int = _fixed_bytes(anchor.tiers[0][0])
+            result = AnchorMatch(addr=None, found=None, confidence=0.0, matches=0, context=0)
+            for signature, context in anchor.tiers:
+                patched_addrs: Set[int] = set(found.get(f"{signature.name}/patched", ()))
+                addrs: List[int] = sorted(set(found.get(signature.name, ())) | patched_addrs)
+                if not addrs:
+                    continue
+                confidence: float = _fixed_bytes(signature) / widest / len(addrs)
+                if len(addrs) == 1:
+                    addr: int = addrs[0] + context
+                    result = AnchorMatch(
+                        addr=addr,
+                        found=image_interface.read_memory(addr=addr, length=anchor.length),
+                        confidence=confidence,
+                        matches=1,
+                        context=context,
+                        patched=(addrs[0] in patched_addrs))
+                else:
+                    # Narrower contexts would only match in more places.
+                    result = AnchorMatch(addr=None, found=None, confidence=confidence, matches=len(addrs), context=context)
+                break
+            matches[anchor.name] = result
+
+        return PortResult(
+            path=path,
+            os_name=_os_name(image_interface),
+            bits=image_interface.image.bits,  # type: ignore[attr-defined]
+            bounds=_image_bounds(image_interface.get_memory_regions()),
+            identifier=_find_identifier(image_interface),
+            anchors=matches)
+    except HackingOpException as e:
+        return PortResult(path=path, error=str(e))
+    finally:
+        image_interface.close()
+
+
+def _port_job(job: Tuple[str, Sequence[Anchor], Sequence[AnyVersion]]) -> PortResult:
+    path, anchors, known, = job
+    return port_executable(path, anchors, known)
+
+
+def port_executables(
+        reference: PortReference,
+        paths: Sequence[str],
+        *,
+        versions: Sequence[AnyVersion]=(),
+        jobs: Optional[int]=None) -> List[PortResult]:
+    """Ports the reference's patches to every executable, one per process, in the order given.
+
+    Anything which turns out to be one of versions already gets left alone.
+    """
+    work: List[Tuple[str, Sequence[Anchor], Sequence[AnyVersion]]] = [
+        (path, reference.anchors, versions)
+        for path in paths]
+    if len(work) <= 1 or jobs == 1:
+        return [_port_job(job) for job in work]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_port_job, work))
+
+
+def _port_address(reference: PortReference, result: PortResult, attr: str) -> Tuple[Optional[int], float]:
+    """What the references to a data address agree it now is, and how sure they are."""
+    votes: Dict[int, List[float]] = {}
+    for name in reference.address_attrs[attr]:
+        match: AnchorMatch = result.anchors[name]
+        if match.found is not None:
+            votes.setdefault(_U32.unpack(match.found)[0], []).append(match.confidence)
+    if not votes:
+        return None, 0.0
+    value: int = max(votes, key=lambda value: sum(votes[value]))
+    # As sure as the surest reference to it, less however much the rest disagree.
+    agreement: float = sum(votes[value]) / sum(sum(confidences) for confidences in votes.values())
+    return value, max(votes[value]) * agreement
+
+
+def _bytes_expr(data: bytes, addr_positions: Sequence[int]) -> str:
+    """Source for some bytes, with absolute addresses in them made relocatable."""
+    parts: List[str] = []
+    start: int = 0
+    for position in list(addr_positions) + [len(data)]:
+        if position > start:
+            parts.append("bytes([" + ", ".join(f"0x{b:02x}" for b in data[start:position]) + "])")
+        if position < len(data):
+            parts.append(f"self.pack_relative_addr(0x{_U32.unpack_from(data, position)[0]:08x})")
+        start = position + 4
+    return " + ".join(parts) or "b\"\""
+
+
+def _bytes_literal(data: bytes) -> str:
+    """Source for some bytes, in double quotes like everything else."""
+    text: str = repr(data)
+    if text.startswith("b'") and '"' not in text:
+        text = f'b"{text[2:-1]}"'
+    return text
+
+
+def _ported_site(site: SiteTemplate, match: AnchorMatch) -> Tuple[bytes, bytes]:
+    """The old and new bytes for a site, keeping whatever the reference patch didn't change from the new build."""
+    assert match.found is not None
+    old: bytes = match.found
+    new: bytes = bytes(
+        want if have != want else here
+        for have, want, here in zip(site.old, site.new, match.found))
+    if match.patched:
+        old, new, = bytes(
+            have if have != want else here
+            for have, want, here in zip(site.old, site.new, match.found)), match.found
+    return old, new
+
+
+def _names_used(cls: type, method_name: str) -> Set[str]:
+    """Every name a method of cls looks up, and every name the methods it looks up look up, and so on."""
+    seen: Set[str] = set()
+    pending: List[str] = [method_name]
+    while pending:
+        name: str = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for klass in cls.__mro__:
+            if name in vars(klass):
+                member: object = vars(klass)[name]
+                if isinstance(member, (classmethod, staticmethod)):
+                    member = member.__func__
+                elif isinstance(member, property):
+                    member = member.fget
+                codes: List[CodeType] = [member.__code__] if isinstance(member, FunctionType) else []
+                while codes:
+                    code: CodeType = codes.pop()
+                    pending += code.co_names
+                    # Comprehensions and lambdas get their own code
+                    codes += [const for const in code.co_consts if isinstance(const, CodeType)]
+                break
+    return seen
+
+
+def version_class_name(result: PortResult) -> Optional[str]:
+    """What the version for a ported build should be called, going by the usual naming scheme."""
+    if result.identifier is None:
+        return None
+    m = _BUILD_NUMBER.search(result.identifier[1])
+    if m is None:
+        return None
+    return f"TalosVersion_v{m.group(1).decode('ascii')}_{result.os_name}_x86_{result.bits:d}"
+
+
+def overall_confidence(reference: PortReference, result: PortResult) -> float:
+    """The least confident of everything that got ported, or 0.0 if anything didn't."""
+    confidences: List[float] = [result.anchors[site.anchor].confidence for spec in reference.specs for site in spec.sites]
+    confidences += [_port_address(reference, result, attr)[1] for attr in reference.address_attrs]
+    return min(confidences, default=0.0)
+
+
+def generate_version(reference: PortReference, result: PortResult) -> str:
+    """Writes the source of a candidate version module for a ported build."""
+    class_name: Optional[str] = version_class_name(result)
+    if class_name is None or result.identifier is None:
+        raise PortException(f"{result.path!r} has no $Version string to name a version after")
+    lo, hi, = result.bounds
+    addresses: Dict[str, Tuple[Optional[int], float]] = {
+        attr: _port_address(reference, result, attr)
+        for attr in reference.address_attrs}
+
+    lines: List[str] = [
+        f"# Ported by crobar.port from {reference.version.__name__} ({os.path.basename(reference.path)}).",
+        f"# Overall confidence {overall_confidence(reference, result):.2f}.",
+        "# Check every site in a disassembler before adding this to ALL_VERSIONS, as:",
+        "#     VersionEntry(",
+        f"#         name=\"{class_name}\",",
+        f"#         module=\"{class_name[len('TalosVersion_'):]}\",",
+        f"#         ver_addr=0x{result.identifier[0]:08x},",
+        f"#         ver_string={_bytes_literal(result.identifier[1])},",
+        f"#         platform=\"{result.os_name}\"),",
+        "from typing import Sequence",
+        "from typing import Tuple",
+        "",
+        "from crobar.api import PatchSite",
+        "from crobar.patchplan import PatchSpec",
+    ]
+    if reference.layout_attrs:
+        lines.append("from crobar.remote import StructLayout")
+    lines.append("from .base import BaseTalosVersion")
+    for layout_name in sorted(set(reference.layout_attrs.values())):
+        lines.append(f"from .layouts import {layout_name}")
+    lines += ["", "", f"class {class_name}(BaseTalosVersion):"]
+
+    for attr, (value, confidence) in addresses.items():
+        if value is None:
+            lines.append(f"    # {attr}: not found")
+        else:
+            lines.append(f"    # Confidence {confidence:.2f}")
+            lines.append(f"    {attr}: int = 0x{value:08x}")
+    if reference.layout_attrs:
+        lines.append(f"    # Assumed to be the same as in {reference.version.__name__}")
+    for attr, layout_name in reference.layout_attrs.items():
+        lines.append(f"    {attr}: StructLayout = {layout_name}")
+
+    ver_addr, ver_string, = result.identifier
+    lines += [
+        "",
+        "    @classmethod",
+        "    def get_version_identifier(cls) -> Tuple[int, bytes]:",
+        "        \"\"\"Returns an (address, bytes) tuple uniquely identifying this build.\"\"\"",
+        "        return (",
+        f"            0x{ver_addr:08x},",
+        f"            {_bytes_literal(ver_string)},)",
+        "",
+        "    def get_patch_manifest(self) -> Sequence[PatchSpec]:",
+        "        \"\"\"Returns every patch this version knows about, described as data.\"\"\"",
+        "        return [",
+    ]
+
+    dropped: Set[str] = set()
+    for spec in reference.specs:
+        missing: List[str] = [dep for dep in spec.requires if dep in dropped]
+        bad: List[str] = []
+        for site_idx, site in enumerate(spec.sites):
+            match: AnchorMatch = result.anchors[site.anchor]
+            if match.matches == 0:
+                bad.append(f"site {site_idx:d} wasn't found")
+            elif match.addr is None:
+                bad.append(f"site {site_idx:d} turned up {match.matches:d} times")
+        if not spec.sites and spec.locate is None:
+            bad.append(f"couldn't be found in {os.path.basename(reference.path)}")
+        # Anything it locates at run time with an address we couldn't port would only fail then.
+        bad += [
+            f"{spec.locate} uses {attr}, which wasn't found"
+            for attr in spec.locate_uses
+            if attr in addresses and addresses[attr][0] is None]
+        if missing or bad:
+            dropped.add(spec.name)
+            reason: str = ", ".join(bad + [f"requires {dep}" for dep in missing])
+            lines.append(f"            # {spec.name}: not ported, {reason}")
+            continue
+
+        confidence: float = min((result.anchors[site.anchor].confidence for site in spec.sites), default=1.0)
+        if spec.sites:
+            lines.append(f"            # Confidence {confidence:.2f}")
+        else:
+            lines.append(f"            # Located at run time, using what's ported above")
+        lines += [
+            "            PatchSpec(",
+            f"                name=\"{spec.name}\",",
+        ]
+        if spec.sites:
+            lines.append("                sites=[")
+            for site in spec.sites:
+                match = result.anchors[site.anchor]
+                assert match.addr is not None and match.found is not None
+                old, new, = _ported_site(site, match)
+                lines += [
+                    f"                    # Found{' already patched' if match.patched else ''} with {match.context:d} bytes of context either side",
+                    "                    PatchSite(",
+                    f"                        addr=self.from_relative_addr(0x{match.addr:08x}),",
+                    f"                        old={_bytes_expr(old, _address_positions(old, match.addr, lo, hi, relative=False))},",
+                    f"                        new={_bytes_expr(new, _address_positions(new, match.addr, lo, hi, relative=False))},",
+                    "                    ),",
+                ]
+            lines.append("                ],")
+        if spec.locate is not None:
+            lines.append(f"                locate=self.{spec.locate},")
+        if spec.requires:
+            requires: str = ", ".join(f"\"{dep}\"" for dep in spec.requires)
+            lines.append(f"                requires=[{requires}],")
+        lines.append("            ),")
+    lines += ["        ]", ""]
+    return "\n".join(lines)
+
+
+def _expand_paths(paths: Sequence[str]) -> List[str]:
+    """Every file named, plus anything in a directory named that looks like an executable."""
+    result: List[str] = []
+    for path in paths:
+        if not os.path.isdir(path):
+            result.append(path)
+            continue
+        for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+            if not entry.is_file():
+                continue
+            try:
+                with open(entry.path, "rb") as fp:
+                    magic: bytes = fp.read(4)
+            except OSError:
+                continue
+            if magic == b"\x7fELF" or magic[:2] == b"MZ":
+                result.append(entry.path)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="crobar.port", description="Port patches from a build we know to builds we don't.")
+    parser.add_argument("reference", help="an executable we already have a version for")
+    parser.add_argument("targets", nargs="+", metavar="EXECUTABLE", help="executables to port to, or directories of them")
+    parser.add_argument("--output", metavar="DIRECTORY", help="write a candidate version module for each one here")
+    parser.add_argument("--jobs", type=int, metavar="N", help="how many executables to search at once (default: one per CPU)")
+    parser.add_argument("--context", type=lambda text: [int(part, 0) for part in text.split(",")], default=DEFAULT_CONTEXTS, metavar="BYTES,...", help="bytes of context to search with either side of each site, widest first (default: %(default)s)")
+    args = parser.parse_args()
+
+    reference = PortReference(args.reference, versions=ALL_VERSIONS, contexts=args.context)
+    print(f"Reference: {reference.version.__name__}, {len(reference.anchors):d} things to find")
+    failed: bool = False
+    for result in port_executables(reference, _expand_paths(args.targets), versions=ALL_VERSIONS, jobs=args.jobs):
+        if result.error is not None:
+            print(f"{result.path}: FAILED: {result.error}")
+            failed = True
+            continue
+        if result.known_as is not None:
+            print(f"{result.path}: already have {result.known_as}")
+            continue
+        class_name: Optional[str] = version_class_name(result)
+        print(f"{result.path}: {class_name or 'no $Version string'}, confidence {overall_confidence(reference, result):.2f}")
+        for spec in reference.specs:
+            for site in spec.sites:
+                match: AnchorMatch = result.anchors[site.anchor]
+                where: str = f"0x{match.addr:08x}" if match.addr is not None else f"found {match.matches:d} times"
+                print(f"- {site.anchor}: {where}, confidence {match.confidence:.2f}")
+        for attr in reference.address_attrs:
+            value, confidence, = _port_address(reference, result, attr)
+            print(f"- {attr}: {'not found' if value is None else f'0x{value:08x}'}, confidence {confidence:.2f}")
+        if args.output is not None and class_name is not None:
+            module_path: str = os.path.join(args.output, class_name[len("TalosVersion_"):] + ".py")
+            with open(module_path, "w") as fp:
+                fp.write(generate_version(reference, result))
+            print(f"  wrote {module_path}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
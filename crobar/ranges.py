@@ -0,0 +1,96 @@
+"""Planning for batched memory transfers.
+
+Several small transfers to nearby addresses are cheaper as one bigger transfer,
+so we sort the requests and glue together anything that's close enough.
+"""
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+
+class CoalescedRange(NamedTuple):
+    """One transfer that serves several of the requested ranges."""
+    addr: int
+    length: int
+    members: Tuple[int, ...]
+
+    @property
+    def end(self) -> int:
+        return self.addr + self.length
+
+
+def coalesce_ranges(ranges: Sequence[Tuple[int, int]], *, max_gap: int) -> List[CoalescedRange]:
+    """Merges (addr, length) ranges which overlap or are at most max_gap bytes apart.
+
+    Each CoalescedRange lists the indices of the requests it covers.
+    Empty requests still get a member slot so that every index is served.
+    """
+    order: List[int] = sorted(range(len(ranges)), key=lambda idx: ranges[idx][0])
+    result: List[CoalescedRange] = []
+
+    cur_addr: int = 0
+    cur_end: int = 0
+    cur_members: List[int] = []
+    for idx in order:
+        addr, length, = ranges[idx]
+        if length < 0:
+            raise ValueError(f"negative length {length:d} for range at 0x{addr:x}")
+        if cur_members and addr <= cur_end + max_gap:
+            cur_end = max(cur_end, addr + length)
+            cur_members.append(idx)
+        else:
+            if cur_members:
+                result.append(CoalescedRange(cur_addr, cur_end - cur_addr, tuple(cur_members)))
+            cur_addr, cur_end, cur_members = addr, addr + length, [idx]
+
+    if cur_members:
+        result.append(CoalescedRange(cur_addr, cur_end - cur_addr, tuple(cur_members)))
+
+    return result
+
+
+def scatter_coalesced(
+        ranges: Sequence[Tuple[int, int]],
+        merged: CoalescedRange,
+        data: bytes,
+        result: List[Optional[bytes]]) -> None:
+    """Hands the data read for a CoalescedRange back out to the original requests."""
+    for idx in merged.members:
+        addr, length, = ranges[idx]
+        offs: int = addr - merged.addr
+        result[idx] = data[offs:offs+length]
+
+
+def coalesce_writes(chunks: Sequence[Tuple[int, bytes]], *, max_gap: int) -> Tuple[List[CoalescedRange], List[bytearray]]:
+    """Merges (addr, data) writes the same way coalesce_ranges() does.
+
+    Where writes overlap, the one that comes later in chunks wins.
+    Returns the plan plus the merged data for each entry in it;
+    any gaps between merged writes are left as zeroes for the caller to fill in.
+    """
+    plan: List[CoalescedRange] = coalesce_ranges(
+        [(addr, len(data)) for addr, data in chunks],
+        max_gap=max_gap)
+
+    merged_data: List[bytearray] = []
+    for merged in plan:
+        buf = bytearray(merged.length)
+        for idx in sorted(merged.members):
+            addr, data, = chunks[idx]
+            buf[addr-merged.addr:addr-merged.addr+len(data)] = data
+        merged_data.append(buf)
+
+    return plan, merged_data
+
+
+def find_gaps(merged: CoalescedRange, chunks: Sequence[Tuple[int, bytes]]) -> List[Tuple[int, int]]:
+    """Returns the (addr, length) holes inside a merged write that no chunk covers."""
+    gaps: List[Tuple[int, int]] = []
+    pos: int = merged.addr
+    for addr, data in sorted((chunks[idx] for idx in merged.members), key=lambda chunk: chunk[0]):
+        if addr > pos:
+            gaps.append((pos, addr - pos))
+        pos = max(pos, addr + len(data))
+    return gaps
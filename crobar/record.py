@@ -0,0 +1,325 @@
+"""Recording everything done to Talos, and playing it back without Talos.
+
+Wrap a DebugInterface in a RecordingDebugInterface, and every read and write
+(address, length, data, and when) gets appended to a log file.
+A ReplayDebugInterface serves those reads back out of memory,
+so whatever ran can be run again, as often as you like, without attaching to anything.
+
+The log starts with a header, followed by one record per operation:
+kind (u8), seconds since the header (f64), address (u64), length (u32),
+then length bytes of data for kinds that carry any. Everything's little-endian.
+
+Replay builds the memory as it was when first seen. Each byte takes its value
+from the first read that covered it, and writes made during replay are seen by later reads.
+Reading anything the recording never saw is an error, since we've no idea what was there.
+"""
+import struct
+import time
+from typing import BinaryIO
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.arch.base import BaseDebugInterface
+
+LOG_MAGIC: bytes = b"CROBARLOG\x00\x01\x00"
+
+# What each record is
+KIND_READ = 1
+KIND_READ_FAILED = 2
+KIND_WRITE = 3
+KIND_WRITE_FAILED = 4
+# The relocation goes in the address field.
+KIND_RELOCATION = 5
+KIND_REGIONS = 6
+KIND_EXECUTABLE = 7
+
+# Kinds which don't carry the data they describe
+_DATALESS_KINDS: Set[int] = {KIND_READ_FAILED, KIND_WRITE_FAILED, KIND_RELOCATION}
+
+_LOG_HEADER = struct.Struct("<12sd")
+_RECORD = struct.Struct("<BdQI")
+
+PAGE_SIZE: int = 0x1000
+
+
+class ReplayException(HackingOpException):
+    """Fires when a replay asks for something the recording doesn't have."""
+    __slots__ = ()
+
+
+class LogRecord(NamedTuple):
+    kind: int
+    # Seconds since the recording started
+    timestamp: float
+    addr: int
+    length: int
+    data: bytes
+
+
+def read_log(path: str) -> Tuple[float, List[LogRecord]]:
+    """Reads a whole log. Returns the time it was started (as time.time()) and every record in it.
+
+    A record cut short at the end, say by a crash, is quietly dropped.
+    """
+    with open(path, "rb") as fp:
+        contents: bytes = fp.read()
+    if len(contents) < _LOG_HEADER.size:
+        raise ReplayException(f"{path!r} is too short to be a crobar log")
+    magic, started, = _LOG_HEADER.unpack_from(contents, 0)
+    if magic != LOG_MAGIC:
+        raise ReplayException(f"{path!r} isn't a crobar log")
+
+    records: List[LogRecord] = []
+    offset: int = _LOG_HEADER.size
+    while offset + _RECORD.size <= len(contents):
+        kind, timestamp, addr, length, = _RECORD.unpack_from(contents, offset)
+        data_length: int = 0 if kind in _DATALESS_KINDS else length
+        if offset + _RECORD.size + data_length > len(contents):
+            break
+        data: bytes = contents[offset+_RECORD.size:offset+_RECORD.size+data_length]
+        records.append(LogRecord(kind=kind, timestamp=timestamp, addr=addr, length=length, data=data))
+        offset += _RECORD.size + data_length
+    return started, records
+
+
+class RecordingDebugInterface(BaseDebugInterface):
+    """Passes everything through to another DebugInterface, and logs it as it goes."""
+    __slots__ = (
+        "path",
+        "_inner",
+        "_fp",
+        "_started",
+        "_relocation",
+        "_executable_logged",
+    )
+
+    def __init__(self, inner: DebugInterface, path: str) -> None:
+        self.path = path
+        self._inner = inner
+        self._started: float = time.perf_counter()
+        self._relocation: Optional[int] = None
+        self._executable_logged: bool = False
+        self._fp: BinaryIO = open(path, "wb")
+        self._fp.write(_LOG_HEADER.pack(LOG_MAGIC, time.time()))
+
+    @property
+    def inner(self) -> DebugInterface:
+        """The DebugInterface we're recording."""
+        return self._inner
+
+    def close(self) -> None:
+        """Finishes the log. The DebugInterface being recorded is left alone."""
+        if not self._fp.closed:
+            self._fp.close()
+
+    def _log(self, kind: int, addr: int, length: int, data: bytes=b"") -> None:
+        self._fp.write(_RECORD.pack(kind, time.perf_counter() - self._started, addr & 0xFFFFFFFFFFFFFFFF, length))
+        if data:
+            self._fp.write(data)
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory from the attached process."""
+        try:
+            data: bytes = self._inner.read_memory(addr=addr, length=length)
+        except HackingOpException:
+            self._log(KIND_READ_FAILED, addr, length)
+            raise
+        self._log(KIND_READ, addr, len(data), data)
+        return data
+
+    def read_many(self, *, ranges: Sequence[Tuple[int, int]], max_gap: Optional[int]=None) -> List[Optional[bytes]]:
+        """Read several (address, length) ranges from the attached process in one go."""
+        result: List[Optional[bytes]] = self._inner.read_many(ranges=ranges, max_gap=max_gap)
+        for (addr, length), data in zip(ranges, result):
+            if data is None:
+                self._log(KIND_READ_FAILED, addr, length)
+            else:
+                self._log(KIND_READ, addr, len(data), data)
+        return result
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Write memory to the attached process."""
+        try:
+            self._inner.write_memory(addr=addr, data=data)
+        except HackingOpException:
+            self._log(KIND_WRITE_FAILED, addr, len(data))
+            raise
+        else:
+            self._log(KIND_WRITE, addr, len(data), data)
+        finally:
+            # Writes are rare and what we most want to see after a crash, so don't sit on them.
+            self._fp.flush()
+
+    def write_many(self, *, chunks: Sequence[Tuple[int, bytes]], max_gap: Optional[int]=None) -> None:
+        """Write several (address, data) chunks to the attached process in one go."""
+        try:
+            self._inner.write_many(chunks=chunks, max_gap=max_gap)
+        except HackingOpException:
+            # We can't tell which got through, so log them all as failed.
+            for addr, data in chunks:
+                self._log(KIND_WRITE_FAILED, addr, len(data))
+            self._fp.flush()
+            raise
+        for addr, data in chunks:
+            self._log(KIND_WRITE, addr, len(data), data)
+        self._fp.flush()
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        if self._relocation is None:
+            self._relocation = self._inner.from_relative_addr(0)
+            self._log(KIND_RELOCATION, self._relocation, 0)
+        return addr + self._relocation
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        regions: Sequence[MemoryRegion] = self._inner.get_memory_regions()
+        packed: bytes = b"".join(region.pack() for region in regions)
+        self._log(KIND_REGIONS, 0, len(packed), packed)
+        return regions
+
+    def get_executable_path(self) -> Optional[str]:
+        """Returns a path the attached process's executable can be opened from, if there is one."""
+        path: Optional[str] = self._inner.get_executable_path()
+        if path is not None and not self._executable_logged:
+            encoded: bytes = path.encode("utf-8", "surrogateescape")
+            self._log(KIND_EXECUTABLE, 0, len(encoded), encoded)
+            self._executable_logged = True
+        return path
+
+
+class ReplayDebugInterface(BaseDebugInterface):
+    """Plays a recording back as if it were the process it was recorded from.
+
+    Nothing gets attached to, and nothing but the log gets read,
+    so get_executable_path() always says there's no executable to look at.
+    reset() puts memory back as it was at the start, for running the same thing again.
+    """
+    __slots__ = (
+        "path",
+        "started",
+        "records",
+        "_initial",
+        "_pages",
+        "_relocation",
+        "_regions",
+        "_failed_writes",
+    )
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.records: List[LogRecord]
+        self.started, self.records, = read_log(path)
+        self._relocation: int = 0
+        self._regions: List[MemoryRegion] = []
+        self._failed_writes: Set[Tuple[int, int]] = set()
+
+        # Page -> (data, mask of which bytes we know)
+        self._initial: Dict[int, Tuple[bytearray, bytearray]] = {}
+        for record in self.records:
+            if record.kind == KIND_READ:
+                self._learn(record.addr, record.data, first_wins=True)
+            elif record.kind == KIND_WRITE:
+                # Whatever was there before this isn't known, but it was overwritten anyway.
+                # Bytes first seen after this show what was written, not what was there.
+                self._learn(record.addr, record.data, first_wins=True)
+            elif record.kind == KIND_WRITE_FAILED:
+                self._failed_writes.add((record.addr, record.length))
+            elif record.kind == KIND_RELOCATION:
+                relocation: int = record.addr
+                self._relocation = relocation - (1 << 64) if relocation >= (1 << 63) else relocation
+            elif record.kind == KIND_REGIONS and not self._regions:
+                self._regions = MemoryRegion.unpack_all(record.data)
+
+        self._pages: Dict[int, Tuple[bytearray, bytearray]] = {}
+        self.reset()
+
+    def _learn(self, addr: int, data: bytes, *, first_wins: bool) -> None:
+        done: int = 0
+        while done < len(data):
+            page: int = (addr + done) & ~(PAGE_SIZE-1)
+            offset: int = addr + done - page
+            piece: int = min(PAGE_SIZE - offset, len(data) - done)
+            page_data, known, = self._initial.setdefault(page, (bytearray(PAGE_SIZE), bytearray(PAGE_SIZE)))
+            if not first_wins or known.find(1, offset, offset + piece) < 0:
+                # None of it's known yet, so take the lot.
+                page_data[offset:offset+piece] = data[done:done+piece]
+                known[offset:offset+piece] = b"\x01" * piece
+            else:
+                for idx in range(offset, offset + piece):
+                    if not known[idx]:
+                        page_data[idx] = data[done + idx - offset]
+                        known[idx] = 1
+            done += piece
+
+    def reset(self) -> None:
+        """Puts memory back as it was when the recording started."""
+        self._pages = {
+            page: (bytearray(page_data), known)
+            for page, (page_data, known) in self._initial.items()}
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory from the attached process."""
+        page: int = addr & ~(PAGE_SIZE-1)
+        offset: int = addr - page
+        if offset + length <= PAGE_SIZE:
+            # Nearly everything fits in a page, so don't bother joining anything.
+            entry: Optional[Tuple[bytearray, bytearray]] = self._pages.get(page)
+            if entry is None or entry[1].find(0, offset, offset + length) >= 0:
+                raise ReplayException(f"the recording never saw {length:d} bytes at 0x{addr:x}")
+            return bytes(entry[0][offset:offset+length])
+
+        result = bytearray()
+        while len(result) < length:
+            result += self.read_memory(
+                addr=addr + len(result),
+                length=min(PAGE_SIZE - ((addr + len(result)) & (PAGE_SIZE-1)), length - len(result)))
+        return bytes(result)
+
+    def read_many(self, *, ranges: Sequence[Tuple[int, int]], max_gap: Optional[int]=None) -> List[Optional[bytes]]:
+        """Read several (address, length) ranges from the attached process in one go."""
+        result: List[Optional[bytes]] = []
+        for addr, length in ranges:
+            try:
+                result.append(self.read_memory(addr=addr, length=length))
+            except ReplayException:
+                result.append(None)
+        return result
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Write memory to the attached process."""
+        if (addr, len(data)) in self._failed_writes:
+            raise ReplayException(f"writing {len(data):d} bytes at 0x{addr:x} failed when recorded")
+        done: int = 0
+        while done < len(data):
+            page: int = (addr + done) & ~(PAGE_SIZE-1)
+            offset: int = addr + done - page
+            piece: int = min(PAGE_SIZE - offset, len(data) - done)
+            if page not in self._pages:
+                self._pages[page] = (bytearray(PAGE_SIZE), bytearray(PAGE_SIZE))
+            page_data, known, = self._pages[page]
+            if page in self._initial and known is self._initial[page][1]:
+                # Shared with the initial state until now.
+                known = bytearray(known)
+                self._pages[page] = (page_data, known)
+            page_data[offset:offset+piece] = data[done:done+piece]
+            known[offset:offset+piece] = b"\x01" * piece
+            done += piece
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        return addr + self._relocation
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        if not self._regions:
+            raise ReplayException(f"the recording never asked for the memory map")
+        return self._regions
@@ -0,0 +1,398 @@
+"""Reading structures out of Talos's memory, described as data.
+
+A StructLayout says where each field of a structure lives and how it's encoded.
+It's compiled once into struct.Struct objects, so decoding doesn't have to
+parse a format string or slice anything.
+
+A RemoteArray is a table of those structures in Talos's memory.
+The whole table comes over in one read, the first time anything in it is wanted.
+column() decodes chosen fields from every record in one pass,
+and indexing gives a RemoteRecord, which only decodes a field once something asks for it.
+
+A PointerResolver follows pointer paths like "[[game_modes]+0x4]" and reads C strings,
+remembering what it read until told to forget it.
+"""
+import re
+import struct
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+
+PAGE_SIZE: int = 0x1000
+
+# Strings get read this many bytes at first, then four times as much each time they haven't ended yet.
+FIRST_STRING_CHUNK: int = 64
+MAX_STRING_LENGTH: int = 4096
+
+
+class Field(NamedTuple):
+    """One field of a structure: where it is, and its struct module format (without a byte order)."""
+    name: str
+    offset: int
+    fmt: str
+
+
+class StructLayout:
+    """How a structure's laid out in memory, ready to decode."""
+    __slots__ = (
+        "name",
+        "size",
+        "fields",
+        "_structs",
+        "_columns",
+    )
+
+    def __init__(self, name: str, size: int, fields: Sequence[Field], *, byte_order: str="<") -> None:
+        self.name = name
+        self.size = size
+        self.fields: Dict[str, Field] = {field.name: field for field in fields}
+        # Field name -> byte order + format
+        self._structs: Dict[str, struct.Struct] = {}
+        # Field names -> one struct covering a whole record, skipping everything else
+        self._columns: Dict[Tuple[str, ...], struct.Struct] = {}
+        for field in fields:
+            compiled = struct.Struct(byte_order + field.fmt)
+            if field.offset < 0 or field.offset + compiled.size > size:
+                raise HackingOpException(f"{name}.{field.name} doesn't fit in 0x{size:x} bytes")
+            self._structs[field.name] = compiled
+
+    def __repr__(self) -> str:
+        return f"<StructLayout {self.name} 0x{self.size:x} bytes, {len(self.fields):d} fields>"
+
+    def offset_of(self, name: str) -> int:
+        return self.fields[name].offset
+
+    def decode(self, name: str, data: bytes, offset: int=0) -> Any:
+        """Decodes one field of the record starting at offset.
+
+        Single-value fields come back as the value, not a 1-tuple.
+        """
+        values: Tuple[Any, ...] = self._structs[name].unpack_from(data, offset + self.fields[name].offset)
+        return values[0] if len(values) == 1 else values
+
+    def encode_into(self, buffer: bytearray, offset: int=0, **values: Any) -> None:
+        """Encodes fields into the record starting at offset."""
+        for name, value in values.items():
+            if not isinstance(value, tuple):
+                value = (value,)
+            self._structs[name].pack_into(buffer, offset + self.fields[name].offset, *value)
+
+    def column_struct(self, names: Sequence[str]) -> struct.Struct:
+        """Returns a struct which pulls the given fields out of a record, in the order given, and skips the rest.
+
+        Compiled the first time it's asked for.
+        """
+        key: Tuple[str, ...] = tuple(names)
+        compiled: Optional[struct.Struct] = self._columns.get(key)
+        if compiled is not None:
+            return compiled
+
+        # struct can't go backwards, so decode in offset order and put them back in the asked-for order afterwards.
+        fmt: List[str] = [self._structs[names[0]].format[0]]
+        pos: int = 0
+        for name in sorted(names, key=self.offset_of):
+            field: Field = self.fields[name]
+            if field.offset < pos:
+                raise HackingOpException(f"{self.name}.{name} overlaps another field asked for")
+            fmt.append(f"{field.offset - pos:d}x{field.fmt}")
+            pos = field.offset + self._structs[name].size
+        fmt.append(f"{self.size - pos:d}x")
+        compiled = struct.Struct("".join(fmt))
+        self._columns[key] = compiled
+        return compiled
+
+
+class RemoteRecord:
+    """One record in a RemoteArray. Fields get decoded the first time they're read, and kept."""
+    __slots__ = (
+        "index",
+        "addr",
+        "_layout",
+        "_data",
+        "_offset",
+        "_values",
+    )
+
+    def __init__(self, *, layout: StructLayout, addr: int, index: int, data: bytes, offset: int) -> None:
+        self.index = index
+        self.addr = addr
+        self._layout = layout
+        self._data = data
+        self._offset = offset
+        self._values: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return self._values[name]
+        except KeyError:
+            value: Any = self._layout.decode(name, self._data, self._offset)
+            self._values[name] = value
+            return value
+
+    def addr_of(self, name: str) -> int:
+        """The absolute address of a field of this record."""
+        return self.addr + self._layout.offset_of(name)
+
+    @property
+    def raw(self) -> bytes:
+        return bytes(self._data[self._offset:self._offset+self._layout.size])
+
+    def __repr__(self) -> str:
+        return f"<{self._layout.name} #{self.index:d} @ 0x{self.addr:x}>"
+
+
+class RemoteArray:
+    """A table of records in the attached process, read all at once when first needed."""
+    __slots__ = (
+        "layout",
+        "addr",
+        "count",
+        "_debug_interface",
+        "_data",
+    )
+
+    def __init__(self, debug_interface: DebugInterface, *, layout: StructLayout, addr: int, count: int) -> None:
+        self.layout = layout
+        self.addr = addr
+        self.count = count
+        self._debug_interface = debug_interface
+        self._data: Optional[bytes] = None
+
+    @property
+    def data(self) -> bytes:
+        """The whole table, as it was when first read."""
+        if self._data is None:
+            self._data = self._debug_interface.read_memory(addr=self.addr, length=self.layout.size * self.count)
+        return self._data
+
+    def refresh(self) -> None:
+        """Forgets what was read, so the next access reads the table again."""
+        self._data = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, idx: int) -> RemoteRecord:
+        if idx < 0:
+            idx += self.count
+        if not (0 <= idx < self.count):
+            raise IndexError(idx)
+        return RemoteRecord(
+            layout=self.layout,
+            addr=self.addr + idx*self.layout.size,
+            index=idx,
+            data=self.data,
+            offset=idx*self.layout.size)
+
+    def __iter__(self) -> Iterator[RemoteRecord]:
+        for idx in range(self.count):
+            yield self[idx]
+
+    def column(self, *names: str) -> List[Tuple[Any, ...]]:
+        """Decodes the given fields from every record, as one tuple per record."""
+        compiled: struct.Struct = self.layout.column_struct(names)
+        rows: Iterator[Tuple[Any, ...]] = compiled.iter_unpack(self.data)
+        order: List[str] = sorted(names, key=self.layout.offset_of)
+        if order == list(names):
+            return list(rows)
+        positions: List[int] = [order.index(name) for name in names]
+        return [tuple(row[pos] for pos in positions) for row in rows]
+
+
+def read_struct(debug_interface: DebugInterface, *, layout: StructLayout, addr: int) -> RemoteRecord:
+    """Reads a single structure."""
+    data: bytes = debug_interface.read_memory(addr=addr, length=layout.size)
+    return RemoteRecord(layout=layout, addr=addr, index=0, data=data, offset=0)
+
+
+def read_c_strings(debug_interface: DebugInterface, addrs: Sequence[int], *, max_length: int=MAX_STRING_LENGTH) -> List[Optional[bytes]]:
+    """Reads a NUL-terminated string from each address, all in one batch, cut off at max_length bytes.
+
+    Strings get read in growing chunks, each stopping at the end of a page,
+    so a short string right before an unmapped page can still be read.
+    Every string still going gets its next chunk in the same batch.
+    Anything that couldn't be read comes back as None.
+    """
+    result: List[Optional[bytes]] = [None] * len(addrs)
+    found: List[bytearray] = [bytearray() for addr in addrs]
+    pending: List[int] = list(range(len(addrs)))
+    chunk: int = FIRST_STRING_CHUNK
+    while pending:
+        ranges: List[Tuple[int, int]] = []
+        for idx in pending:
+            pos: int = addrs[idx] + len(found[idx])
+            ranges.append((pos, min(chunk, PAGE_SIZE - (pos & (PAGE_SIZE-1)), max_length - len(found[idx]))))
+
+        still_pending: List[int] = []
+        for idx, data, in zip(pending, debug_interface.read_many(ranges=ranges, max_gap=0)):
+            if data is None:
+                continue
+            end: int = data.find(b"\x00")
+            found[idx] += data if end < 0 else data[:end]
+            if end >= 0 or len(found[idx]) >= max_length:
+                result[idx] = bytes(found[idx])
+            else:
+                still_pending.append(idx)
+        pending = still_pending
+        chunk *= 4
+    return result
+
+
+# Pointer paths, compiled: an int, a symbol name, ("deref", path) or ("add", path, path)
+PathNode = Any
+
+_PATH_TOKEN = re.compile(r"\s*(?:(0[xX][0-9a-fA-F]+|[0-9]+)|([A-Za-z_][A-Za-z0-9_]*)|(.))")
+
+
+def compile_path(text: str) -> PathNode:
+    """Parses a pointer path like "[[game_modes]+0x4]".
+
+    [x] reads the pointer at x, + and - do what they say,
+    numbers are absolute addresses or offsets, and names are looked up in the symbols given to resolve().
+    """
+    tokens: List[Tuple[str, str]] = []
+    for match in _PATH_TOKEN.finditer(text.strip()):
+        number, name, other, = match.groups()
+        if number is not None:
+            tokens.append(("number", number))
+        elif name is not None:
+            tokens.append(("name", name))
+        else:
+            tokens.append(("op", other))
+    pos: int = 0
+
+    def term() -> PathNode:
+        nonlocal pos
+        if pos >= len(tokens):
+            raise HackingOpException(f"pointer path {text!r} ends too soon")
+        kind, value, = tokens[pos]
+        pos += 1
+        if kind == "number":
+            return int(value, 0)
+        elif kind == "name":
+            return value
+        elif value == "[":
+            inner: PathNode = expr()
+            if pos >= len(tokens) or tokens[pos] != ("op", "]"):
+                raise HackingOpException(f"pointer path {text!r} is missing a ]")
+            pos += 1
+            return ("deref", inner)
+        elif value == "-":
+            return ("neg", term())
+        raise HackingOpException(f"unexpected {value!r} in pointer path {text!r}")
+
+    def expr() -> PathNode:
+        nonlocal pos
+        node: PathNode = term()
+        while pos < len(tokens) and tokens[pos] in (("op", "+"), ("op", "-")):
+            sign: str = tokens[pos][1]
+            pos += 1
+            rhs: PathNode = term()
+            node = ("add", node, rhs if sign == "+" else ("neg", rhs))
+        return node
+
+    node: PathNode = expr()
+    if pos != len(tokens):
+        raise HackingOpException(f"unexpected {tokens[pos][1]!r} in pointer path {text!r}")
+    return node
+
+
+class PointerResolver:
+    """Follows pointer paths and reads C strings, remembering everything it reads until told to forget.
+
+    The game moves things around whenever it likes, so call invalidate() whenever what's
+    been remembered might be out of date: after writing, or whenever the game's had time to change things.
+    """
+    __slots__ = (
+        "_debug_interface",
+        "_pointer",
+        "_paths",
+        "_pointers",
+        "_strings",
+    )
+
+    def __init__(self, debug_interface: DebugInterface, *, pointer_format: str="<I") -> None:
+        self._debug_interface = debug_interface
+        self._pointer = struct.Struct(pointer_format)
+        self._paths: Dict[str, PathNode] = {}
+        # Address -> pointer read from there
+        self._pointers: Dict[int, int] = {}
+        # (address, max length) -> string read from there
+        self._strings: Dict[Tuple[int, int], bytes] = {}
+
+    def invalidate(self, addr: Optional[int]=None, length: int=1) -> None:
+        """Forgets everything read from the given range, or everything at all if no address is given."""
+        if addr is None:
+            self._pointers.clear()
+            self._strings.clear()
+            return
+        end: int = addr + length
+        for pointer_addr in [pointer_addr for pointer_addr in self._pointers if pointer_addr < end and pointer_addr + self._pointer.size > addr]:
+            del self._pointers[pointer_addr]
+        for key in [key for key, value in self._strings.items() if key[0] < end and key[0] + len(value) + 1 > addr]:
+            del self._strings[key]
+
+    def read_pointer(self, addr: int) -> int:
+        try:
+            return self._pointers[addr]
+        except KeyError:
+            value: int
+            value, = self._pointer.unpack(self._debug_interface.read_memory(addr=addr, length=self._pointer.size))
+            self._pointers[addr] = value
+            return value
+
+    def resolve(self, path: str, symbols: Optional[Mapping[str, int]]=None) -> int:
+        """Works out where a pointer path like "[[game_modes]+0x4]" ends up."""
+        node: Optional[PathNode] = self._paths.get(path)
+        if node is None:
+            node = self._paths[path] = compile_path(path)
+        return self._evaluate(node, symbols or {}) & ((1 << (8*self._pointer.size)) - 1)
+
+    def _evaluate(self, node: PathNode, symbols: Mapping[str, int]) -> int:
+        if isinstance(node, int):
+            return node
+        elif isinstance(node, str):
+            try:
+                return symbols[node]
+            except KeyError:
+                raise HackingOpException(f"no symbol named {node!r} in pointer path")
+        elif node[0] == "deref":
+            return self.read_pointer(self._evaluate(node[1], symbols))
+        elif node[0] == "neg":
+            return -self._evaluate(node[1], symbols)
+        else:
+            return self._evaluate(node[1], symbols) + self._evaluate(node[2], symbols)
+
+    def read_c_string(self, addr: int, *, max_length: int=MAX_STRING_LENGTH) -> bytes:
+        """Reads a NUL-terminated string, cut off at max_length bytes."""
+        result: Optional[bytes] = self.read_c_strings([addr], max_length=max_length)[0]
+        if result is None:
+            raise HackingOpException(f"could not read a string at 0x{addr:x}")
+        return result
+
+    def read_c_strings(self, addrs: Sequence[int], *, max_length: int=MAX_STRING_LENGTH) -> List[Optional[bytes]]:
+        """Reads a NUL-terminated string from each address, cut off at max_length bytes.
+
+        Only the ones not already known get read, in one batch.
+        Anything that couldn't be read comes back as None, and isn't remembered.
+        """
+        missing: List[int] = sorted({addr for addr in addrs if (addr, max_length) not in self._strings})
+        if missing:
+            for addr, value, in zip(missing, read_c_strings(self._debug_interface, missing, max_length=max_length)):
+                if value is not None:
+                    self._strings[(addr, max_length)] = value
+        return [self._strings.get((addr, max_length)) for addr in addrs]
+
+
+def make_layout(name: str, size: int, fields: Mapping[str, Tuple[int, str]]) -> StructLayout:
+    """Shorthand for a little-endian StructLayout, from field name -> (offset, format)."""
+    return StructLayout(name, size, [Field(field_name, offset, fmt) for field_name, (offset, fmt) in fields.items()])
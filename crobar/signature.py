@@ -0,0 +1,296 @@
+"""Byte signature scanning, for finding patch sites without hardcoding their addresses.
+
+Signatures are written the way they look in a disassembler:
+
+    f6 44 24 7c 01 0f 85 ?? ?? 00 00
+
+where ?? matches any byte, and a single ? matches any nibble (e.g. 8? or ?5).
+
+All the signatures get scanned for at once. Each one has an "anchor",
+which is its longest run of exact bytes, and a single regex finds every anchor
+in one pass over the data. Only then does the full signature get checked.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import re
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Pattern
+from typing import Sequence
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.buffers import BufferPool
+from crobar.buffers import read_pages_into
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE: int = 4 * 1024 * 1024
+
+
+class SignatureException(HackingOpException):
+    """Fires when a signature can't be parsed, or can't be found where it has to be."""
+    __slots__ = ()
+
+
+def _byte_class(value: int, mask: int) -> bytes:
+    """Returns a regex fragment matching any byte b where b & mask == value."""
+    if mask == 0xFF:
+        return re.escape(bytes([value]))
+    if mask == 0x00:
+        return b"."
+    return b"[" + b"".join(
+        re.escape(bytes([b]))
+        for b in range(256)
+        if (b & mask) == value) + b"]"
+
+
+class Signature:
+    """A byte pattern with wildcards."""
+    __slots__ = (
+        "name",
+        "pattern",
+        "mask",
+        "anchor",
+        "anchor_offset",
+        "_regex",
+    )
+
+    def __init__(self, *, pattern: bytes, mask: bytes, name: Optional[str]=None) -> None:
+        if len(pattern) != len(mask) or len(pattern) == 0:
+            raise SignatureException("signature pattern and mask must be the same non-zero length")
+
+        self.pattern = bytes(p & m for p, m in zip(pattern, mask))
+        self.mask = mask
+        self.name: str = name if name is not None else self.pattern.hex()
+
+        # Find the longest run of exact bytes to search for.
+        best_offset: int = 0
+        best_length: int = 0
+        run_offset: int = 0
+        for idx in range(len(mask) + 1):
+            if idx == len(mask) or mask[idx] != 0xFF:
+                if idx - run_offset > best_length:
+                    best_offset, best_length = run_offset, idx - run_offset
+                run_offset = idx + 1
+        if best_length == 0:
+            raise SignatureException(f"signature {self.name!r} needs at least one exact byte")
+        self.anchor: bytes = self.pattern[best_offset:best_offset+best_length]
+        self.anchor_offset: int = best_offset
+
+        self._regex: Pattern[bytes] = re.compile(
+            b"".join(_byte_class(p, m) for p, m in zip(self.pattern, self.mask)),
+            re.DOTALL)
+
+    @classmethod
+    def parse(cls, text: str, *, name: Optional[str]=None) -> "Signature":
+        """Parses a signature like "85 c0 0f 84 ?? ?? 00 00"."""
+        pattern = bytearray()
+        mask = bytearray()
+        for token in text.split():
+            if len(token) != 2:
+                raise SignatureException(f"bad signature byte {token!r} in {text!r}")
+            value: int = 0
+            byte_mask: int = 0
+            for nibble in token:
+                value <<= 4
+                byte_mask <<= 4
+                if nibble != "?":
+                    try:
+                        value |= int(nibble, 16)
+                    except ValueError:
+                        raise SignatureException(f"bad signature byte {token!r} in {text!r}")
+                    byte_mask |= 0xF
+            pattern.append(value)
+            mask.append(byte_mask)
+        return cls(pattern=bytes(pattern), mask=bytes(mask), name=name)
+
+    @classmethod
+    def exact(cls, data: bytes, *, name: Optional[str]=None) -> "Signature":
+        """Makes a signature that matches exactly these bytes."""
+        return cls(pattern=data, mask=b"\xFF" * len(data), name=name)
+
+    def overlay(self, offset: int, data: bytes, *, name: Optional[str]=None) -> "Signature":
+        """Makes a copy of this signature with data written over it at offset.
+
+        Handy for finding a site after it's been patched.
+        """
+        if offset < 0 or offset + len(data) > len(self.pattern):
+            raise SignatureException(f"can't overlay {len(data):d} bytes at offset {offset:d} of signature {self.name!r}")
+        pattern = bytearray(self.pattern)
+        mask = bytearray(self.mask)
+        pattern[offset:offset+len(data)] = data
+        mask[offset:offset+len(data)] = b"\xFF" * len(data)
+        return Signature(pattern=bytes(pattern), mask=bytes(mask), name=name)
+
+    def __len__(self) -> int:
+        return len(self.pattern)
+
+    def __repr__(self) -> str:
+        return f"Signature({self.name!r})"
+
+    def __str__(self) -> str:
+        return " ".join(
+            "".join(
+                f"{(p >> shift) & 0xF:x}" if (m >> shift) & 0xF else "?"
+                for shift in (4, 0))
+            for p, m in zip(self.pattern, self.mask))
+
+    def matches_at(self, data: bytes, offs: int) -> bool:
+        """Returns True if the signature matches data at offs."""
+        return offs >= 0 and self._regex.match(data, offs) is not None
+
+
+class SignatureMatch(NamedTuple):
+    signature: Signature
+    addr: int
+
+
+class SignatureScanner:
+    """Finds every match of a set of signatures in one pass."""
+    __slots__ = (
+        "signatures",
+        "_anchor_regex",
+        "_by_first_byte",
+        "_max_length",
+    )
+
+    def __init__(self, signatures: Iterable[Signature]) -> None:
+        self.signatures: List[Signature] = list(signatures)
+        if not self.signatures:
+            raise SignatureException("need at least one signature to scan for")
+
+        # Longest first, so that a short anchor doesn't hide a long one at the same spot.
+        # Anything else starting at the same spot gets picked up by _by_first_byte.
+        anchors: List[bytes] = sorted({sig.anchor for sig in self.signatures}, key=len, reverse=True)
+        self._anchor_regex: Pattern[bytes] = re.compile(
+            b"|".join(re.escape(anchor) for anchor in anchors),
+            re.DOTALL)
+
+        self._by_first_byte: Dict[int, List[Signature]] = {}
+        for sig in self.signatures:
+            self._by_first_byte.setdefault(sig.anchor[0], []).append(sig)
+
+        self._max_length: int = max(len(sig) for sig in self.signatures)
+
+    def scan_buffer(self, data: bytes, *, base_addr: int=0, start: int=0, end: Optional[int]=None) -> List[SignatureMatch]:
+        """Returns every match that starts within data[start:end].
+
+        Matches may run past end, as long as they fit in data.
+        """
+        if end is None:
+            end = len(data)
+
+        result: List[SignatureMatch] = []
+        search_end: int = min(len(data), end + self._max_length)
+        pos: int = start
+        while True:
+            m = self._anchor_regex.search(data, pos, search_end)
+            if m is None:
+                break
+            hit: int = m.start()
+            for sig in self._by_first_byte[data[hit]]:
+                sig_start: int = hit - sig.anchor_offset
+                if (start <= sig_start < end
+                        and data.startswith(sig.anchor, hit)
+                        and sig.matches_at(data, sig_start)):
+                    result.append(SignatureMatch(sig, base_addr + sig_start))
+            # Step one byte at a time so that overlapping matches don't hide each other.
+            pos = hit + 1
+
+        return result
+
+    def scan(
+            self,
+            debug_interface: DebugInterface,
+            *,
+            regions: Optional[Sequence[MemoryRegion]]=None,
+            chunk_size: int=DEFAULT_CHUNK_SIZE,
+            workers: Optional[int]=None) -> List[SignatureMatch]:
+        """Scans the attached process. Defaults to all executable regions.
+
+        Regions are read in big chunks across a thread pool, so that reading
+        one chunk overlaps with scanning another.
+        Chunks the pool can't read get read again here a page at a time,
+        and pages that still can't be read are skipped.
+        """
+        if regions is None:
+            regions = [region for region in debug_interface.get_memory_regions() if region.executable and region.readable]
+
+        # Glue together regions which touch, so that nothing falls through the cracks between them.
+        spans: List[Tuple[int, int]] = []
+        for region in sorted(regions, key=lambda region: region.start):
+            if spans and spans[-1][1] == region.start:
+                spans[-1] = (spans[-1][0], region.end)
+            else:
+                spans.append((region.start, region.end))
+
+        # Each chunk overlaps the next by enough to catch any match straddling them.
+        overlap: int = self._max_length - 1
+        chunks: List[Tuple[int, int, int]] = []
+        for span_start, span_end in spans:
+            for chunk_start in range(span_start, span_end, chunk_size):
+                chunk_end: int = min(chunk_start + chunk_size, span_end)
+                chunks.append((chunk_start, chunk_end, min(chunk_end + overlap, span_end)))
+
+        # Nearly every chunk is the same size, so each worker keeps reading into the same few buffers.
+        pool = BufferPool()
+
+        def scan_chunk(chunk: Tuple[int, int, int]) -> Optional[List[SignatureMatch]]:
+            chunk_start, chunk_end, read_end, = chunk
+            with pool.borrow(read_end - chunk_start) as data:
+                if not debug_interface.try_read_into(addr=chunk_start, buffer=data):
+                    return None
+                return self.scan_buffer(data, base_addr=chunk_start, end=chunk_end - chunk_start)
+
+        def scan_chunk_slowly(chunk: Tuple[int, int, int]) -> List[SignatureMatch]:
+            chunk_start, chunk_end, read_end, = chunk
+            with pool.borrow(read_end - chunk_start) as data:
+                try:
+                    debug_interface.read_into(addr=chunk_start, buffer=data)
+                    return self.scan_buffer(data, base_addr=chunk_start, end=chunk_end - chunk_start)
+                except HackingOpException:
+                    pass
+
+                # Scan each run that could be read on its own, so that nothing matches across a hole.
+                result: List[SignatureMatch] = []
+                readable: List[Tuple[int, int]] = read_pages_into(debug_interface, addr=chunk_start, buffer=data)
+                missing: int = len(data) - sum(end - start for start, end in readable)
+                if missing != 0:
+                    logger.warning("Skipping %d unreadable bytes between %08X and %08X", missing, chunk_start, read_end)
+                for start, end in readable:
+                    if start < chunk_end - chunk_start:
+                        result += self.scan_buffer(
+                            bytes(data[start:end]),
+                            base_addr=chunk_start + start,
+                            end=min(end, chunk_end - chunk_start) - start)
+                return result
+
+        result: List[SignatureMatch] = []
+        with ThreadPoolExecutor(max_workers=(workers or min(8, (os.cpu_count() or 1) + 1))) as executor:
+            for chunk, matches in zip(chunks, executor.map(scan_chunk, chunks)):
+                # The pool can't do everything, so whatever it couldn't gets done here.
+                if matches is None:
+                    matches = scan_chunk_slowly(chunk)
+                result += matches
+
+        result.sort(key=lambda match: match.addr)
+        return result
+
+    def find_all(
+            self,
+            debug_interface: DebugInterface,
+            *,
+            regions: Optional[Sequence[MemoryRegion]]=None) -> Dict[str, List[int]]:
+        """Scans the attached process, and returns the addresses found for each signature by name."""
+        result: Dict[str, List[int]] = {sig.name: [] for sig in self.signatures}
+        for match in self.scan(debug_interface, regions=regions):
+            result[match.signature.name].append(match.addr)
+        return result
+
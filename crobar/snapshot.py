@@ -0,0 +1,404 @@
+"""Copying all of Talos's memory into a file, and looking at it again later without Talos.
+
+take_snapshot() walks every readable region of the attached process,
+reading it in big chunks across a thread pool, and writes it all out as one file.
+Chunks the pool can't read get read again a page at a time on the calling thread.
+A SnapshotDebugInterface maps that file back in, and serves reads straight out of it.
+It's read-only, but anything that only reads (identifying, verifying, --find) works on it.
+
+The file is a header, then the data, then an index saying which addresses ended up where:
+- blocks which were all zeros aren't stored at all,
+- blocks which couldn't be read aren't stored either, and reading them is an error,
+- with compression on, blocks which zlib shrinks get stored compressed, and everything else as is.
+Uncompressed blocks are read straight out of the mapped file, without being copied first.
+
+Talos keeps running while this happens, unless it's been stopped for the session,
+so a snapshot of a busy game may not all be from quite the same moment.
+"""
+import bisect
+import collections
+import mmap
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import ReadableBuffer
+from crobar.api import WritableBuffer
+from crobar.arch.base import BaseDebugInterface
+from crobar.buffers import BufferPool
+from crobar.buffers import read_pages_into
+
+SNAPSHOT_MAGIC: bytes = b"CROBARSNAP\x00\x01"
+
+# How much each read asks for
+DEFAULT_CHUNK_SIZE: int = 4 * 1024 * 1024
+
+# How finely chunks get split up, when looking for zeros and compressing
+BLOCK_SIZE: int = 64 * 1024
+
+PAGE_SIZE: int = 0x1000
+
+# Fast, since the whole point is to be quick
+COMPRESS_LEVEL: int = 1
+
+# How many decompressed blocks to hang on to while reading
+MAX_DECOMPRESSED: int = 8
+
+# How each block is stored
+BLOCK_RAW = 1
+BLOCK_ZLIB = 2
+# All zeros, so nothing stored
+BLOCK_ZERO = 3
+# Couldn't be read, so nothing stored
+BLOCK_MISSING = 4
+
+FLAG_COMPRESSED = 0x1
+
+# magic, time.time() when taken, relocation, flags, index offset, index length
+_HEADER = struct.Struct("<12sdqBQQ")
+# region count, block count, executable path length, then the path, regions and blocks
+_INDEX = struct.Struct("<IIH")
+# addr, length, kind, offset in the file, length in the file
+_BLOCK = struct.Struct("<QIBQI")
+
+_ZEROS = memoryview(bytes(BLOCK_SIZE))
+
+
+class SnapshotException(HackingOpException):
+    """Fires when a snapshot can't be made or read, or doesn't have what's asked of it."""
+    __slots__ = ()
+
+
+class SnapshotBlock(NamedTuple):
+    """One run of memory in a snapshot, and where it ended up in the file."""
+    addr: int
+    length: int
+    kind: int
+    # Where its data starts in the file, and how many bytes of it there are
+    offset: int = 0
+    stored: int = 0
+
+
+class SnapshotStats:
+    """Counters for how big a snapshot was, and how long it took."""
+    __slots__ = (
+        "regions",
+        "mapped_bytes",
+        "stored_bytes",
+        "zero_bytes",
+        "missing_bytes",
+        "elapsed",
+    )
+
+    def __init__(self) -> None:
+        self.regions: int = 0
+        self.mapped_bytes: int = 0
+        self.stored_bytes: int = 0
+        self.zero_bytes: int = 0
+        self.missing_bytes: int = 0
+        self.elapsed: float = 0.0
+
+    def __repr__(self) -> str:
+        rate: float = self.mapped_bytes / self.elapsed / 1e6 if self.elapsed else 0.0
+        return (
+            f"{self.mapped_bytes/1e6:.1f} MB from {self.regions:d} regions in {self.elapsed:.2f} s ({rate:.0f} MB/s), "
+            f"{self.stored_bytes/1e6:.1f} MB stored, {self.zero_bytes/1e6:.1f} MB zeros, {self.missing_bytes/1e6:.1f} MB unreadable")
+
+
+# What a chunk comes back from the thread pool as: (addr, length, kind, data) pieces, and the buffer the data's in
+_Piece = Tuple[int, int, int, Optional[ReadableBuffer]]
+
+
+def take_snapshot(
+        debug_interface: DebugInterface,
+        path: str,
+        *,
+        compress: bool=False,
+        regions: Optional[Sequence[MemoryRegion]]=None,
+        chunk_size: int=DEFAULT_CHUNK_SIZE,
+        workers: Optional[int]=None) -> SnapshotStats:
+    """Copies every readable region of the attached process into a snapshot file.
+
+    Chunks get read (and compressed) across a thread pool, and written out in order as they finish.
+    Reading from the pool goes through try_read_into(), and whatever that can't manage
+    gets read here instead, since read_into() only works on the thread that attached.
+    Only a few chunks are ever in flight at once, so this takes about as much memory
+    however big the process is.
+    """
+    if chunk_size <= 0 or chunk_size % PAGE_SIZE != 0:
+        raise SnapshotException(f"chunk size has to be a multiple of {PAGE_SIZE:d}")
+    start: float = time.perf_counter()
+    taken: float = time.time()
+    stats = SnapshotStats()
+    all_regions: Sequence[MemoryRegion] = debug_interface.get_memory_regions()
+    if regions is None:
+        regions = [region for region in all_regions if region.readable]
+    stats.regions = len(regions)
+
+    chunks: List[Tuple[int, int]] = [
+        (chunk_addr, min(chunk_size, region.end - chunk_addr))
+        for region in sorted(regions, key=lambda region: region.start)
+        for chunk_addr in range(region.start, region.end, chunk_size)]
+    stats.mapped_bytes = sum(length for addr, length in chunks)
+
+    pool = BufferPool()
+
+    def pack_block(addr: int, buf: bytearray, offs: int, length: int) -> _Piece:
+        if buf.startswith(_ZEROS[:length], offs):
+            return (addr, length, BLOCK_ZERO, None)
+        data = memoryview(buf)[offs:offs+length]
+        if compress:
+            packed: bytes = zlib.compress(data, COMPRESS_LEVEL)
+            if len(packed) < length:
+                return (addr, length, BLOCK_ZLIB, packed)
+        return (addr, length, BLOCK_RAW, data)
+
+    def pack_chunk(addr: int, buf: bytearray, readable: List[Tuple[int, int]]) -> List[_Piece]:
+        # readable is (start, end) offsets of what could be read
+        length: int = len(buf)
+        pieces: List[_Piece] = []
+        pos: int = 0
+        for readable_start, readable_end in readable:
+            if readable_start > pos:
+                pieces.append((addr + pos, readable_start - pos, BLOCK_MISSING, None))
+            for offs in range(readable_start, readable_end, BLOCK_SIZE):
+                pieces.append(pack_block(addr + offs, buf, offs, min(BLOCK_SIZE, readable_end - offs)))
+            pos = readable_end
+        if pos < length:
+            pieces.append((addr + pos, length - pos, BLOCK_MISSING, None))
+        return pieces
+
+    def read_chunk(chunk: Tuple[int, int]) -> Tuple[bytearray, Optional[List[_Piece]]]:
+        addr, length, = chunk
+        buf: bytearray = pool.acquire(length)
+        if not debug_interface.try_read_into(addr=addr, buffer=buf):
+            return buf, None
+        return buf, pack_chunk(addr, buf, [(0, length)])
+
+    def read_chunk_slowly(chunk: Tuple[int, int], buf: bytearray) -> List[_Piece]:
+        addr, length, = chunk
+        readable: List[Tuple[int, int]]
+        try:
+            debug_interface.read_into(addr=addr, buffer=buf)
+            readable = [(0, length)]
+        except HackingOpException:
+            # Something in there can't be read. Go a page at a time to find out what.
+            readable = read_pages_into(debug_interface, addr=addr, buffer=buf)
+        return pack_chunk(addr, buf, readable)
+
+    blocks: List[SnapshotBlock] = []
+
+    def write_chunk(fp: BinaryIO, chunk: Tuple[int, int], buf: bytearray, pieces: Optional[List[_Piece]]) -> None:
+        if pieces is None:
+            # The pool couldn't read this one, so it gets read here instead.
+            pieces = read_chunk_slowly(chunk, buf)
+        for addr, length, kind, data, in pieces:
+            offset: int = fp.tell()
+            stored: int = 0
+            if data is not None:
+                fp.write(data)
+                stored = memoryview(data).nbytes
+                stats.stored_bytes += stored
+            elif kind == BLOCK_ZERO:
+                stats.zero_bytes += length
+            else:
+                stats.missing_bytes += length
+
+            # Glue it onto the last block if it carries straight on from it, to keep the index small.
+            if blocks and kind != BLOCK_ZLIB:
+                last: SnapshotBlock = blocks[-1]
+                if (last.kind == kind
+                        and last.addr + last.length == addr
+                        and last.offset + last.stored == offset):
+                    blocks[-1] = last._replace(length=last.length + length, stored=last.stored + stored)
+                    continue
+            blocks.append(SnapshotBlock(addr=addr, length=length, kind=kind, offset=offset, stored=stored))
+        pool.release(buf)
+
+    relocation: int = debug_interface.from_relative_addr(0)
+    # /proc/<pid>/exe won't mean much once the process is gone, so save where it actually leads.
+    executable_path: Optional[str] = debug_interface.get_executable_path()
+    executable: bytes = (os.path.realpath(executable_path) if executable_path else "").encode("utf-8", "surrogateescape")
+    max_workers: int = workers or min(8, (os.cpu_count() or 1) + 1)
+    with open(path, "wb") as fp:
+        # The index goes in the header once there is one. Until then, this says the snapshot's unfinished.
+        fp.write(_HEADER.pack(SNAPSHOT_MAGIC, taken, relocation, 0, 0, 0))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending: Deque[Tuple[Tuple[int, int], "Future[Tuple[bytearray, Optional[List[_Piece]]]]"]] = collections.deque()
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(read_chunk, chunk)))
+                if len(pending) >= max_workers * 2:
+                    done_chunk, future, = pending.popleft()
+                    write_chunk(fp, done_chunk, *future.result())
+            while pending:
+                done_chunk, future, = pending.popleft()
+                write_chunk(fp, done_chunk, *future.result())
+
+        index_offset: int = fp.tell()
+        fp.write(_INDEX.pack(len(all_regions), len(blocks), len(executable)))
+        fp.write(executable)
+        for region in all_regions:
+            fp.write(region.pack())
+        for block in blocks:
+            fp.write(_BLOCK.pack(*block))
+        index_length: int = fp.tell() - index_offset
+        fp.seek(0)
+        fp.write(_HEADER.pack(
+            SNAPSHOT_MAGIC,
+            taken,
+            relocation,
+            (FLAG_COMPRESSED if compress else 0),
+            index_offset,
+            index_length))
+
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+class SnapshotDebugInterface(BaseDebugInterface):
+    """Serves reads out of a snapshot file, as if it were the process it was taken from.
+
+    Writing to it is an error. So is reading anything that wasn't mapped readable,
+    or couldn't be read, when the snapshot was taken.
+    """
+    __slots__ = (
+        "path",
+        "taken",
+        "compressed",
+        "executable",
+        "_fp",
+        "_data",
+        "_view",
+        "_relocation",
+        "_regions",
+        "_blocks",
+        "_starts",
+        "_decompressed",
+    )
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._fp = open(path, "rb")
+        try:
+            self._data = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fp.close()
+            raise SnapshotException(f"{path!r} is empty")
+        self._view = memoryview(self._data)
+        try:
+            self._load_index()
+        except (struct.error, SnapshotException):
+            self.close()
+            raise
+        # Block index -> its data, most recently used last
+        self._decompressed: Dict[int, bytes] = {}
+
+    def _load_index(self) -> None:
+        if len(self._data) < _HEADER.size:
+            raise SnapshotException(f"{self.path!r} is too short to be a crobar snapshot")
+        magic, taken, relocation, flags, index_offset, index_length, = _HEADER.unpack_from(self._data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotException(f"{self.path!r} isn't a crobar snapshot")
+        if index_offset == 0 or index_offset + index_length > len(self._data):
+            raise SnapshotException(f"{self.path!r} was never finished")
+        self.taken: float = taken
+        self.compressed: bool = bool(flags & FLAG_COMPRESSED)
+        self._relocation: int = relocation
+
+        region_count, block_count, executable_length, = _INDEX.unpack_from(self._data, index_offset)
+        offset: int = index_offset + _INDEX.size
+        executable: str = bytes(self._data[offset:offset+executable_length]).decode("utf-8", "surrogateescape")
+        # Where the process's executable was, for reference. It may well not be there any more.
+        self.executable: Optional[str] = executable or None
+        offset += executable_length
+        self._regions: List[MemoryRegion] = []
+        for idx in range(region_count):
+            region, offset, = MemoryRegion.unpack_from(self._data, offset)  # type: ignore[arg-type]
+            self._regions.append(region)
+        self._blocks: List[SnapshotBlock] = sorted(
+            (SnapshotBlock(*_BLOCK.unpack_from(self._data, offset + idx * _BLOCK.size)) for idx in range(block_count)),
+            key=lambda block: block.addr)
+        self._starts: List[int] = [block.addr for block in self._blocks]
+
+    @property
+    def blocks(self) -> Sequence[SnapshotBlock]:
+        return self._blocks
+
+    def close(self) -> None:
+        """Unmaps the file. Safe to call more than once."""
+        if not self._data.closed:
+            self._view.release()
+            self._data.close()
+        self._fp.close()
+
+    def _block_data(self, idx: int) -> memoryview:
+        block: SnapshotBlock = self._blocks[idx]
+        if block.kind == BLOCK_RAW:
+            return self._view[block.offset:block.offset+block.length]
+
+        data: Optional[bytes] = self._decompressed.pop(idx, None)
+        if data is None:
+            data = zlib.decompress(self._view[block.offset:block.offset+block.stored])
+            if len(self._decompressed) >= MAX_DECOMPRESSED:
+                del self._decompressed[next(iter(self._decompressed))]
+        self._decompressed[idx] = data
+        return memoryview(data)
+
+    def read_into(self, *, addr: int, buffer: WritableBuffer) -> None:
+        """Fills a buffer with memory as it was when the snapshot was taken, starting at addr."""
+        view = memoryview(buffer).cast("B")
+        done: int = 0
+        while done < len(view):
+            here: int = addr + done
+            idx: int = bisect.bisect_right(self._starts, here) - 1
+            block: Optional[SnapshotBlock] = self._blocks[idx] if idx >= 0 else None
+            if block is None or here >= block.addr + block.length:
+                raise SnapshotException(f"the snapshot has nothing at 0x{here:x}")
+            if block.kind == BLOCK_MISSING:
+                raise SnapshotException(f"0x{here:x} couldn't be read when the snapshot was taken")
+
+            offs: int = here - block.addr
+            piece: int = min(block.length - offs, len(view) - done)
+            if block.kind == BLOCK_ZERO:
+                while piece > 0:
+                    zeros: int = min(piece, len(_ZEROS))
+                    view[done:done+zeros] = _ZEROS[:zeros]
+                    done += zeros
+                    piece -= zeros
+            else:
+                view[done:done+piece] = self._block_data(idx)[offs:offs+piece]
+                done += piece
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory as it was when the snapshot was taken."""
+        if length <= 0:
+            return b""
+        result = bytearray(length)
+        self.read_into(addr=addr, buffer=result)
+        return bytes(result)
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Snapshots are read-only, so this always fails."""
+        raise SnapshotException(f"can't write {len(data):d} bytes at 0x{addr:x}: snapshots are read-only")
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        return addr + self._relocation
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped when the snapshot was taken, lowest address first."""
+        return self._regions
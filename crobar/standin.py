@@ -0,0 +1,264 @@
+"""A stand-in for Talos, for when you don't have the game handy.
+
+Run it with `python -m crobar.standin` and it maps a synthetic image at the real addresses of a version,
+with the version string, the original bytes at every patch site,
+and a game mode table for upgrade_singleplayer to find.
+It then sits there until killed, under a name crobar will recognise as Talos.
+
+The image is built from the version's own manifest, so it keeps up with it.
+Pages holding patch sites are made read-only and executable, like a real text section.
+
+The stand-in's executable is Python, not Talos, so attach to it with relocate=False.
+Linux only.
+"""
+import argparse
+import ctypes
+import mmap
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Type
+
+from crobar.api import HackingOpException
+from crobar.api import MemoryRegion
+from crobar.api import PatchSite
+from crobar.api import TalosVersion
+from crobar.arch.base import BaseDebugInterface
+from crobar.remote import StructLayout
+from crobar.versions import VersionEntry
+from crobar.versions import find_version as find_version_entry
+
+PAGE_SIZE: int = 0x1000
+
+STANDIN_NAME: str = "Talos_standin"
+
+GAME_MODE_NAMES: Sequence[bytes] = (b"Cooperative", b"SinglePlayer", b"Deathmatch", b"TeamDeathmatch")
+
+# Free space after everything else, for benchmarks to scribble on
+SCRATCH_SIZE: int = 16 * 1024 * 1024
+
+
+class StandinImage(NamedTuple):
+    """Everything that goes into a stand-in's memory."""
+    version: Type[TalosVersion]
+    start: int
+    end: int
+    # Pages that get made read-only, like the text section
+    code_pages: Sequence[int]
+    scratch: int
+    # Page address -> contents, for pages that aren't all zeroes
+    pages: Dict[int, bytes]
+
+
+class _ImageBuilder(BaseDebugInterface):
+    """A sparse, zero-filled address space, for versions to poke at while we build the image."""
+    __slots__ = (
+        "pages",
+    )
+
+    def __init__(self) -> None:
+        self.pages: Dict[int, bytearray] = {}
+
+    def read_memory(self, *, addr: int, length: int) -> bytes:
+        """Read memory from the attached process."""
+        result = bytearray()
+        while len(result) < length:
+            page: int = (addr + len(result)) & ~(PAGE_SIZE-1)
+            offset: int = addr + len(result) - page
+            piece: int = min(PAGE_SIZE - offset, length - len(result))
+            data: Optional[bytearray] = self.pages.get(page)
+            result += data[offset:offset+piece] if data is not None else bytes(piece)
+        return bytes(result)
+
+    def write_memory(self, *, addr: int, data: bytes) -> None:
+        """Write memory to the attached process."""
+        done: int = 0
+        while done < len(data):
+            page: int = (addr + done) & ~(PAGE_SIZE-1)
+            offset: int = addr + done - page
+            piece: int = min(PAGE_SIZE - offset, len(data) - done)
+            self.pages.setdefault(page, bytearray(PAGE_SIZE))[offset:offset+piece] = data[done:done+piece]
+            done += piece
+
+    def from_relative_addr(self, addr: int) -> int:
+        """Converts a relative-to-intended-memory-base address to an absolute address."""
+        return addr
+
+    def get_memory_regions(self) -> Sequence[MemoryRegion]:
+        """Returns every region mapped in the attached process, lowest address first."""
+        return [
+            MemoryRegion(start=page, end=page+PAGE_SIZE, readable=True, writable=True, executable=False)
+            for page in sorted(self.pages)]
+
+
+def _align_up(addr: int, alignment: int) -> int:
+    return (addr + alignment - 1) & ~(alignment - 1)
+
+
+def build_image(version_type: Type[TalosVersion]) -> StandinImage:
+    """Works out what a stand-in for a version should have in memory. Doesn't map anything."""
+    builder = _ImageBuilder()
+    ver_addr, ver_string, = version_type.get_version_identifier()
+    builder.write_memory(addr=ver_addr, data=ver_string)
+
+    # The game mode table goes on its own pages just past the list pointing at it, like a heap would.
+    list_addr: Optional[int] = getattr(version_type, "game_mode_list_addr", None)
+    list_layout: Optional[StructLayout] = getattr(version_type, "game_mode_list_layout", None)
+    layout: Optional[StructLayout] = getattr(version_type, "game_mode_layout", None)
+    if list_addr is not None and list_layout is not None and layout is not None:
+        table_addr: int = _align_up(list_addr + list_layout.size, 0x10000)
+        names_addr: int = table_addr + len(GAME_MODE_NAMES) * layout.size
+        game_mode_list = bytearray(list_layout.size)
+        list_layout.encode_into(game_mode_list, base=table_addr, count=len(GAME_MODE_NAMES))
+        builder.write_memory(addr=list_addr, data=bytes(game_mode_list))
+        table = bytearray(len(GAME_MODE_NAMES) * layout.size)
+        for idx, name in enumerate(GAME_MODE_NAMES):
+            layout.encode_into(table, idx*layout.size, name=names_addr + idx*32)
+            builder.write_memory(addr=names_addr + idx*32, data=name + b"\x00")
+        builder.write_memory(addr=table_addr, data=bytes(table))
+
+    talos_version: TalosVersion = version_type(debug_interface=builder)
+    code_pages: Set[int] = set()
+    for spec in talos_version.get_patch_manifest():
+        sites: List[PatchSite] = [site for site in spec.sites if isinstance(site, PatchSite)]
+        for site in sites:
+            code_pages.update(range(site.addr & ~(PAGE_SIZE-1), site.addr + len(site.old), PAGE_SIZE))
+        if spec.locate is not None:
+            # Whatever it finds goes in the data, not the code.
+            sites += [site for site in spec.locate() if isinstance(site, PatchSite)]
+        for site in sites:
+            builder.write_memory(addr=site.addr, data=site.old)
+
+    start: int = min(builder.pages)
+    scratch: int = _align_up(max(builder.pages) + PAGE_SIZE, 0x10000)
+    return StandinImage(
+        version=version_type,
+        start=start,
+        end=scratch + SCRATCH_SIZE,
+        code_pages=sorted(code_pages),
+        scratch=scratch,
+        pages={page: bytes(data) for page, data in builder.pages.items()})
+
+
+def find_version(name: Optional[str]=None) -> Type[TalosVersion]:
+    """Looks up a version by class name. Defaults to the Linux one."""
+    entry: Optional[VersionEntry] = find_version_entry(name or "TalosVersion_v244371_linux_x86_32")
+    if entry is None:
+        raise HackingOpException(f"no version named {name!r}")
+    return entry.load()
+
+
+def map_image(image: StandinImage) -> None:
+    """Maps a stand-in image into this process. Fails if anything's already there."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.mprotect.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+
+    # Only a hint, so it lands somewhere else rather than on top of something.
+    length: int = image.end - image.start
+    addr: Optional[int] = libc.mmap(
+        image.start,
+        length,
+        mmap.PROT_READ | mmap.PROT_WRITE,
+        mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS,
+        -1,
+        0)
+    if addr != image.start:
+        if addr not in (None, ctypes.c_void_p(-1).value):
+            libc.munmap(ctypes.c_void_p(addr), ctypes.c_size_t(length))
+        raise HackingOpException(f"could not map 0x{image.start:x}-0x{image.end:x}, something's already there")
+
+    for page, data in image.pages.items():
+        ctypes.memmove(page, data, len(data))
+    for page in image.code_pages:
+        libc.mprotect(page, PAGE_SIZE, mmap.PROT_READ | mmap.PROT_EXEC)
+
+
+def _set_process_name(name: str) -> None:
+    # PR_SET_NAME, which is what ends up in /proc/<pid>/stat
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.prctl(15, name.encode("utf-8")[:15], 0, 0, 0)
+
+
+def python_env() -> Dict[str, str]:
+    """The environment for a fresh Python, with crobar importable from wherever this one got it."""
+    env: Dict[str, str] = dict(os.environ)
+    package_parent: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_parent, env.get("PYTHONPATH")]))
+    return env
+
+
+class StandinProcess:
+    """Runs a stand-in in a child process, for as long as this is open."""
+    __slots__ = (
+        "image",
+        "pid",
+        "_proc",
+    )
+
+    def __init__(self, version_type: Optional[Type[TalosVersion]]=None, *, threads: int=0) -> None:
+        self.image: StandinImage = build_image(version_type or find_version())
+        self._proc = subprocess.Popen(
+            [sys.executable, "-m", "crobar.standin", "--version", self.image.version.__name__, "--threads", str(threads)],
+            env=python_env(),
+            stdout=subprocess.PIPE,
+            text=True)
+        assert self._proc.stdout is not None
+        # It prints its PID once everything's mapped.
+        if not self._proc.stdout.readline().strip().isdigit():
+            self.close()
+            raise HackingOpException(f"the stand-in didn't start")
+        self.pid: int = self._proc.pid
+
+    def __enter__(self) -> "StandinProcess":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        if self._proc.stdout is not None:
+            self._proc.stdout.close()
+
+
+def _tick() -> None:
+    # Wake up often, like a game would.
+    while True:
+        time.sleep(0.001)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="crobar.standin", description="Pretend to be Talos.")
+    parser.add_argument("--version", help="which version to pretend to be (default: the Linux one)")
+    parser.add_argument("--threads", type=int, default=0, help="start this many extra threads, so there's more to freeze")
+    args = parser.parse_args()
+
+    image: StandinImage = build_image(find_version(args.version))
+    map_image(image)
+    _set_process_name(STANDIN_NAME)
+
+    for idx in range(args.threads):
+        threading.Thread(target=_tick, daemon=True).start()
+
+    # The PID tells whoever started us that the image is ready.
+    print(os.getpid(), flush=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    while True:
+        signal.pause()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,81 @@
+"""Every version we know about, without loading any of them until we need one.
+
+Each version gets a VersionEntry here, saying where its version string lives and what it says.
+That's all identifying a build takes, so a version's module only gets imported once it matches,
+and knowing about dozens of builds costs next to nothing at startup.
+"""
+import importlib
+from typing import NamedTuple
+from typing import Optional
 from typing import Sequence
+from typing import Tuple
 from typing import Type
+from typing import Union
 
+from crobar.api import HackingOpException
 from crobar.api import TalosVersion
 
 
+class VersionEntry(NamedTuple):
+    """A version, as far as identifying it goes. load() gets the real thing."""
+    # The TalosVersion subclass, and the module in this package it's defined in
+    name: str
+    module: str
+    # Where the version string lives (relative), and what it says
+    ver_addr: int
+    ver_string: bytes
+    # linux, macos or windows
+    platform: str
+
+    def get_version_identifier(self) -> Tuple[int, bytes]:
+        """Returns an (address, bytes) tuple uniquely identifying this build."""
+        return (self.ver_addr, self.ver_string)
+
+    def load(self) -> Type[TalosVersion]:
+        """Imports the version's module, and returns its class."""
+        version: Type[TalosVersion] = getattr(importlib.import_module(f"{__name__}.{self.module}"), self.name)
+        if version.get_version_identifier() != self.get_version_identifier():
+            raise HackingOpException(f"{self.name} doesn't identify itself the way its entry in crobar.versions says")
+        return version
+
+
+# Anywhere that takes versions takes either of these
+AnyVersion = Union[Type[TalosVersion], VersionEntry]
+
+
 # Add versions here...
 # v(220480|244371|326589|440323|...)_(linux|macos|windows)_(x86)_(32|64)
-from .v244371_linux_x86_32 import TalosVersion_v244371_linux_x86_32
-from .v244371_windows_x86_32 import TalosVersion_v244371_windows_x86_32
-
-# ...and also remember to add them here too so they show up
+# `python -m crobar.port` can make a start on one from an executable, given one we already have
 # Yes, for all OSes, it IS possible to debug Windows stuff on Linux and FreeBSD via Wine
-ALL_VERSIONS: Sequence[Type[TalosVersion]] = (
-    TalosVersion_v244371_windows_x86_32,
-    TalosVersion_v244371_linux_x86_32,
+ALL_VERSIONS: Sequence[VersionEntry] = (
+    VersionEntry(
+        name="TalosVersion_v244371_windows_x86_32",
+        module="v244371_windows_x86_32",
+        ver_addr=0x01515f38,
+        ver_string=b"$Version: Talos_PC_distro; Talos-Windows-Final; 244371 2015-07-23 19:11:28 @builder14; Win32-Static-Final-Default$",
+        platform="windows"),
+    VersionEntry(
+        name="TalosVersion_v244371_linux_x86_32",
+        module="v244371_linux_x86_32",
+        ver_addr=0x09a7d174,
+        ver_string=b"$Version: Talos_PC_distro; Talos_Executables-Linux-Final; 244371 2015-07-23 19:11:33 @builderl02; Linux-Static-Final-Default$",
+        platform="linux"),
 )
 
+
+def find_version(name: str) -> Optional[VersionEntry]:
+    """Looks up a version by class name."""
+    for entry in ALL_VERSIONS:
+        if entry.name == name:
+            return entry
+    return None
+
+
+def load_version(version: AnyVersion) -> Type[TalosVersion]:
+    """Returns the class for a version, loading it if it's only an entry."""
+    return version.load() if isinstance(version, VersionEntry) else version
+
+
+def version_name(version: AnyVersion) -> str:
+    """Returns a version's class name, without loading it."""
+    return version.name if isinstance(version, VersionEntry) else version.__name__
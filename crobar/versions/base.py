@@ -1,20 +1,44 @@
 from abc import ABCMeta
 from abc import abstractmethod
+import logging
 import struct
-from typing import Tuple
+from typing import Iterable
+from typing import List
+from typing import Optional
 
 from crobar.api import DebugInterface
 from crobar.api import TalosVersion
 from crobar.api import HackingOpException
+from crobar.api import PatchSite
+from crobar.patchplan import PatchPlan
+from crobar.patchplan import compile_plan
+from crobar.remote import PointerResolver
+from crobar.remote import RemoteArray
+from crobar.remote import RemoteRecord
+from crobar.remote import StructLayout
+from crobar.remote import read_struct
+from crobar.watch import Watch
+
+logger = logging.getLogger(__name__)
 
 
 class BaseTalosVersion(TalosVersion, metaclass=ABCMeta):
     __slots__ = (
         "_debug_interface",
+        "_resolver",
     )
 
+    # Where gam_esgaStartAs lives (relative)
+    esga_start_as_addr: Optional[int] = None
+
+    # Where the pointer to the game mode list lives (relative), and the layouts of the list and its entries
+    game_mode_list_addr: Optional[int] = None
+    game_mode_list_layout: Optional[StructLayout] = None
+    game_mode_layout: Optional[StructLayout] = None
+
     def __init__(self, *, debug_interface: DebugInterface) -> None:
         self._debug_interface = debug_interface
+        self._resolver: Optional[PointerResolver] = None
 
     def from_relative_addr(self, addr: int) -> int:
         """Converts a relative-to-intended-memory-base address to an absolute address."""
@@ -24,31 +48,89 @@ class BaseTalosVersion(TalosVersion, metaclass=ABCMeta):
         """Packs a relative-to-intended-memory-base address as an absolute address."""
         return struct.pack("<I", self.from_relative_addr(addr))
 
-    def patch_memory(self, *, addr: int, old: bytes, new: bytes) -> bool:
-        """Attempts to apply a patch at the given address.
+    @property
+    def resolver(self) -> PointerResolver:
+        """Follows pointers and reads strings for this version, remembering what it's read."""
+        if self._resolver is None:
+            self._resolver = PointerResolver(self._debug_interface)
+        return self._resolver
 
-        Returns True if the patch applied.
-        Returns False if the patch was applied earlier
-        Throws a HackingOpException if the data there is neither old nor new.
-        """
+    def get_game_modes(self) -> RemoteArray:
+        """Returns the game mode table. Nothing gets read until something in it is wanted."""
+        if self.game_mode_list_addr is None or self.game_mode_list_layout is None or self.game_mode_layout is None:
+            raise HackingOpException(f"{type(self).__name__} doesn't know where its game modes are")
+        game_mode_list: RemoteRecord = read_struct(
+            self._debug_interface,
+            layout=self.game_mode_list_layout,
+            addr=self.from_relative_addr(self.game_mode_list_addr))
+        return RemoteArray(
+            self._debug_interface,
+            layout=self.game_mode_layout,
+            addr=game_mode_list["base"],
+            count=game_mode_list["count"])
 
-        assert len(old) == len(new)
-
-        ref: bytes = self._debug_interface.read_memory(
-            addr=addr,
-            length=len(old))
-
-        print(repr(ref))
-        if ref == new:
-            # Already been patched.
-            return False
-        elif ref == old:
-            # Needs to be patched.
-            self._debug_interface.write_memory(
-                addr=addr,
-                data=new)
-            return True
+    def _locate_upgrade_singleplayer(self) -> List[PatchSite]:
+        """Finds the SinglePlayer game mode, which lives wherever the game allocated it."""
+        game_modes: RemoteArray = self.get_game_modes()
+        logger.debug("Game modes: %d @ 0x%x", game_modes.count, game_modes.addr)
+
+        names: List[Optional[bytes]] = self.resolver.read_c_strings(
+            [name_addr for name_addr, in game_modes.column("name")])
+        for idx, game_mode_name in enumerate(names):
+            logger.debug("  - %2d: %r", idx, game_mode_name)
+            if game_mode_name == b"SinglePlayer":
+                logger.debug("    - Found it!")
+                break
         else:
-            # Unexpected data!
-            raise HackingOpException(f"unexpected data to be patched: {ref!r}")
+            raise HackingOpException("Could not find the \"SinglePlayer\" game mode")
+
+        # Set gar_bAllowsMP = true and gar_ctMaxPlayersTop = 16
+        return [
+            PatchSite(
+                addr=game_modes[idx].addr_of("multiplayer_settings"),
+                old=bytes([0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00]),
+                new=bytes([0x01, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x10, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00])),
+        ]
+
+    def get_watches(self) -> List[Watch]:
+        """Returns the live state worth keeping an eye on: gam_esgaStartAs, and each game mode's multiplayer fields."""
+        watches: List[Watch] = []
+        if self.esga_start_as_addr is not None:
+            watches.append(Watch(name="esga_start_as", addr=self.from_relative_addr(self.esga_start_as_addr), fmt="<I"))
+        if self.game_mode_list_addr is not None:
+            game_modes: RemoteArray = self.get_game_modes()
+            names: List[Optional[bytes]] = self.resolver.read_c_strings(
+                [name_addr for name_addr, in game_modes.column("name")])
+            for game_mode, name, in zip(game_modes, names):
+                label: str = (name or b"").decode("utf-8", "replace") or f"#{game_mode.index:d}"
+                for field in ("allows_mp", "max_players_top"):
+                    watches.append(Watch(name=f"{label}.{field}", addr=game_mode.addr_of(field), fmt="<" + game_modes.layout.fields[field].fmt))
+        return watches
+
+    def compile_patch_plan(self, *, names: Optional[Iterable[str]]=None) -> PatchPlan:
+        """Compiles patches from the manifest into one plan. Defaults to all of them."""
+        return compile_plan(self._debug_interface, self.get_patch_manifest(), names=names)
+
+    def apply_patch(self, name: str) -> bool:
+        """Applies one patch from the manifest, along with anything it requires.
+
+        Returns True if the patch applied, and False if it was applied earlier.
+        """
+        return self.compile_patch_plan(names=[name]).apply(self._debug_interface)[name]
+
+    def patch_enable_esga(self) -> bool:
+        return self.apply_patch("enable_esga")
+
+    def patch_bypass_game_mode_checks_for_map_vote(self) -> bool:
+        return self.apply_patch("bypass_game_mode_checks_for_map_vote")
+
+    def patch_crash_on_nexus_0001(self) -> bool:
+        if not any(spec.name == "crash_on_nexus_0001" for spec in self.get_patch_manifest()):
+            return super().patch_crash_on_nexus_0001()
+        return self.apply_patch("crash_on_nexus_0001")
+
+    def patch_upgrade_singleplayer(self) -> bool:
+        return self.apply_patch("upgrade_singleplayer")
 
+    def patch_ignore_pure_mode(self) -> bool:
+        return self.apply_patch("ignore_pure_mode")
@@ -0,0 +1,18 @@
+"""Layouts of the game's own structures, for each build that has them."""
+from crobar.remote import StructLayout
+from crobar.remote import make_layout
+
+# Where the game keeps its list of game modes
+GAME_MODE_LIST_V244371: StructLayout = make_layout("CGameModeList", 0x8, {
+    "base": (0x0, "I"),
+    "count": (0x4, "I"),
+})
+
+# One game mode
+GAME_MODE_V244371: StructLayout = make_layout("CGameMode", 0x1B4, {
+    "name": (0x4, "I"),
+    # Everything upgrade_singleplayer touches, starting one field before gar_bAllowsMP
+    "multiplayer_settings": (0x3C, "20s"),
+    "allows_mp": (0x40, "I"),
+    "max_players_top": (0x48, "I"),
+})
@@ -0,0 +1,231 @@
+"""Watching values in Talos's memory change, many times a second.
+
+Register what to watch with Watcher.add(), then either:
+- call poll() whenever you like, to get whatever changed since last time,
+- call run() with a callback, to poll at a steady rate until told to stop, or
+- iterate over it with `async for`, to get changes as they happen.
+
+Each tick is a single read_many() of everything being watched,
+which nearby values get merged into as few transfers as the backend can manage.
+Raw bytes get compared first, and only values that changed get decoded.
+
+Watch the raw debug interface, not a caching one, or nothing will ever change.
+
+Polling can miss a value that changes and changes back between ticks, and can't say what changed it.
+For that, backends which can do it offer hardware watchpoints, described by Watchpoint.
+"""
+import struct
+import threading
+import time
+from typing import Any
+from typing import AsyncIterator
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from crobar.api import DebugInterface
+from crobar.api import HackingOpException
+
+DEFAULT_RATE: float = 60.0
+
+# What a hardware watchpoint can watch for
+WATCH_EXECUTE = "execute"
+WATCH_WRITE = "write"
+WATCH_ACCESS = "access"
+
+
+class Watch(NamedTuple):
+    """Something to keep an eye on: where it is, and its struct module format (with a byte order)."""
+    name: str
+    addr: int
+    fmt: str
+
+
+class WatchEvent(NamedTuple):
+    """A watched value changing. old is None the first time it's seen, and new is None if it can't be read."""
+    name: str
+    addr: int
+    old: Any
+    new: Any
+    # time.monotonic() when the tick that saw it started
+    time: float
+
+
+class Watchpoint(NamedTuple):
+    """Something for a hardware watchpoint to watch, on backends which have them."""
+    addr: int
+    length: int = 4
+    kind: str = WATCH_WRITE
+
+
+class WatchpointHit(NamedTuple):
+    """A watchpoint going off."""
+    watchpoint: Watchpoint
+    # Which debug register it's in
+    slot: int
+    tid: int
+    ip: int
+    # What's there now, or None for executes, or if it couldn't be read
+    value: Optional[bytes]
+    # time.monotonic() when we heard about it
+    time: float
+
+
+class WatchStats:
+    """Counters for how well the watcher's keeping up."""
+    __slots__ = (
+        "ticks",
+        "changes",
+        "overruns",
+        "busy_time",
+        "max_time",
+    )
+
+    def __init__(self) -> None:
+        self.ticks: int = 0
+        self.changes: int = 0
+        # Ticks that took so long that the next one had to be skipped
+        self.overruns: int = 0
+        self.busy_time: float = 0.0
+        self.max_time: float = 0.0
+
+    def __repr__(self) -> str:
+        mean: float = self.busy_time / self.ticks if self.ticks else 0.0
+        return (
+            f"{self.ticks:d} ticks, {self.changes:d} changes, {self.overruns:d} overruns, "
+            f"{mean*1e6:.0f} us mean, {self.max_time*1e6:.0f} us max per tick")
+
+
+class Watcher:
+    """Samples a set of values at a steady rate, reporting only the ones that changed."""
+    __slots__ = (
+        "rate",
+        "stats",
+        "_debug_interface",
+        "_watches",
+        "_structs",
+        "_ranges",
+        "_last_raw",
+        "_last_values",
+    )
+
+    def __init__(self, debug_interface: DebugInterface, *, rate: float=DEFAULT_RATE) -> None:
+        self.rate = rate
+        self.stats = WatchStats()
+        self._debug_interface = debug_interface
+        self._watches: List[Watch] = []
+        self._structs: List[struct.Struct] = []
+        self._ranges: List[Tuple[int, int]] = []
+        self._last_raw: List[Optional[bytes]] = []
+        self._last_values: List[Any] = []
+
+    @property
+    def watches(self) -> Sequence[Watch]:
+        return self._watches
+
+    def add(self, name: str, addr: int, fmt: str="<I") -> None:
+        """Starts watching a value. The first poll() afterwards reports it as changed from None."""
+        if any(watch.name == name for watch in self._watches):
+            raise HackingOpException(f"already watching something called {name!r}")
+        compiled = struct.Struct(fmt)
+        self._watches.append(Watch(name=name, addr=addr, fmt=fmt))
+        self._structs.append(compiled)
+        self._ranges.append((addr, compiled.size))
+        self._last_raw.append(None)
+        self._last_values.append(None)
+
+    def add_all(self, watches: Sequence[Watch]) -> None:
+        for watch in watches:
+            self.add(watch.name, watch.addr, watch.fmt)
+
+    def remove(self, name: str) -> None:
+        for idx, watch in enumerate(self._watches):
+            if watch.name == name:
+                for items in (self._watches, self._structs, self._ranges, self._last_raw, self._last_values):
+                    del items[idx]
+                return
+        raise KeyError(name)
+
+    def values(self) -> Dict[str, Any]:
+        """Everything as of the last poll(), by name."""
+        return {watch.name: value for watch, value, in zip(self._watches, self._last_values)}
+
+    def poll(self) -> List[WatchEvent]:
+        """Reads everything once, and returns whatever changed since the last time."""
+        start: float = time.monotonic()
+        raw: List[Optional[bytes]] = self._debug_interface.read_many(ranges=self._ranges)
+        events: List[WatchEvent] = []
+        last_raw: List[Optional[bytes]] = self._last_raw
+        for idx, data, in enumerate(raw):
+            if data == last_raw[idx]:
+                continue
+            new: Any = None
+            if data is not None:
+                values: Tuple[Any, ...] = self._structs[idx].unpack(data)
+                new = values[0] if len(values) == 1 else values
+            watch: Watch = self._watches[idx]
+            events.append(WatchEvent(name=watch.name, addr=watch.addr, old=self._last_values[idx], new=new, time=start))
+            last_raw[idx] = data
+            self._last_values[idx] = new
+
+        elapsed: float = time.monotonic() - start
+        self.stats.ticks += 1
+        self.stats.changes += len(events)
+        self.stats.busy_time += elapsed
+        self.stats.max_time = max(self.stats.max_time, elapsed)
+        return events
+
+    def _next_deadline(self, deadline: float, now: float) -> float:
+        """Where the next tick should start. If we've fallen behind, skip ticks rather than bunching them up."""
+        period: float = 1.0 / self.rate
+        deadline += period
+        if deadline < now:
+            missed: int = int((now - deadline) / period) + 1
+            self.stats.overruns += missed
+            deadline += missed * period
+        return deadline
+
+    def run(
+            self,
+            callback: Callable[[WatchEvent], None],
+            *,
+            stop: Optional[threading.Event]=None,
+            duration: Optional[float]=None) -> None:
+        """Polls at the watcher's rate, calling back with each change, until stop is set or duration runs out."""
+        started: float = time.monotonic()
+        deadline: float = started
+        while not (stop is not None and stop.is_set()):
+            for event in self.poll():
+                callback(event)
+            now: float = time.monotonic()
+            if duration is not None and now - started >= duration:
+                break
+            deadline = self._next_deadline(deadline, now)
+            if stop is not None:
+                stop.wait(deadline - now)
+            else:
+                time.sleep(deadline - now)
+
+    async def changes(self) -> AsyncIterator[WatchEvent]:
+        """Polls at the watcher's rate, yielding each change, forever.
+
+        Reads happen on the event loop's own thread. They're quick, and backends
+        which have to stop the target only work from the thread that attached.
+        """
+        # Importing asyncio takes longer than everything else crobar needs to start, so only when it's wanted.
+        import asyncio
+
+        deadline: float = time.monotonic()
+        while True:
+            for event in self.poll():
+                yield event
+            now: float = time.monotonic()
+            deadline = self._next_deadline(deadline, now)
+            await asyncio.sleep(deadline - now)
+
+    def __aiter__(self) -> AsyncIterator[WatchEvent]:
+        return self.changes()